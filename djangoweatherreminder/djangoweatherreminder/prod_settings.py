@@ -36,7 +36,16 @@ CELERY_BROKER_TRANSPORT_OPTIONS = {'visibility_timeout': 3600}
 CELERY_ACCEPT_CONTENT = ['application/json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
-CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
+CELERY_BEAT_SCHEDULER = 'weatherreminder.scheduler:HeapScheduler'
+
+# HeapScheduler receives due time changes of web and celery processes through this cache
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': f'redis://redis:{REDIS_HOST}/1',
+    }
+}
+SHARED_CACHE_ALIAS = 'default'
 CELERY_IMPORTS = [
     'weatherreminder.tasks',
 ]
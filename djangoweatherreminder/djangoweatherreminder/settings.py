@@ -15,6 +15,7 @@ from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 import environ
+from celery.schedules import crontab
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 env = environ.Env()
@@ -34,11 +35,15 @@ EMAIL_HOST_USER = env('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = env('EMAIL_HOST_PASSWORD')
 DEFAULT_FROM_EMAIL = env('DEFAULT_FROM_EMAIL')
 RECIPIENTS_EMAIL = env('RECIPIENTS_EMAIL')
+EMAIL_BATCH_SIZE = 100  # emails sent over one SMTP connection before it is renewed
 
 # SECURITY WARNING: don't run with debug turned on in production!
 
 ALLOWED_HOSTS = []
 
+# CACHES alias shared by all web, celery and beat processes, set by prod_settings
+SHARED_CACHE_ALIAS = None
+
 try:
     from local_settings import *
 except ImportError:
@@ -137,6 +142,11 @@ REST_FRAMEWORK = {
    # )
 }
 
+# Cursor pagination of the cities and subscriptions lists, ?page_size= is capped by API_MAX_PAGE_SIZE
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+SUBSCRIPTIONS_BULK_MAX_OPERATIONS = 1000  # operations per bulk subscriptions request
+
 # Internationalization
 # https://docs.djangoproject.com/en/4.1/topics/i18n/
 
@@ -170,6 +180,112 @@ MEDIA_URL = '/media/'
 
 OPEN_WEATHER_API_URL = 'http://api.openweathermap.org/data/2.5/weather'
 WEATHER_BIT_API_URL = 'http://api.weatherbit.io/v2.0/current'
+# Cities with known OpenWeatherMap ids are refreshed in groups of up to 20 per request
+OPEN_WEATHER_GROUP_API_URL = 'http://api.openweathermap.org/data/2.5/group'
+OPEN_WEATHER_GROUP_SIZE = 20
+WEATHER_API_TIMEOUT = 10  # seconds
+WEATHER_API_CONCURRENCY = 50  # provider requests in flight per process
+WEATHER_UPSERT_BATCH_SIZE = 1000  # Weather rows per INSERT ... ON CONFLICT statement
+
+# Services queried together by the fan-out fetch, concurrently, so every added service
+# costs no extra latency. 'fastest' takes the first response, 'consensus' merges the responses
+# that arrive within WEATHER_FANOUT_BUDGET seconds. The home page uses WEATHER_FANOUT_MODE
+# for lookups without a personal token; None keeps the single OpenWeatherMap request.
+WEATHER_PROVIDERS = ['OpenWeatherMap', 'WeatherBit']
+WEATHER_FANOUT_MODE = None
+WEATHER_FANOUT_BUDGET = 2  # seconds
+
+# Serve the home and subscription pages with the async views of weatherreminder/async_views.py,
+# so a slow provider doesn't hold a worker thread. Needs an ASGI server, e.g.
+# gunicorn djangoweatherreminder.asgi:application -k uvicorn.workers.UvicornWorker
+ASYNC_VIEWS = env.bool('ASYNC_VIEWS', default=False)
+WEATHER_ASYNC_VIEWS_CONCURRENCY = 500  # provider calls in flight per ASGI process
+
+# Provider quotas per API key. Bursts above the limit are delayed to the allowed rate;
+# views give up with 429 if they would wait longer than WEATHER_RATE_LIMIT_MAX_WAIT seconds.
+# WEATHER_RATE_LIMITS is keyed by API key for keys with their own plan, or by service name;
+# other keys get WEATHER_RATE_LIMIT_DEFAULT.
+# WEATHER_RATE_LIMIT_ALIAS, a shared CACHES alias, counts calls of all workers together.
+WEATHER_RATE_LIMITS = {
+    'OpenWeatherMap': {'per_minute': 60, 'burst': 10},
+    'WeatherBit': {'per_minute': 30, 'burst': 5},
+}
+WEATHER_RATE_LIMIT_DEFAULT = {'per_minute': 30, 'burst': 5}
+WEATHER_RATE_LIMIT_ALIAS = SHARED_CACHE_ALIAS
+WEATHER_RATE_LIMIT_MAX_WAIT = 5
+
+# Circuit breaker per provider: WEATHER_BREAKER_FAILURES failed or slower than
+# WEATHER_BREAKER_SLOW_CALL seconds calls in a row stop view calls for WEATHER_BREAKER_RESET
+# seconds; stored weather older than WEATHER_STALE_AFTER is shown with its age.
+WEATHER_BREAKER_FAILURES = 5
+WEATHER_BREAKER_SLOW_CALL = 5  # seconds
+WEATHER_BREAKER_RESET = 60  # seconds
+WEATHER_BREAKER_ALIAS = SHARED_CACHE_ALIAS
+WEATHER_STALE_AFTER = timedelta(hours=2)
+
+# Provider responses cache. WEATHER_CACHE_ALIAS, a shared CACHES alias (e.g. 'default' on redis),
+# shares cached responses between all web and celery workers.
+WEATHER_CACHE_TTL = 600  # seconds
+WEATHER_CACHE_MAXSIZE = 1024  # responses kept in memory of every process
+WEATHER_CACHE_ALIAS = SHARED_CACHE_ALIAS
+
+# Concurrent requests for the same city wait for one provider call. Processes coordinate
+# through WEATHER_SINGLEFLIGHT_ALIAS, which should be shared, like WEATHER_CACHE_ALIAS.
+WEATHER_SINGLEFLIGHT_ALIAS = WEATHER_CACHE_ALIAS
+WEATHER_SINGLEFLIGHT_TIMEOUT = 15  # seconds
+
+# City names validation cache
+CITY_VALID_TTL = timedelta(days=30)
+CITY_INVALID_TTL = timedelta(days=1)
+
+# Offline list of cities for validation and autocomplete: the bundled csv
+# or OpenWeatherMap's city.list.json(.gz) for full coverage
+GAZETTEER_PATH = os.path.join(BASE_DIR, 'weatherreminder', 'data', 'cities.csv')
+GAZETTEER_AUTOCOMPLETE_LIMIT = 10
+
+# Notifications dispatcher
+NOTIFICATION_DISPATCH_INTERVAL = 5  # minutes
+NOTIFICATION_DISPATCH_BATCH_SIZE = 500
+
+# Weather is refreshed only ahead of notifications: the hourly refresh at minute 45 fetches
+# the pairs with a notification due within WEATHER_REFRESH_LEAD, unless their weather is
+# already that fresh. Keep it over 15 minutes, so full hour notifications are caught.
+# Weather older than WEATHER_REFRESH_MAX_AGE is refreshed whatever the notifications,
+# as views and the API show it too.
+WEATHER_REFRESH_LEAD = timedelta(minutes=30)
+WEATHER_REFRESH_MAX_AGE = timedelta(hours=3)
+
+# weatherreminder.scheduler:HeapScheduler runs the dispatcher right when the first subscription
+# is due. Due time changes reach beat through NOTIFICATION_EVENTS_ALIAS, a CACHES alias shared
+# with web and celery workers; without it beat only knows the due times it loaded at start and
+# the dispatcher interval above catches up with the rest.
+NOTIFICATION_EVENTS_ALIAS = SHARED_CACHE_ALIAS
+NOTIFICATION_EVENTS_TTL = 3600  # seconds
+NOTIFICATION_EVENTS_MAXSIZE = 10000  # batches kept in process memory without a shared alias
+NOTIFICATION_EVENTS_POLL = 5  # seconds between reads of new changes by beat
+NOTIFICATION_EVENTS_GAP_TIMEOUT = 30  # seconds to wait for a missing batch before a full reload
+
+# Weather history: raw observations are kept for WEATHER_HISTORY_RAW_DAYS,
+# then rolled into daily aggregates kept for WEATHER_HISTORY_DAILY_DAYS
+WEATHER_HISTORY_RAW_DAYS = 7
+WEATHER_HISTORY_DAILY_DAYS = 730
+WEATHER_HISTORY_INSERT_BATCH_SIZE = 1000
+WEATHER_HISTORY_PRUNE_BATCH_SIZE = 5000  # rows downsampled or deleted per transaction
+
+CELERY_BEAT_SCHEDULE = {
+    'dispatch-due-notifications': {
+        'task': 'dispatch_notifications_task',
+        'schedule': timedelta(minutes=NOTIFICATION_DISPATCH_INTERVAL),
+    },
+    'refresh-subscribed-weather': {
+        'task': 'refresh_weather_task',
+        'schedule': crontab(minute='45'),
+    },
+    'downsample-weather-history': {
+        'task': 'downsample_weather_history_task',
+        'schedule': crontab(minute='30', hour='3'),
+    },
+}
 
 SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(days=15),
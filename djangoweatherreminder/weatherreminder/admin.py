@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import User, City, Subscription, Weather
+from .models import User, City, Subscription, Weather, CityValidation, WeatherObservation, WeatherDaily
 
 
 class UserAdmin(admin.ModelAdmin):
@@ -7,7 +7,7 @@ class UserAdmin(admin.ModelAdmin):
 
 
 class CityAdmin(admin.ModelAdmin):
-    list_display = ('id', 'name')
+    list_display = ('id', 'name', 'open_weather_id', 'lat', 'lon')
 
 
 class SubscriptionAdmin(admin.ModelAdmin):
@@ -15,10 +15,25 @@ class SubscriptionAdmin(admin.ModelAdmin):
 
 
 class WeatherAdmin(admin.ModelAdmin):
-    list_display = ('id', 'city', 'service', 'country_code', 'coordinate', 'temp', 'pressure', 'humidity')
+    list_display = ('id', 'city', 'service', 'country_code', 'lat', 'lon', 'temp', 'pressure', 'humidity')
+
+
+class WeatherObservationAdmin(admin.ModelAdmin):
+    list_display = ('id', 'city', 'service', 'observed_at', 'temp', 'pressure', 'humidity')
+
+
+class WeatherDailyAdmin(admin.ModelAdmin):
+    list_display = ('id', 'city', 'service', 'date', 'temp_min', 'temp_max', 'temp_avg', 'samples')
+
+
+class CityValidationAdmin(admin.ModelAdmin):
+    list_display = ('id', 'name', 'service', 'exists', 'checked_at')
 
 
 admin.site.register(User, UserAdmin)
 admin.site.register(City, CityAdmin)
 admin.site.register(Subscription, SubscriptionAdmin)
 admin.site.register(Weather, WeatherAdmin)
+admin.site.register(CityValidation, CityValidationAdmin)
+admin.site.register(WeatherObservation, WeatherObservationAdmin)
+admin.site.register(WeatherDaily, WeatherDailyAdmin)
@@ -1,4 +1,5 @@
 
+from django.db import IntegrityError, transaction
 from rest_framework import status
 from rest_framework.authentication import SessionAuthentication
 
@@ -9,7 +10,13 @@ from rest_framework_simplejwt.authentication import JWTAuthentication
 import environ
 
 from weatherreminder.models import *
-from weatherreminder.serializers import SubscriptionSerializer, CitySerializer, WeatherSerializer
+from djangoweatherreminder.settings import GAZETTEER_AUTOCOMPLETE_LIMIT
+from weatherreminder.gazetteer import get_gazetteer
+from weatherreminder.pagination import paginated_response
+from weatherreminder.schedule_events import schedule_events
+from weatherreminder.serializers import SubscriptionSerializer, CitySerializer, WeatherSerializer, \
+    GazetteerCitySerializer, BulkSubscriptionSerializer
+from weatherreminder.tasks import fetch_missing_weather_task
 from weatherreminder.utils import check_or_create_weather, check_existing_subscription
 
 env = environ.Env()
@@ -22,11 +29,10 @@ class SubscriptionAPIList(APIView):
     permission_classes = (IsAuthenticated,)
 
     def get(self, request, *args, **kwargs):
-        request.data['user'] = User.objects.get(pk=request.user.id).id
         pk = kwargs.get("pk", None)
         if not pk:
             subscriptions = Subscription.objects.filter(user=request.user.id)
-            return Response({'users_cities': SubscriptionSerializer(subscriptions, many=True).data}, status.HTTP_200_OK)
+            return paginated_response(request, self, subscriptions, SubscriptionSerializer, 'users_cities')
         try:
             subscription = Subscription.objects.get(pk=pk)
         except:
@@ -37,17 +43,23 @@ class SubscriptionAPIList(APIView):
         if kwargs.get("pk", None):
             return Response("Method POST got an unexpected keyword argument 'pk'", status.HTTP_405_METHOD_NOT_ALLOWED)
         request.data['user'] = User.objects.get(pk=request.user.id).id
-        check_existing_subscription(request.data)
+        existing_subscription = check_existing_subscription(request.data)
+        if existing_subscription is not None:
+            return existing_subscription
         subscription_serializer = SubscriptionSerializer(data=request.data)
         subscription_serializer.is_valid(raise_exception=True)
-        subscription_serializer.save()
+        try:
+            with transaction.atomic():
+                subscription_serializer.save()
+        except IntegrityError:
+            # A concurrent request has created the same subscription
+            return Response("Such subscription already exists!", status.HTTP_409_CONFLICT)
         city = City.objects.get(pk=request.data['city'])
         check_or_create_weather(city, city.name, subscription_serializer.data['service'])
         city.users.add(request.user)
         city.save()
         subscription = Subscription.objects.get(pk=subscription_serializer.data['id'])
         SubscriptionTask(subscription).create_task()
-        WeatherTask(subscription).create_task()
         return Response({"subscription": subscription_serializer.data},
                         status=status.HTTP_201_CREATED)
 
@@ -77,11 +89,24 @@ class SubscriptionAPIList(APIView):
         except:
             return Response({"error": "Such city does not exist to delete!"}, status.HTTP_404_NOT_FOUND)
         SubscriptionTask(subscription).delete_task()
-        WeatherTask(subscription).delete_subscription_weather_task()
         subscription.delete()
         return Response({"subscription": "delete subscription " + str(pk)}, status=status.HTTP_204_NO_CONTENT)
 
 
+class SubscriptionBulkView(APIView):
+    authentication_classes = [JWTAuthentication, SessionAuthentication]
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request):
+        """Applies a list of create/update/delete operations in one transaction"""
+        bulk_serializer = BulkSubscriptionSerializer(data=request.data, context={'request': request})
+        with transaction.atomic():
+            bulk_serializer.is_valid(raise_exception=True)
+            result = bulk_serializer.save()
+            pairs = sorted({(subscription.city_id, subscription.service) for subscription in result['created']})
+            if pairs:
+                transaction.on_commit(lambda: fetch_missing_weather_task.delay(pairs))
+        return Response(bulk_serializer.data, status=status.HTTP_200_OK)
 
 
 class CitiesListView(APIView):
@@ -92,7 +117,7 @@ class CitiesListView(APIView):
         pk = kwargs.get("pk", None)
         if not pk:
             cities = City.objects.all()
-            return Response({'users_cities': CitySerializer(cities, many=True).data}, status.HTTP_200_OK)
+            return paginated_response(request, self, cities, CitySerializer, 'users_cities')
         try:
             city = City.objects.get(pk=pk)
         except:
@@ -116,16 +141,32 @@ class CitiesListView(APIView):
             city = City.objects.get(pk=pk)
         except:
             return Response({"error": "Such city does not exist to delete!"}, status.HTTP_404_NOT_FOUND)
+        # The city is deleted with subscriptions of all users, beat has to forget all of them
+        schedule_events.publish([(pk, None) for pk in Subscription.objects.filter(city=city)
+                                .values_list('pk', flat=True)])
         subscriptions = Subscription.objects.filter(city=city, user=request.user)
 
         for s in subscriptions:
-            WeatherTask(s).delete_city_weather_task()
-            SubscriptionTask(s).delete_task()
             s.delete()
         city.delete()
         return Response({"city": "delete city " + str(pk)}, status=status.HTTP_204_NO_CONTENT)
 
 
+class CityAutocompleteView(APIView):
+    authentication_classes = [JWTAuthentication, SessionAuthentication]
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request):
+        """Cities from the gazetteer whose name starts with `q`"""
+        try:
+            limit = min(int(request.query_params.get('limit', GAZETTEER_AUTOCOMPLETE_LIMIT)),
+                        GAZETTEER_AUTOCOMPLETE_LIMIT)
+        except ValueError:
+            return Response({"error": "limit should be a number"}, status.HTTP_400_BAD_REQUEST)
+        cities = get_gazetteer().search(request.query_params.get('q', ''), limit)
+        return Response({'cities': GazetteerCitySerializer(cities, many=True).data}, status=status.HTTP_200_OK)
+
+
 class GetWeather(APIView):
     authentication_classes = [JWTAuthentication, SessionAuthentication]
     permission_classes = (IsAuthenticated,)
@@ -135,4 +176,3 @@ class GetWeather(APIView):
         return Response({'weather_in_DB': WeatherSerializer(weather, many=True).data}, status=status.HTTP_200_OK)
 
 
-
@@ -0,0 +1,139 @@
+"""Async versions of the home and subscription views, served instead of the ones
+from views.py when ASYNC_VIEWS is set. They wait for providers on the event loop,
+so one ASGI process holds hundreds of provider calls in flight instead of a thread per call."""
+import asyncio
+
+import aiohttp
+from asgiref.sync import sync_to_async
+from django.contrib.auth.views import redirect_to_login
+from django.shortcuts import render
+
+from djangoweatherreminder.settings import WEATHER_FANOUT_MODE, WEATHER_FANOUT_BUDGET
+from weatherreminder.breaker import ProviderUnavailable
+from weatherreminder.clients import get_view_client
+from weatherreminder.gazetteer import get_gazetteer
+from weatherreminder.models import City, Service, Subscription, Weather, next_notification_time
+from weatherreminder.ratelimit import RateLimited
+from weatherreminder.schedule_events import schedule_events
+from weatherreminder.tasks import fetch_missing_weather_task
+from weatherreminder.utils import BaseWeather, CityName, CityNotFound, check_period, enabled_services, get_provider
+from weatherreminder.views import SubscribeView
+
+
+async def get_user(request):
+    """Loads the lazy request.user off the event loop, so templates can use it"""
+    await sync_to_async(lambda: request.user.is_authenticated)()
+    return request.user
+
+
+async def get_stored_weather(city, service):
+    return await Weather.objects.filter(city_name=CityName(CityName(city).view()).serializer(),
+                                        service=service).afirst()
+
+
+async def home(request):
+    if request.method == 'POST':
+        city = request.POST.get('city')
+        token = request.POST.get('token')
+        client = await get_view_client()
+        try:
+            if WEATHER_FANOUT_MODE and not token:
+                services = enabled_services()
+                if WEATHER_FANOUT_MODE == 'consensus':
+                    reading, _ = await client.fetch_consensus(city, services, WEATHER_FANOUT_BUDGET)
+                else:
+                    reading, _ = await client.fetch_fastest(city, services)
+                context = BaseWeather(city=city).get_context_from_reading(reading, index=True)
+            else:
+                provider, _ = get_provider(city, Service.open_weather)
+                try:
+                    reading = await client.get_reading(city, Service.open_weather, token)
+                except (ProviderUnavailable, aiohttp.ClientError, asyncio.TimeoutError):
+                    stored = await get_stored_weather(city, Service.open_weather)
+                    if stored is None:
+                        raise
+                    context = provider.get_context_from_weather(stored, index=True)
+                else:
+                    context = provider.get_context_from_reading(reading, index=True)
+        except:
+            context = {'error': True}
+        await get_user(request)
+        return render(request, 'weatherreminder/index.html', context)
+    context = {"user": await get_user(request)}
+    return render(request, 'weatherreminder/index.html', context)
+
+
+class AsyncSubscribeView(SubscribeView):
+    """SubscribeView with the provider call and the reads on the event loop.
+    The writes of a new subscription run in one transaction in a worker thread."""
+
+    async def dispatch(self, request, *args, **kwargs):
+        user = await get_user(request)
+        if not user.is_authenticated:
+            return redirect_to_login(request.get_full_path(), self.get_login_url(), self.get_redirect_field_name())
+        return await super().dispatch(request, *args, **kwargs)
+
+    async def get(self, request):
+        context = self.get_user_context(title=self.title, user=request.user)
+        return render(request, self.template_name, context=context)
+
+    async def post(self, request):
+        user = request.user
+        context = self.get_user_context(title=self.title, user=user)
+        city = request.POST.get('city')
+        period = check_period(request.POST.get('period'))
+        provider, _ = get_provider(city, self.service)
+        try:
+            city_name = CityName(city).serializer()
+        except:
+            context['error'] = True
+            return render(request, self.template_name, context, status=302)
+        existing_city = await City.objects.filter(name__iexact=city_name).afirst()
+        weather = None
+        if existing_city is not None:
+            weather = await Weather.objects.filter(city=existing_city, service=self.service).afirst()
+            existing_subscription = await Subscription.objects.filter(
+                city=existing_city, user=user, service=self.service).values_list('pk', flat=True).afirst()
+            if existing_subscription is not None:
+                due = next_notification_time(period)
+                await Subscription.objects.filter(pk=existing_subscription) \
+                    .aupdate(period_notifications=period, next_notification_at=due)
+                await sync_to_async(schedule_events.publish)([(existing_subscription, due)])
+                if weather is not None:
+                    context.update(provider.get_context_from_weather(weather, index=True))
+                context['exists'] = True
+                return render(request, self.template_name, context, status=302)
+        reading = None
+        if weather is None:
+            client = await get_view_client()
+            try:
+                reading = await client.get_city_reading(city, self.service)
+            except CityNotFound:
+                context['error'] = True
+                return render(request, self.template_name, context, status=302)
+            except (ProviderUnavailable, RateLimited, aiohttp.ClientError, asyncio.TimeoutError):
+                # Loading the gazetteer reads a file, so the first call must not block the loop
+                if city not in await sync_to_async(get_gazetteer)():
+                    context['to_many'] = True
+                    return render(request, self.template_name, context, status=429)
+        subscription = await sync_to_async(self.create_subscription)(user, existing_city, city_name, period, reading)
+        if reading is not None:
+            context.update(provider.get_context_from_reading(reading, index=True))
+        elif weather is not None:
+            context.update(provider.get_context_from_weather(weather, index=True))
+        else:
+            await sync_to_async(fetch_missing_weather_task.delay)([[subscription.city_id, self.service]])
+            context['city'] = CityName(city).view()
+        return render(request, self.template_name, context, status=200)
+
+
+class OpenWeatherView(AsyncSubscribeView):
+    template_name = 'weatherreminder/open_weather.html'
+    title = "OpenWeatherMap service"
+    service = Service.open_weather
+
+
+class WeatherBitView(AsyncSubscribeView):
+    template_name = 'weatherreminder/weather_bit.html'
+    title = "WeatherBit service"
+    service = Service.weather_bit
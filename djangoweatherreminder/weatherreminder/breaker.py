@@ -0,0 +1,112 @@
+import threading
+import time
+
+from django.core.cache import caches
+
+from djangoweatherreminder.settings import WEATHER_BREAKER_FAILURES, WEATHER_BREAKER_SLOW_CALL, \
+    WEATHER_BREAKER_RESET, WEATHER_BREAKER_ALIAS
+from weatherreminder.ratelimit import RateLimited
+
+
+class ProviderUnavailable(Exception):
+    """The circuit of the provider is open, the call was not sent"""
+
+
+def is_provider_failure(exception) -> bool:
+    """Errors, timeouts and 5xx/429 responses count against the provider,
+    other 4xx responses (e.g. unknown city) are answers of a healthy provider.
+    RateLimited is our own quota, the provider was not called."""
+    if isinstance(exception, RateLimited):
+        return False
+    response = getattr(exception, 'response', None)
+    code = getattr(exception, 'status', None) or getattr(response, 'status_code', None)
+    return not (code and 400 <= code < 500 and code != 429)
+
+
+class CircuitBreaker:
+    """Counts consecutive failed or slower than `slow_call` seconds provider calls.
+    After `failures` of them the circuit opens for `reset` seconds: views stop calling
+    the provider and serve stored weather instead, while background refreshes keep
+    probing it. The first successful probe closes the circuit.
+
+    With `alias` from CACHES the state is shared by all web and celery processes,
+    otherwise it lives in the process memory."""
+
+    def __init__(self, name, failures=WEATHER_BREAKER_FAILURES, slow_call=WEATHER_BREAKER_SLOW_CALL,
+                 reset=WEATHER_BREAKER_RESET, alias=WEATHER_BREAKER_ALIAS, timer=time.time):
+        self.name = name
+        self.failures = failures
+        self.slow_call = slow_call
+        self.reset = reset
+        self.alias = alias
+        self.timer = timer
+        self.state = {'failures': 0, 'opened_until': 0}
+        self.lock = threading.Lock()
+
+    @property
+    def shared(self):
+        return caches[self.alias] if self.alias else None
+
+    @property
+    def key(self):
+        return f'breaker:{self.name}'
+
+    def load(self) -> dict:
+        if self.shared is None:
+            return dict(self.state)
+        return self.shared.get(self.key) or {'failures': 0, 'opened_until': 0}
+
+    def store(self, state):
+        if self.shared is None:
+            self.state = state
+        else:
+            self.shared.set(self.key, state, None)
+
+    @property
+    def is_open(self) -> bool:
+        return self.load()['opened_until'] > self.timer()
+
+    def check(self):
+        """Raises ProviderUnavailable instead of a call to a failing provider"""
+        if self.is_open:
+            raise ProviderUnavailable(f"{self.name} is unavailable, serving stored weather")
+
+    def record_success(self, elapsed=0):
+        if elapsed > self.slow_call:
+            return self.record_failure()
+        with self.lock:
+            if self.load()['failures']:
+                self.store({'failures': 0, 'opened_until': 0})
+
+    def record_failure(self):
+        with self.lock:
+            state = self.load()
+            state['failures'] += 1
+            if state['failures'] >= self.failures:
+                state['opened_until'] = self.timer() + self.reset
+            self.store(state)
+
+    def call(self, function, *args, probe=False, **kwargs):
+        """Calls the provider through the breaker. Probes are sent even with the open circuit"""
+        if not probe:
+            self.check()
+        started = time.monotonic()
+        try:
+            result = function(*args, **kwargs)
+        except Exception as e:
+            if is_provider_failure(e):
+                self.record_failure()
+            raise
+        self.record_success(time.monotonic() - started)
+        return result
+
+
+breakers = {}
+breakers_lock = threading.Lock()
+
+
+def get_breaker(service) -> CircuitBreaker:
+    with breakers_lock:
+        if service not in breakers:
+            breakers[service] = CircuitBreaker(str(service))
+        return breakers[service]
@@ -0,0 +1,173 @@
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import quote
+
+from django.core.cache import caches
+from django.db import IntegrityError
+from django.utils import timezone
+
+from djangoweatherreminder.settings import WEATHER_CACHE_TTL, WEATHER_CACHE_MAXSIZE, WEATHER_CACHE_ALIAS, \
+    CITY_VALID_TTL, CITY_INVALID_TTL
+from weatherreminder.breaker import ProviderUnavailable
+from weatherreminder.models import CityValidation
+from weatherreminder.singleflight import single_flight
+
+
+def normalize_city(city):
+    """'New%20York', 'new_york' and ' New York' are the same city for caches"""
+    return city.replace('%20', ' ').replace('_', ' ').strip().lower()
+
+
+class TTLCache:
+    """Thread-safe in-process LRU cache. Entries expire `ttl` seconds after they were set
+    and the least recently used entry is evicted once there are more than `maxsize`."""
+
+    def __init__(self, maxsize, ttl, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                return default
+            expires, value = item
+            if expires <= self.timer():
+                del self.data[key]
+                return default
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self.data[key] = (self.timer() + (self.ttl if ttl is None else ttl), value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+
+class ProviderCache:
+    """Cache of raw provider responses keyed by (service, normalized city, units).
+    The first tier lives in the process memory, the optional second one is a Django cache
+    (`alias` from CACHES) shared by all gunicorn and celery workers."""
+
+    def __init__(self, ttl=WEATHER_CACHE_TTL, maxsize=WEATHER_CACHE_MAXSIZE, alias=WEATHER_CACHE_ALIAS):
+        self.ttl = ttl
+        self.local = TTLCache(maxsize, ttl)
+        self.alias = alias
+
+    @property
+    def shared(self):
+        return caches[self.alias] if self.alias else None
+
+    @staticmethod
+    def key(service, city, units='metric'):
+        return f'weather:{quote(service)}:{units}:{quote(normalize_city(city))}'
+
+    def get(self, service, city, units='metric'):
+        key = self.key(service, city, units)
+        data = self.local.get(key)
+        if data is None and self.shared is not None:
+            data = self.shared.get(key)
+            if data is not None:
+                self.local.set(key, data)
+        return data
+
+    def set(self, service, city, data, units='metric'):
+        key = self.key(service, city, units)
+        self.local.set(key, data)
+        if self.shared is not None:
+            self.shared.set(key, data, self.ttl)
+
+    def clear(self):
+        self.local.clear()
+
+
+provider_cache = ProviderCache()
+
+
+class CityValidationCache:
+    """Remembers whether the service knows a city name, so repeated checks and typos
+    cost no provider requests. Confirmed names are kept for CITY_VALID_TTL, unknown ones
+    for CITY_INVALID_TTL. Results live in the CityValidation table, shared by all processes,
+    and in the memory of the process."""
+
+    def __init__(self, valid_ttl=CITY_VALID_TTL, invalid_ttl=CITY_INVALID_TTL):
+        self.valid_ttl = valid_ttl
+        self.invalid_ttl = invalid_ttl
+        self.local = TTLCache(WEATHER_CACHE_MAXSIZE, valid_ttl.total_seconds())
+
+    @staticmethod
+    def key(service, city):
+        return f'{service}:{normalize_city(city)}'
+
+    def get(self, service, city):
+        """Returns True or False for a checked city and None for an unknown one"""
+        key = self.key(service, city)
+        exists = self.local.get(key)
+        if exists is not None:
+            return exists
+        now = timezone.now()
+        validation = CityValidation.objects.filter(service=service, name=normalize_city(city)).first()
+        if validation is None:
+            return None
+        ttl = self.valid_ttl if validation.exists else self.invalid_ttl
+        if validation.checked_at + ttl <= now:
+            return None
+        self.local.set(key, validation.exists, (validation.checked_at + ttl - now).total_seconds())
+        return validation.exists
+
+    def set(self, service, city, exists):
+        key = self.key(service, city)
+        ttl = self.valid_ttl if exists else self.invalid_ttl
+        self.local.set(key, exists, ttl.total_seconds())
+        try:
+            CityValidation.objects.update_or_create(
+                service=service, name=normalize_city(city),
+                defaults={'exists': exists, 'checked_at': timezone.now()},
+            )
+        except IntegrityError:
+            pass
+
+    def check(self, service, city, request_status) -> bool:
+        """Returns whether the city exists, calling `request_status()` for the status code
+        of the service response only when there is no cached result.
+        Errors other than "not found" are not cached: they raise ProviderUnavailable,
+        as the service couldn't tell whether the city exists."""
+        exists = self.get(service, city)
+        if exists is not None:
+            return exists
+        return single_flight.do(f'city:{quote(self.key(service, city))}',
+                                lambda: self.request(service, city, request_status),
+                                lookup=lambda: self.get(service, city))
+
+    def request(self, service, city, request_status) -> bool:
+        status_code = request_status()
+        if status_code == 200:
+            self.set(service, city, True)
+            return True
+        if status_code in (204, 400, 404):
+            self.set(service, city, False)
+            return False
+        raise ProviderUnavailable(f"{service} answered {status_code} to the check of {city}")
+
+    def clear(self):
+        self.local.clear()
+
+
+city_validation_cache = CityValidationCache()
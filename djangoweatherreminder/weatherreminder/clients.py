@@ -0,0 +1,320 @@
+import asyncio
+import time
+import weakref
+from collections import defaultdict
+
+import aiohttp
+
+from asgiref.sync import sync_to_async
+
+from djangoweatherreminder.settings import WEATHER_API_TIMEOUT, WEATHER_API_CONCURRENCY, WEATHER_FANOUT_BUDGET, \
+    WEATHER_RATE_LIMIT_MAX_WAIT, WEATHER_ASYNC_VIEWS_CONCURRENCY
+from weatherreminder.breaker import ProviderUnavailable, get_breaker, is_provider_failure
+from weatherreminder.cache import city_validation_cache, provider_cache
+from weatherreminder.ratelimit import get_bucket
+from weatherreminder.utils import CityNotFound, enabled_services, get_provider, merge_readings, providers, \
+    resolve_city
+
+
+async def off_loop(store, function, *args, **kwargs):
+    """Calls `function` of a provider cache, circuit breaker or rate limit bucket.
+    With a shared alias the call is a network round-trip that may also wait for a lock,
+    so it runs in a worker thread instead of blocking the event loop."""
+    if store.shared is None:
+        return function(*args, **kwargs)
+    return await sync_to_async(function, thread_sensitive=False)(*args, **kwargs)
+
+
+class AsyncWeatherClient:
+    """Asyncio client for bulk refresh of weather.
+    All requests share one keep-alive connection pool, and at most `concurrency`
+    of them are in flight at the same time.
+
+    async with AsyncWeatherClient() as client:
+        results = await client.fetch_many([('London', Service.open_weather), ...])
+    """
+
+    def __init__(self, concurrency=None, timeout=None):
+        self.concurrency = concurrency or WEATHER_API_CONCURRENCY
+        self.timeout = timeout or WEATHER_API_TIMEOUT
+        self.session = None
+        self.semaphore = None
+        self.resolved = {}
+        self.inflight = {}
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.concurrency, ttl_dns_cache=300)
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            raise_for_status=True,
+        )
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def get_json(self, url, service, token, max_wait=None):
+        """Waits for the quota of the service API key, then requests the url.
+        Raises RateLimited instead of waiting longer than `max_wait` seconds.
+        The outcome is reported to the circuit breaker of the service."""
+        bucket = get_bucket(service, token)
+        await asyncio.sleep(await off_loop(bucket, bucket.reserve, max_wait=max_wait))
+        breaker = get_breaker(service)
+        async with self.semaphore:
+            started = time.monotonic()
+            try:
+                async with self.session.get(url) as response:
+                    if response.status == 204:
+                        # WeatherBit answers an unknown city with an empty response
+                        raise CityNotFound(service)
+                    data = await response.json(content_type=None)
+            except Exception as e:
+                if is_provider_failure(e):
+                    await off_loop(breaker, breaker.record_failure)
+                raise
+        await off_loop(breaker, breaker.record_success, time.monotonic() - started)
+        return data
+
+    @staticmethod
+    async def cache_data(provider, list_of_data):
+        await off_loop(provider_cache, provider_cache.set, provider.service, provider.city, list_of_data,
+                       provider.units)
+
+    async def fetch_data(self, provider, token, max_wait=None) -> dict:
+        list_of_data = await self.get_json(provider.get_url(token), provider.service, token, max_wait)
+        await self.cache_data(provider, list_of_data)
+        return list_of_data
+
+    async def fetch(self, city_name, service) -> dict:
+        """Returns typed weather values for the city from the selected service.
+        Fresh responses also replace cached ones for the views."""
+        provider, token = get_provider(city_name, service)
+        return provider.get_reading_from_data(await self.fetch_data(provider, token))
+
+    async def get_reading(self, city_name, service, token=None) -> dict:
+        """Async BaseWeather.get_weather_reading for views: the cached response when there is one,
+        otherwise one request shared by all concurrent callers of the city in this event loop.
+        Raises ProviderUnavailable while the service circuit is open and RateLimited
+        if the quota would delay the request for more than WEATHER_RATE_LIMIT_MAX_WAIT seconds."""
+        provider, default_token = get_provider(city_name, service)
+        list_of_data = await off_loop(provider_cache, provider_cache.get, service, provider.city, provider.units)
+        if list_of_data is None:
+            key = provider_cache.key(service, provider.city, provider.units)
+            task = self.inflight.get(key)
+            if task is None:
+                breaker = get_breaker(service)
+                await off_loop(breaker, breaker.check)
+                # A concurrent caller may have started the request meanwhile
+                task = self.inflight.get(key)
+            if task is None:
+                task = asyncio.ensure_future(
+                    self.fetch_data(provider, token or default_token, WEATHER_RATE_LIMIT_MAX_WAIT))
+                self.inflight[key] = task
+                task.add_done_callback(lambda _: self.inflight.pop(key, None))
+            # A cancelled caller must not cancel the request of the others
+            list_of_data = await asyncio.shield(task)
+        return provider.get_reading_from_data(list_of_data)
+
+    async def get_city_reading(self, city_name, service) -> dict:
+        """Async fetch_city_weather: validates the city and returns its weather with one request.
+        Raises CityNotFound for a city the service doesn't know."""
+        exists = await sync_to_async(city_validation_cache.get)(service, city_name)
+        if exists is False:
+            raise CityNotFound(city_name)
+        try:
+            reading = await self.get_reading(city_name, service)
+        except CityNotFound as e:
+            await sync_to_async(city_validation_cache.set)(service, city_name, False)
+            raise CityNotFound(city_name) from e
+        except aiohttp.ClientResponseError as e:
+            if e.status in (204, 400, 404):
+                await sync_to_async(city_validation_cache.set)(service, city_name, False)
+                raise CityNotFound(city_name) from e
+            raise
+        if exists is None:
+            await sync_to_async(city_validation_cache.set)(service, city_name, True)
+        return reading
+
+    async def fetch_many(self, cities) -> dict:
+        """Fetches weather for every (city name, service) pair concurrently.
+        Returns dict {(city name, service): weather values or the raised exception}."""
+        cities = list(dict.fromkeys(cities))
+        results = await asyncio.gather(*(self.fetch(city_name, service) for city_name, service in cities),
+                                       return_exceptions=True)
+        return dict(zip(cities, results))
+
+    async def fetch_city(self, city, service) -> dict:
+        """One request for the City model, by its ids when the service supports them.
+        Ids found in the response are set on the model and the model is added to `resolved`."""
+        provider, token = get_provider(city.name, service)
+        list_of_data = await self.get_json(provider.get_city_url(city, token), service, token)
+        await self.cache_data(provider, list_of_data)
+        if resolve_city(city, provider.get_city_ids(list_of_data)):
+            self.resolved[city.pk] = city
+        return provider.get_reading_from_data(list_of_data)
+
+    async def fetch_group(self, service, cities) -> dict:
+        """One group request of the service for cities with known ids.
+        Returns dict {(city name, service): weather values or the exception}."""
+        provider, token = get_provider(None, service)
+        city_ids = [getattr(city, provider.group_id_field) for city in cities]
+        try:
+            list_of_data = await self.get_json(provider.get_group_url(city_ids, token), service, token)
+        except Exception as e:
+            return {(city.name, service): e for city in cities}
+        by_id = provider.get_group_data(list_of_data)
+        results = {}
+        for city, city_id in zip(cities, city_ids):
+            data = by_id.get(city_id)
+            if data is None:
+                results[city.name, service] = LookupError(f"{city.name} is missing in the group response")
+                continue
+            city_provider, _ = get_provider(city.name, service)
+            await self.cache_data(city_provider, data)
+            results[city.name, service] = city_provider.get_reading_from_data(data)
+        return results
+
+    async def fetch_cities(self, cities) -> dict:
+        """Fetches weather for (City model, service) pairs with the least requests:
+        cities with known ids of services that support group requests are packed
+        into groups of the service `group_size`, the rest is requested one by one.
+        All requests run concurrently.
+        Returns dict {(city name, service): weather values or the raised exception}."""
+        cities = list({(city.pk, service): (city, service) for city, service in cities}.values())
+        grouped = defaultdict(list)
+        single = []
+        for city, service in cities:
+            provider_class = providers[service]
+            if provider_class.supports_group and getattr(city, provider_class.group_id_field):
+                grouped[service].append(city)
+            else:
+                single.append((city, service))
+        groups = [(service, service_cities[i:i + providers[service].group_size])
+                  for service, service_cities in grouped.items()
+                  for i in range(0, len(service_cities), providers[service].group_size)]
+        group_results, single_results = await asyncio.gather(
+            asyncio.gather(*(self.fetch_group(service, group) for service, group in groups)),
+            asyncio.gather(*(self.fetch_city(city, service) for city, service in single), return_exceptions=True),
+        )
+        results = {(city.name, service): result for (city, service), result in zip(single, single_results)}
+        for group_result in group_results:
+            results.update(group_result)
+        return results
+
+    async def fan_out(self, city_name, services):
+        """Starts requests of the city to all services at once, skipping services with an
+        open circuit. Returns the readings cached for the city and {task: service} of the started requests."""
+        cached = {}
+        tasks = {}
+        for service in services:
+            provider, _ = get_provider(city_name, service)
+            list_of_data = await off_loop(provider_cache, provider_cache.get, service, provider.city, provider.units)
+            breaker = get_breaker(service)
+            if list_of_data is not None:
+                cached[service] = provider.get_reading_from_data(list_of_data)
+            elif not await off_loop(breaker, lambda: breaker.is_open):
+                tasks[asyncio.ensure_future(self.fetch(city_name, service))] = service
+        if not cached and not tasks:
+            raise ProviderUnavailable(f"None of {', '.join(services)} is available")
+        return cached, tasks
+
+    @staticmethod
+    async def cancel(tasks):
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def fetch_fastest(self, city_name, services) -> tuple:
+        """Requests the city from all services concurrently and returns the first successful
+        reading with [its service]; the slower requests are cancelled.
+        Raises the last error if every service fails."""
+        cached, tasks = await self.fan_out(city_name, services)
+        if cached:
+            await self.cancel(tasks)
+            service, reading = next(iter(cached.items()))
+            return reading, [service]
+        pending = set(tasks)
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result(), [tasks[task]]
+                    error = task.exception()
+        finally:
+            await self.cancel(pending)
+        raise error
+
+    async def fetch_consensus(self, city_name, services, budget) -> tuple:
+        """Requests the city from all services concurrently and merges the readings that arrive
+        within `budget` seconds; later requests are cancelled.
+        Returns the merged reading with the list of services that answered."""
+        cached, tasks = await self.fan_out(city_name, services)
+        readings = dict(cached)
+        errors = []
+        if tasks:
+            done, pending = await asyncio.wait(tasks, timeout=budget)
+            await self.cancel(pending)
+            for task in done:
+                if task.exception() is None:
+                    readings[tasks[task]] = task.result()
+                else:
+                    errors.append(task.exception())
+        if not readings:
+            raise errors[-1] if errors else asyncio.TimeoutError(f"No weather for {city_name} within {budget}s")
+        services = [service for service in services if service in readings]
+        return merge_readings(readings[service] for service in services), services
+
+
+view_clients = weakref.WeakKeyDictionary()
+
+
+async def get_view_client() -> AsyncWeatherClient:
+    """Client of the async views, one per event loop, so all provider calls in flight
+    in an ASGI process share one connection pool of WEATHER_ASYNC_VIEWS_CONCURRENCY connections"""
+    loop = asyncio.get_running_loop()
+    client = view_clients.get(loop)
+    if client is None:
+        client = view_clients[loop] = await AsyncWeatherClient(WEATHER_ASYNC_VIEWS_CONCURRENCY).__aenter__()
+    return client
+
+
+async def close_view_client():
+    client = view_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.__aexit__(None, None, None)
+
+
+def fetch_many(cities, concurrency=None, timeout=None) -> dict:
+    """Blocking wrapper around AsyncWeatherClient.fetch_many for celery tasks"""
+    async def run():
+        async with AsyncWeatherClient(concurrency, timeout) as client:
+            return await client.fetch_many(cities)
+    return asyncio.run(run())
+
+
+def fetch_cities(cities, concurrency=None, timeout=None):
+    """Blocking wrapper around AsyncWeatherClient.fetch_cities for celery tasks.
+    Returns the results and the list of City models whose ids were resolved on the way."""
+    async def run():
+        async with AsyncWeatherClient(concurrency, timeout) as client:
+            return await client.fetch_cities(cities), list(client.resolved.values())
+    return asyncio.run(run())
+
+
+def fetch_fanout(city_name, mode='fastest', services=None, budget=None, concurrency=None, timeout=None) -> tuple:
+    """Blocking fan-out fetch of the city from all `services` (WEATHER_PROVIDERS by default)
+    at once: the `fastest` reading or the `consensus` of readings within `budget` seconds.
+    Returns the reading with the list of services it came from."""
+    services = enabled_services(services)
+    budget = WEATHER_FANOUT_BUDGET if budget is None else budget
+
+    async def run():
+        async with AsyncWeatherClient(concurrency, timeout) as client:
+            if mode == 'consensus':
+                return await client.fetch_consensus(city_name, services, budget)
+            return await client.fetch_fastest(city_name, services)
+    return asyncio.run(run())
@@ -0,0 +1,41 @@
+"""Human readable weather for views and emails, from typed values stored in Weather"""
+from django.utils import timezone
+from django.utils.timesince import timesince
+
+from djangoweatherreminder.settings import WEATHER_STALE_AFTER
+
+READING_FIELDS = ('country_code', 'lat', 'lon', 'temp', 'pressure', 'humidity')
+
+
+def format_number(value) -> str:
+    """1019.0 -> '1019', 9.08 -> '9.08', None -> ''"""
+    if value is None:
+        return ''
+    value = float(value)
+    return str(int(value)) if value.is_integer() else str(value)
+
+
+def weather_reading(weather) -> dict:
+    """Typed values of a Weather row in the same dict the services' readings use"""
+    return {field: getattr(weather, field) for field in READING_FIELDS}
+
+
+def format_weather(reading) -> dict:
+    """Returns context dict in proper view from the typed reading"""
+    return {
+        "country_code": reading['country_code'],
+        "coordinate": f"{format_number(reading['lon'])} {format_number(reading['lat'])}".strip(),
+        "temp": f"{format_number(reading['temp'])}с" if reading['temp'] is not None else '',
+        "pressure": format_number(reading['pressure']),
+        "humidity": f"{format_number(reading['humidity'])}%" if reading['humidity'] is not None else '',
+    }
+
+
+def weather_age(updated_at, now=None) -> dict:
+    """Age of stored weather: {'updated_at': ..., 'age': '3\xa0hours', 'stale': True}"""
+    now = now or timezone.now()
+    return {
+        "updated_at": updated_at,
+        "age": timesince(updated_at, now) if updated_at else '',
+        "stale": updated_at is None or now - updated_at > WEATHER_STALE_AFTER,
+    }
@@ -33,7 +33,10 @@ class ChangeProfileForm(forms.ModelForm):
         attrs={'type': "text", 'id': "form3Example1cg", 'class': "form-control form-control-lg"}))
     email = forms.EmailField(label='Email', widget=forms.EmailInput(
         attrs={'type': "email", 'id': "form3Example3cg", 'class': "form-control form-control-lg"}))
+    digest_notifications = forms.BooleanField(label='One email for all cities due at the same time',
+                                              required=False,
+                                              widget=forms.CheckboxInput(attrs={'class': "form-check-input"}))
 
     class Meta:
         model = User
-        fields = ['username', 'email']
+        fields = ['username', 'email', 'digest_notifications']
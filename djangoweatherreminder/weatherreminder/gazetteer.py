@@ -0,0 +1,95 @@
+import csv
+import gzip
+import json
+from bisect import bisect_left
+from collections import namedtuple
+from functools import lru_cache
+
+from djangoweatherreminder.settings import GAZETTEER_PATH
+from weatherreminder.cache import normalize_city
+
+GazetteerCity = namedtuple('GazetteerCity', ['name', 'country', 'lat', 'lon', 'open_weather_id', 'weather_bit_id'])
+
+
+def optional_int(value):
+    return int(value) if value not in (None, '') else None
+
+
+def read_csv(file):
+    for row in csv.DictReader(file):
+        yield GazetteerCity(
+            name=row['name'],
+            country=row['country'],
+            lat=float(row['lat']),
+            lon=float(row['lon']),
+            open_weather_id=optional_int(row.get('open_weather_id')),
+            weather_bit_id=optional_int(row.get('weather_bit_id')),
+        )
+
+
+def read_open_weather_list(file):
+    """OpenWeatherMap's bulk city.list.json"""
+    for row in json.load(file):
+        yield GazetteerCity(
+            name=row['name'],
+            country=row['country'],
+            lat=row['coord']['lat'],
+            lon=row['coord']['lon'],
+            open_weather_id=row['id'],
+            weather_bit_id=None,
+        )
+
+
+class Gazetteer:
+    """Prefix index of known cities.
+    Normalized names are kept in one sorted list, so an exact lookup or a prefix
+    search is a binary search plus a scan of the matching names only."""
+
+    def __init__(self, cities):
+        rows = sorted(((normalize_city(city.name), city) for city in cities), key=lambda row: row[0])
+        self.keys = [key for key, _ in rows]
+        self.cities = [city for _, city in rows]
+
+    @classmethod
+    def load(cls, path):
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', encoding='utf-8') as file:
+            if '.json' in path:
+                return cls(read_open_weather_list(file))
+            return cls(read_csv(file))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, name):
+        key = normalize_city(name)
+        index = bisect_left(self.keys, key)
+        return index < len(self.keys) and self.keys[index] == key
+
+    def get(self, name) -> list:
+        """Returns all cities with the name, e.g. Paris, FR and Paris, US"""
+        key = normalize_city(name)
+        index = bisect_left(self.keys, key)
+        found = []
+        while index < len(self.keys) and self.keys[index] == key:
+            found.append(self.cities[index])
+            index += 1
+        return found
+
+    def search(self, prefix, limit=10) -> list:
+        """Returns first `limit` cities whose name starts with the prefix"""
+        prefix = normalize_city(prefix)
+        if not prefix:
+            return []
+        index = bisect_left(self.keys, prefix)
+        found = []
+        while index < len(self.keys) and len(found) < limit and self.keys[index].startswith(prefix):
+            found.append(self.cities[index])
+            index += 1
+        return found
+
+
+@lru_cache(maxsize=None)
+def get_gazetteer() -> Gazetteer:
+    """Gazetteer from GAZETTEER_PATH, loaded once per process"""
+    return Gazetteer.load(str(GAZETTEER_PATH))
@@ -0,0 +1,120 @@
+"""Weather history: append-only observations and their daily aggregates"""
+from datetime import datetime, time, timedelta, timezone as dt_timezone
+
+from django.db import transaction
+from django.db.models import Avg, Count, Max, Min
+from django.utils import timezone
+
+from djangoweatherreminder.settings import WEATHER_HISTORY_RAW_DAYS, WEATHER_HISTORY_DAILY_DAYS, \
+    WEATHER_HISTORY_INSERT_BATCH_SIZE, WEATHER_HISTORY_PRUNE_BATCH_SIZE
+from weatherreminder.models import WeatherObservation, WeatherDaily
+
+OBSERVED_FIELDS = ('temp', 'pressure', 'humidity')
+AVERAGED_FIELDS = ('temp_avg', 'pressure_avg', 'humidity_avg')
+
+
+def observation(city_id, service, reading, observed_at=None) -> WeatherObservation:
+    """Unsaved observation of the reading, to be inserted with `record_observations`"""
+    return WeatherObservation(city_id=city_id, service=service, observed_at=observed_at or timezone.now(),
+                              **{field: reading.get(field) for field in OBSERVED_FIELDS})
+
+
+def record_observations(observations, batch_size=None):
+    return WeatherObservation.objects.bulk_create(observations,
+                                                  batch_size=batch_size or WEATHER_HISTORY_INSERT_BATCH_SIZE)
+
+
+def day_bounds(day):
+    start = datetime.combine(day, time.min, tzinfo=dt_timezone.utc)
+    return start, start + timedelta(days=1)
+
+
+def weighted_average(first, first_samples, second, second_samples):
+    if first is None:
+        return second
+    if second is None:
+        return first
+    return (first * first_samples + second * second_samples) / (first_samples + second_samples)
+
+
+def combine(function, *values):
+    values = [value for value in values if value is not None]
+    return function(values) if values else None
+
+
+def merge_daily(daily, row):
+    """Adds the aggregated raw points to the already stored aggregate of the same day"""
+    daily.temp_min = combine(min, daily.temp_min, row['temp_min'])
+    daily.temp_max = combine(max, daily.temp_max, row['temp_max'])
+    for field in AVERAGED_FIELDS:
+        setattr(daily, field, weighted_average(getattr(daily, field), daily.samples, row[field], row['samples']))
+    daily.samples += row['samples']
+    return daily
+
+
+def delete_in_batches(queryset, batch_size=None) -> int:
+    """Deletes the rows by primary key chunks, so no single statement locks the whole range"""
+    batch_size = batch_size or WEATHER_HISTORY_PRUNE_BATCH_SIZE
+    deleted = 0
+    while True:
+        ids = list(queryset.order_by().values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        deleted += queryset.model.objects.filter(pk__in=ids).delete()[0]
+
+
+def downsample_batch(day, raw, batch_size) -> int:
+    """Rolls one batch of the raw observations into WeatherDaily and deletes it in the same transaction,
+    so a failure never leaves points both aggregated and stored. Returns the number of deleted observations."""
+    with transaction.atomic():
+        ids = list(raw.order_by().values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return 0
+        batch = WeatherObservation.objects.filter(pk__in=ids)
+        rows = batch.values('city_id', 'service').order_by().annotate(
+            temp_min=Min('temp'), temp_max=Max('temp'), temp_avg=Avg('temp'),
+            pressure_avg=Avg('pressure'), humidity_avg=Avg('humidity'), samples=Count('id'),
+        )
+        existing = {(daily.city_id, daily.service): daily
+                    for daily in WeatherDaily.objects.select_for_update().filter(date=day)}
+        created, updated = [], []
+        for row in rows:
+            daily = existing.get((row['city_id'], row['service']))
+            if daily is None:
+                created.append(WeatherDaily(date=day, **row))
+            else:
+                updated.append(merge_daily(daily, row))
+        WeatherDaily.objects.bulk_create(created)
+        WeatherDaily.objects.bulk_update(updated, ['temp_min', 'temp_max', *AVERAGED_FIELDS, 'samples'])
+        return batch.delete()[0]
+
+
+def downsample_day(day, batch_size=None) -> int:
+    """Rolls the raw observations of the UTC day into WeatherDaily and deletes them,
+    one transaction per batch. Returns the number of deleted observations."""
+    batch_size = batch_size or WEATHER_HISTORY_PRUNE_BATCH_SIZE
+    start, end = day_bounds(day)
+    raw = WeatherObservation.objects.filter(observed_at__gte=start, observed_at__lt=end)
+    deleted = 0
+    while True:
+        batch_deleted = downsample_batch(day, raw, batch_size)
+        if not batch_deleted:
+            return deleted
+        deleted += batch_deleted
+
+
+def downsample_history(now=None) -> dict:
+    """Downsamples whole days older than WEATHER_HISTORY_RAW_DAYS, one batch per transaction,
+    and prunes daily aggregates older than WEATHER_HISTORY_DAILY_DAYS"""
+    today = (now or timezone.now()).astimezone(dt_timezone.utc).date()
+    raw_cutoff = day_bounds(today - timedelta(days=WEATHER_HISTORY_RAW_DAYS))[0]
+    expired = WeatherObservation.objects.filter(observed_at__lt=raw_cutoff)
+    downsampled = 0
+    while True:
+        oldest = expired.aggregate(oldest=Min('observed_at'))['oldest']
+        if oldest is None:
+            break
+        downsampled += downsample_day(oldest.astimezone(dt_timezone.utc).date())
+    pruned = delete_in_batches(
+        WeatherDaily.objects.filter(date__lt=today - timedelta(days=WEATHER_HISTORY_DAILY_DAYS)))
+    return {'downsampled': downsampled, 'pruned': pruned}
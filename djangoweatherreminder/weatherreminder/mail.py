@@ -0,0 +1,69 @@
+import logging
+import smtplib
+import threading
+
+from django.core.mail import get_connection
+
+from djangoweatherreminder.settings import EMAIL_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+class PooledMailer:
+    """Sends emails over one long-lived connection of the EMAIL_BACKEND per process
+    instead of opening a new SMTP connection (and TLS handshake) for every email.
+    The connection is renewed after `batch_size` emails, since SMTP servers limit
+    messages per connection, and on any failure, in which case the email is sent once
+    again over the new connection. An email that fails again is logged and skipped,
+    so one bad address doesn't cost the rest of the batch.
+
+    Locally it works with the locmem/filebased backends or a debugging SMTP server:
+    `python -m aiosmtpd -n -l localhost:1025` with EMAIL_HOST='localhost', EMAIL_PORT=1025
+    and EMAIL_USE_TLS=False."""
+
+    errors = (smtplib.SMTPException, OSError)
+
+    def __init__(self, batch_size=EMAIL_BATCH_SIZE, backend=None):
+        self.batch_size = batch_size
+        self.backend = backend
+        self.connection = None
+        self.sent_over_connection = 0
+        self.lock = threading.Lock()
+
+    def open(self):
+        if self.connection is None or self.sent_over_connection >= self.batch_size:
+            self.close()
+            self.connection = get_connection(self.backend, fail_silently=False)
+            self.connection.open()
+        return self.connection
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except self.errors:
+                pass
+        self.connection = None
+        self.sent_over_connection = 0
+
+    def send_one(self, message):
+        try:
+            sent = self.open().send_messages([message])
+        except self.errors:
+            self.close()
+            try:
+                sent = self.open().send_messages([message])
+            except self.errors as e:
+                self.close()
+                logger.warning("Could not send %r to %s: %r", message.subject, ', '.join(message.to), e)
+                return 0
+        self.sent_over_connection += 1
+        return sent or 0
+
+    def send(self, messages) -> int:
+        """Sends the emails and returns how many of them were sent"""
+        with self.lock:
+            return sum(self.send_one(message) for message in messages)
+
+
+mailer = PooledMailer()
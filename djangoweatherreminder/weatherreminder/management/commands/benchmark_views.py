@@ -0,0 +1,102 @@
+import asyncio
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+from unittest.mock import patch
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand
+from django.test import AsyncRequestFactory, RequestFactory
+
+from djangoweatherreminder.settings import WEATHER_RATE_LIMITS
+from weatherreminder import async_views, views
+from weatherreminder.breaker import CircuitBreaker, breakers
+from weatherreminder.cache import provider_cache
+from weatherreminder.clients import close_view_client
+from weatherreminder.ratelimit import buckets
+from weatherreminder.stub_provider import StubProvider
+
+
+class Command(BaseCommand):
+    help = "Compares throughput of the sync and async home view against a local stub provider. " \
+           "The sync view runs in a pool of --threads threads, like a gunicorn deployment, " \
+           "the async one on a single event loop, like an ASGI worker."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help="Lookups per deployment")
+        parser.add_argument('--concurrency', type=int, default=100, help="Clients sending lookups at once")
+        parser.add_argument('--threads', type=int, default=8, help="Worker threads of the sync deployment")
+        parser.add_argument('--delay', type=float, default=0.2, help="Response time of the stub provider, seconds")
+        parser.add_argument('--cache-alias', default=None,
+                            help="CACHES alias for the provider cache, breakers and rate limits, "
+                                 "as shared by the processes of a deployment")
+
+    def handle(self, *args, **options):
+        runs = (('sync', self.run_sync), ('async', self.run_async))
+        cities = {f'{name} city {i}': {'country': 'XX', 'lat': i / 1000, 'lon': i / 1000, 'id': i}
+                  for name, _ in runs for i in range(options['requests'])}
+        limits = {service: {'per_minute': 10 ** 9, 'burst': 10 ** 9} for service in WEATHER_RATE_LIMITS}
+        alias = options['cache_alias']
+        with StubProvider(cities=cities, delay=options['delay']) as stub, \
+                patch('weatherreminder.utils.OPEN_WEATHER_API_URL', stub.open_weather_url), \
+                patch.dict(WEATHER_RATE_LIMITS, limits), \
+                patch.object(provider_cache, 'alias', alias), \
+                patch('weatherreminder.ratelimit.WEATHER_RATE_LIMIT_ALIAS', alias), \
+                patch.dict(breakers, {service: CircuitBreaker(service, alias=alias) for service in limits}):
+            for name, run in runs:
+                # Every lookup is a different city, also in a shared cache, so all of them reach the provider
+                provider_cache.clear()
+                buckets.clear()
+                stub.requests.clear()
+                started = time.monotonic()
+                latencies, errors = run([city for city in cities if city.startswith(f'{name} ')], options)
+                elapsed = time.monotonic() - started
+                self.report(name, latencies, errors, elapsed, len(stub.requests))
+
+    @staticmethod
+    def lookup_request(factory, city):
+        request = factory.post('/', urlencode({'city': city, 'token': 'benchmark'}),
+                               content_type='application/x-www-form-urlencoded')
+        request.user = AnonymousUser()
+        return request
+
+    def run_sync(self, cities, options):
+        factory = RequestFactory()
+
+        def lookup(city):
+            started = time.monotonic()
+            response = views.home(self.lookup_request(factory, city))
+            return time.monotonic() - started, b'Temperature' in response.content
+
+        with ThreadPoolExecutor(max_workers=min(options['threads'], options['concurrency'])) as pool:
+            results = list(pool.map(lookup, cities))
+        return [latency for latency, _ in results], sum(not ok for _, ok in results)
+
+    def run_async(self, cities, options):
+        factory = AsyncRequestFactory()
+
+        async def lookup(semaphore, city):
+            async with semaphore:
+                started = time.monotonic()
+                response = await async_views.home(self.lookup_request(factory, city))
+                return time.monotonic() - started, b'Temperature' in response.content
+
+        async def run():
+            semaphore = asyncio.Semaphore(options['concurrency'])
+            try:
+                return await asyncio.gather(*(lookup(semaphore, city) for city in cities))
+            finally:
+                await close_view_client()
+
+        results = asyncio.run(run())
+        return [latency for latency, _ in results], sum(not ok for _, ok in results)
+
+    def report(self, name, latencies, errors, elapsed, provider_calls):
+        latencies = sorted(latencies)
+        p95 = latencies[int(len(latencies) * 0.95) - 1] if latencies else 0
+        self.stdout.write(
+            f"{name:>5}: {len(latencies)} lookups in {elapsed:.2f}s, {len(latencies) / elapsed:.1f} req/s, "
+            f"p50 {statistics.median(latencies) * 1000:.0f} ms, p95 {p95 * 1000:.0f} ms, "
+            f"{provider_calls} provider calls, {errors} errors"
+        )
@@ -0,0 +1,34 @@
+# Generated by Django 4.1.7 on 2026-10-18 18:39
+
+from django.db import migrations, models
+from django.utils import timezone
+
+import weatherreminder.models
+
+
+def schedule_existing_subscriptions(apps, schema_editor):
+    """Moves existing subscriptions from per-subscription PeriodicTask rows to the dispatcher."""
+    Subscription = apps.get_model('weatherreminder', 'Subscription')
+    PeriodicTask = apps.get_model('django_celery_beat', 'PeriodicTask')
+    now = timezone.now()
+    for period in Subscription.objects.values_list('period_notifications', flat=True).distinct():
+        Subscription.objects.filter(period_notifications=period).update(
+            next_notification_at=weatherreminder.models.next_notification_time(period, now))
+    PeriodicTask.objects.filter(task='send_email_task').delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weatherreminder', '0006_alter_subscription_date_of_subscription'),
+        ('django_celery_beat', '0016_alter_crontabschedule_timezone'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscription',
+            name='next_notification_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.RunPython(schedule_existing_subscriptions, migrations.RunPython.noop),
+    ]
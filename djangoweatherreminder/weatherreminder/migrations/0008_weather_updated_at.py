@@ -0,0 +1,25 @@
+# Generated by Django 4.1.7 on 2026-10-18 18:40
+
+from django.db import migrations, models
+
+
+def delete_weather_periodic_tasks(apps, schema_editor):
+    """Weather is refreshed per (city, service) pair by refresh_weather_task now."""
+    PeriodicTask = apps.get_model('django_celery_beat', 'PeriodicTask')
+    PeriodicTask.objects.filter(task='get_weather_task').delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weatherreminder', '0007_subscription_next_notification_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='weather',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, null=True),
+        ),
+        migrations.RunPython(delete_weather_periodic_tasks, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.1.7 on 2026-10-18 18:45
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weatherreminder', '0008_weather_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CityValidation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, verbose_name='Normalized city name')),
+                ('service', models.TextField(choices=[('OpenWeatherMap', 'Open Weather'), ('WeatherBit', 'Weather Bit')])),
+                ('exists', models.BooleanField()),
+                ('checked_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='cityvalidation',
+            constraint=models.UniqueConstraint(fields=('name', 'service'), name='unique_city_validation'),
+        ),
+    ]
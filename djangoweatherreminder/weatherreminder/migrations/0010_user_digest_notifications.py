@@ -0,0 +1,18 @@
+# Generated by Django 4.1.7 on 2026-10-18 18:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weatherreminder', '0009_cityvalidation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='digest_notifications',
+            field=models.BooleanField(default=False, verbose_name='Digest notifications'),
+        ),
+    ]
@@ -0,0 +1,109 @@
+# Generated by Django 4.1.7 on 2026-10-18 18:53
+
+from django.db import migrations, models
+
+
+def parse_number(value, cast=float):
+    """'14.6с' -> 14.6, '21%' -> 21, '' -> None"""
+    value = (value or '').strip().rstrip('%сcС').strip()
+    try:
+        return cast(float(value))
+    except ValueError:
+        return None
+
+
+def convert_weather(apps, schema_editor):
+    """Parses the formatted strings stored before into the typed columns."""
+    Weather = apps.get_model('weatherreminder', 'Weather')
+    rows = list(Weather.objects.all())
+    for weather in rows:
+        coordinate = (weather.coordinate or '').split()
+        if len(coordinate) == 2:
+            weather.lon, weather.lat = (parse_number(value) for value in coordinate)
+        weather.temp_value = parse_number(weather.temp)
+        weather.pressure_value = parse_number(weather.pressure)
+        weather.humidity_value = parse_number(weather.humidity, int)
+    Weather.objects.bulk_update(
+        rows, ['lat', 'lon', 'temp_value', 'pressure_value', 'humidity_value'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weatherreminder', '0010_user_digest_notifications'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='weather',
+            name='lat',
+            field=models.FloatField(blank=True, null=True, verbose_name='Latitude'),
+        ),
+        migrations.AddField(
+            model_name='weather',
+            name='lon',
+            field=models.FloatField(blank=True, null=True, verbose_name='Longitude'),
+        ),
+        migrations.AddField(
+            model_name='weather',
+            name='temp_value',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='weather',
+            name='pressure_value',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='weather',
+            name='humidity_value',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(convert_weather, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='weather',
+            name='coordinate',
+        ),
+        migrations.RemoveField(
+            model_name='weather',
+            name='temp',
+        ),
+        migrations.RemoveField(
+            model_name='weather',
+            name='pressure',
+        ),
+        migrations.RemoveField(
+            model_name='weather',
+            name='humidity',
+        ),
+        migrations.RenameField(
+            model_name='weather',
+            old_name='temp_value',
+            new_name='temp',
+        ),
+        migrations.RenameField(
+            model_name='weather',
+            old_name='pressure_value',
+            new_name='pressure',
+        ),
+        migrations.RenameField(
+            model_name='weather',
+            old_name='humidity_value',
+            new_name='humidity',
+        ),
+        migrations.AlterField(
+            model_name='weather',
+            name='temp',
+            field=models.FloatField(blank=True, null=True, verbose_name='Temperature, °C'),
+        ),
+        migrations.AlterField(
+            model_name='weather',
+            name='pressure',
+            field=models.FloatField(blank=True, null=True, verbose_name='Pressure, hPa'),
+        ),
+        migrations.AlterField(
+            model_name='weather',
+            name='humidity',
+            field=models.PositiveSmallIntegerField(blank=True, null=True, verbose_name='Humidity, %'),
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 4.1.7 on 2026-10-18 18:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weatherreminder', '0011_typed_weather'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WeatherObservation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('service', models.TextField(choices=[('OpenWeatherMap', 'Open Weather'), ('WeatherBit', 'Weather Bit')])),
+                ('observed_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('temp', models.FloatField(blank=True, null=True, verbose_name='Temperature, °C')),
+                ('pressure', models.FloatField(blank=True, null=True, verbose_name='Pressure, hPa')),
+                ('humidity', models.PositiveSmallIntegerField(blank=True, null=True, verbose_name='Humidity, %')),
+                ('city', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='observations', to='weatherreminder.city')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='WeatherDaily',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('service', models.TextField(choices=[('OpenWeatherMap', 'Open Weather'), ('WeatherBit', 'Weather Bit')])),
+                ('date', models.DateField()),
+                ('temp_min', models.FloatField(blank=True, null=True)),
+                ('temp_max', models.FloatField(blank=True, null=True)),
+                ('temp_avg', models.FloatField(blank=True, null=True)),
+                ('pressure_avg', models.FloatField(blank=True, null=True)),
+                ('humidity_avg', models.FloatField(blank=True, null=True)),
+                ('samples', models.PositiveIntegerField(default=0)),
+                ('city', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_weather', to='weatherreminder.city')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='weatherobservation',
+            index=models.Index(fields=['city', 'service', 'observed_at'], name='observation_city_service_time'),
+        ),
+        migrations.AddIndex(
+            model_name='weatherobservation',
+            index=models.Index(fields=['observed_at'], name='observation_time'),
+        ),
+        migrations.AddIndex(
+            model_name='weatherdaily',
+            index=models.Index(fields=['date'], name='weather_daily_date'),
+        ),
+        migrations.AddConstraint(
+            model_name='weatherdaily',
+            constraint=models.UniqueConstraint(fields=('city', 'service', 'date'), name='unique_weather_daily'),
+        ),
+    ]
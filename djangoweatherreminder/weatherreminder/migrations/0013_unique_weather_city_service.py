@@ -0,0 +1,29 @@
+# Generated by Django 4.1.7 on 2026-10-18 19:01
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def remove_duplicate_weather(apps, schema_editor):
+    """Keeps only the latest Weather row of every (city, service) pair."""
+    Weather = apps.get_model('weatherreminder', 'Weather')
+    duplicates = Weather.objects.values('city_id', 'service').order_by() \
+        .annotate(latest=Max('pk'), rows=Count('pk')).filter(rows__gt=1)
+    for duplicate in duplicates:
+        Weather.objects.filter(city_id=duplicate['city_id'], service=duplicate['service']) \
+            .exclude(pk=duplicate['latest']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weatherreminder', '0012_weather_history'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_weather, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='weather',
+            constraint=models.UniqueConstraint(fields=('city', 'service'), name='unique_weather_city_service'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 4.1.7 on 2026-10-18 19:02
+
+from django.db import migrations, models
+import django.db.models.functions.text
+from django.db.models import Count, Max
+
+
+def remove_duplicate_subscriptions(apps, schema_editor):
+    """Keeps only the latest subscription of a user on the same city and service."""
+    Subscription = apps.get_model('weatherreminder', 'Subscription')
+    duplicates = Subscription.objects.values('user_id', 'city_id', 'service').order_by() \
+        .annotate(latest=Max('pk'), rows=Count('pk')).filter(rows__gt=1)
+    for duplicate in duplicates:
+        Subscription.objects.filter(user_id=duplicate['user_id'], city_id=duplicate['city_id'],
+                                    service=duplicate['service']).exclude(pk=duplicate['latest']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weatherreminder', '0013_unique_weather_city_service'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_subscriptions, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='city',
+            index=models.Index(django.db.models.functions.text.Upper('name'), name='city_upper_name'),
+        ),
+        migrations.AddIndex(
+            model_name='subscription',
+            index=models.Index(fields=['user', 'service'], name='subscription_user_service'),
+        ),
+        migrations.AddIndex(
+            model_name='subscription',
+            index=models.Index(fields=['city', 'service'], name='subscription_city_service'),
+        ),
+        migrations.AddIndex(
+            model_name='weather',
+            index=models.Index(fields=['city_name', 'service'], name='weather_city_name_service'),
+        ),
+        migrations.AddConstraint(
+            model_name='subscription',
+            constraint=models.UniqueConstraint(fields=('user', 'city', 'service'), name='unique_subscription'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.1.7 on 2026-10-18 19:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weatherreminder', '0014_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='city',
+            name='lat',
+            field=models.FloatField(blank=True, null=True, verbose_name='Latitude'),
+        ),
+        migrations.AddField(
+            model_name='city',
+            name='lon',
+            field=models.FloatField(blank=True, null=True, verbose_name='Longitude'),
+        ),
+        migrations.AddField(
+            model_name='city',
+            name='open_weather_id',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='OpenWeatherMap city id'),
+        ),
+    ]
@@ -1,13 +1,15 @@
 import json
 import sys
 import zoneinfo
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import pytz
 from django.utils import timezone
 from django.contrib.auth.models import AbstractUser
 from django.db import models
-from django_celery_beat.models import  PeriodicTask, CrontabSchedule
+from django.db.models.functions import Upper
+
+from weatherreminder.schedule_events import schedule_events
 
 
 class Service(models.TextChoices):
@@ -17,6 +19,7 @@ class Service(models.TextChoices):
 
 class User(AbstractUser):
     username = models.CharField(max_length=50, verbose_name="User name", unique=True)
+    digest_notifications = models.BooleanField(default=False, verbose_name="Digest notifications")
 
     def __str__(self):
         return self.username
@@ -28,15 +31,39 @@ class User(AbstractUser):
 class City(models.Model):
     name = models.CharField(max_length=100, verbose_name="City", unique=True)
     users = models.ManyToManyField(User, through='Subscription', related_name='city_subscriptions')
+    # Resolved from the first service response, so later requests don't depend on the name
+    open_weather_id = models.PositiveIntegerField(verbose_name="OpenWeatherMap city id", null=True, blank=True)
+    lat = models.FloatField(verbose_name="Latitude", null=True, blank=True)
+    lon = models.FloatField(verbose_name="Longitude", null=True, blank=True)
 
     def __str__(self):
         return f'{self.name}'
 
+    class Meta:
+        indexes = [
+            # name__iexact lookups compare UPPER(name) and can't use the unique index on name
+            models.Index(Upper('name'), name='city_upper_name'),
+        ]
+
 def current_time():
     s = timezone.datetime.now()
     a = timezone.make_aware(s, pytz.timezone('UTC'))
     return a
 
+
+NOTIFICATIONS_TIMEZONE = zoneinfo.ZoneInfo('Europe/Kiev')
+
+
+def next_notification_time(period, after=None):
+    """Returns the first full hour after `after` whose local hour is a multiple of `period`,
+    the same moments the old `minute=0, hour=*/period` crontab used to fire at."""
+    after = after or timezone.now()
+    candidate = after.astimezone(pytz.utc).replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+    while candidate.astimezone(NOTIFICATIONS_TIMEZONE).hour % int(period) != 0:
+        candidate += timedelta(hours=1)
+    return candidate
+
+
 class Subscription(models.Model):
     class Period(models.IntegerChoices):
         ONE = 1
@@ -50,6 +77,16 @@ class Subscription(models.Model):
     period_notifications = models.IntegerField(choices=Period.choices)
     date_of_subscription = models.DateTimeField(default=current_time)
     service = models.TextField(choices=Service.choices)
+    next_notification_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'city', 'service'], name='unique_subscription'),
+        ]
+        indexes = [
+            models.Index(fields=['user', 'service'], name='subscription_user_service'),
+            models.Index(fields=['city', 'service'], name='subscription_city_service'),
+        ]
 
     def __str__(self):
         # return f"{self.pk}"
@@ -62,113 +99,94 @@ class Weather(models.Model):
     city_name = models.CharField(max_length=100, verbose_name="City name", blank=True)
     service = models.TextField(choices=Service.choices)
     country_code = models.CharField(max_length=100, verbose_name="Country code", blank=True)
-    coordinate = models.CharField(max_length=100, verbose_name="Coordinate", blank=True)
-    temp = models.CharField(max_length=100, verbose_name="Temperature", blank=True)
-    pressure = models.CharField(max_length=100, verbose_name="Pressure", blank=True)
-    humidity = models.CharField(max_length=100, verbose_name="Humidity", blank=True)
+    lat = models.FloatField(verbose_name="Latitude", null=True, blank=True)
+    lon = models.FloatField(verbose_name="Longitude", null=True, blank=True)
+    temp = models.FloatField(verbose_name="Temperature, °C", null=True, blank=True)
+    pressure = models.FloatField(verbose_name="Pressure, hPa", null=True, blank=True)
+    humidity = models.PositiveSmallIntegerField(verbose_name="Humidity, %", null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True, null=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['city', 'service'], name='unique_weather_city_service'),
+        ]
+        indexes = [
+            models.Index(fields=['city_name', 'service'], name='weather_city_name_service'),
+        ]
+
+
+class WeatherObservation(models.Model):
+    """Append-only history of the weather fetched by the refresh job.
+    Raw points are rolled into WeatherDaily and pruned by `downsample_weather_history_task`."""
+    city = models.ForeignKey(City, on_delete=models.CASCADE, related_name='observations')
+    service = models.TextField(choices=Service.choices)
+    observed_at = models.DateTimeField(default=timezone.now)
+    temp = models.FloatField(verbose_name="Temperature, °C", null=True, blank=True)
+    pressure = models.FloatField(verbose_name="Pressure, hPa", null=True, blank=True)
+    humidity = models.PositiveSmallIntegerField(verbose_name="Humidity, %", null=True, blank=True)
 
-class SubscriptionTask:
-    def __init__(self, subscription):
-        self.subscription = subscription
+    class Meta:
+        indexes = [
+            models.Index(fields=['city', 'service', 'observed_at'], name='observation_city_service_time'),
+            models.Index(fields=['observed_at'], name='observation_time'),
+        ]
 
-    def create_task(self):
-        schedule, _ = CrontabSchedule.objects.get_or_create(
-        minute='0',
-        hour='*/'+str(self.subscription.period_notifications) if str(self.subscription.period_notifications) != '1' else '*',
-        day_of_week='*',
-        day_of_month='*',
-        month_of_year='*',
-        timezone=zoneinfo.ZoneInfo('Europe/Kiev')
-    )
-        task = PeriodicTask.objects.filter(
-            name=f'Send email with {self.subscription.service} with {self.subscription.city} to {self.subscription.user.email}').first()
-        if task is not None:
-            return
-        task = PeriodicTask.objects.create(
-            name=f'Send email with {self.subscription.service} with {self.subscription.city} to {self.subscription.user.email}',
-            task='send_email_task',
-            crontab=schedule,
-            args=json.dumps([self.subscription.id]),
-            start_time=timezone.now()
-        )
-        task.save()
-        return
 
-    def edit_task(self):
-        task = PeriodicTask.objects.filter(name=f'Send email with {self.subscription.service} with {self.subscription.city} to {self.subscription.user.email}').first()
-
-        schedule, _ = CrontabSchedule.objects.get_or_create(
-            minute='0',
-            hour='*/'+str(self.subscription.period_notifications) if str(self.subscription.period_notifications) != '1' else '*',
-            day_of_week='*',
-            day_of_month='*',
-            month_of_year='*',
-            timezone=zoneinfo.ZoneInfo('Europe/Kiev')
-        )
-        if task:
-            task.crontab = schedule
-            task.save()
-        return
+class WeatherDaily(models.Model):
+    """Daily aggregate of WeatherObservation points for one (city, service) pair"""
+    city = models.ForeignKey(City, on_delete=models.CASCADE, related_name='daily_weather')
+    service = models.TextField(choices=Service.choices)
+    date = models.DateField()
+    temp_min = models.FloatField(null=True, blank=True)
+    temp_max = models.FloatField(null=True, blank=True)
+    temp_avg = models.FloatField(null=True, blank=True)
+    pressure_avg = models.FloatField(null=True, blank=True)
+    humidity_avg = models.FloatField(null=True, blank=True)
+    samples = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['city', 'service', 'date'], name='unique_weather_daily'),
+        ]
+        indexes = [
+            models.Index(fields=['date'], name='weather_daily_date'),
+        ]
 
-    def delete_task(self):
-        task = PeriodicTask.objects.filter(name=f'Send email with {self.subscription.service} with {self.subscription.city} to {self.subscription.user.email}').first()
-        if task is not None:
-            task.delete()
-        return
 
+class CityValidation(models.Model):
+    """Persistent result of checking a city name with the service"""
+    name = models.CharField(max_length=100, verbose_name="Normalized city name")
+    service = models.TextField(choices=Service.choices)
+    exists = models.BooleanField()
+    checked_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['name', 'service'], name='unique_city_validation'),
+        ]
 
-class WeatherTask:
+    def __str__(self):
+        return f'{self.name} {"exists" if self.exists else "does not exist"} on {self.service}'
+
+
+class SubscriptionTask:
+    """Schedules subscription notifications for `dispatch_notifications_task`.
+    Instead of a PeriodicTask per subscription, every subscription keeps its own
+    `next_notification_at` and the dispatcher picks up the due ones."""
     def __init__(self, subscription):
         self.subscription = subscription
 
     def create_task(self):
-        """It is necessary to check if there is no another task doing the same
-        and only then create new task"""
-        task = PeriodicTask.objects.filter(
-            name=f'Update weather for city {self.subscription.city.name} and service {self.subscription.service} every hour in database').first()
-        if task is not None:
+        if self.subscription.next_notification_at is not None:
             return
-        schedule, _ = CrontabSchedule.objects.get_or_create(
-            minute='0',
-            hour='*',
-            day_of_week='*',
-            day_of_month='*',
-            month_of_year='*',
-            timezone=zoneinfo.ZoneInfo('Europe/Kiev')
-        )
-        task = PeriodicTask.objects.create(
-            name=f'Update weather for city {self.subscription.city.name} and service {self.subscription.service} every hour in database',
-            task='get_weather_task',
-            crontab=schedule,
-            args=json.dumps([self.subscription.id]),
-            start_time=timezone.now()
-        )
-        task.save()
-        return
+        self.edit_task()
 
-    def delete_subscription_weather_task(self):
-        """Use in subscription "delete" apiView.
-        In subscription apiView we need to check that this is a last subscription left on city
-        with selected service and only then delete task."""
-
-        city = City.objects.get(pk=self.subscription.city.id)
-        subscriptions = Subscription.objects.filter(city=city, service=self.subscription.service)
-        if len(subscriptions) == 1:
-            task = PeriodicTask.objects.filter(
-                name=f'Update weather for city {city.name} and service {self.subscription.service} every hour in database').first()
-            if task is not None:
-                task.delete()
-        return
-
-    def delete_city_weather_task(self):
-        """Use in city "delete" apiView.
-        In city apiView because of two services we need to check
-        every subscription in delete cycle
-        so it should avoid error if there is no such task."""
-        task = PeriodicTask.objects.filter(
-            name=f'Update weather for city {self.subscription.city.name} and service {self.subscription.service} every hour in database').first()
-        if task is not None:
-            task.delete()
+    def edit_task(self):
+        self.subscription.next_notification_at = next_notification_time(self.subscription.period_notifications)
+        self.subscription.save(update_fields=['next_notification_at'])
+        schedule_events.publish([(self.subscription.pk, self.subscription.next_notification_at)])
         return
 
+    def delete_task(self):
+        """Unschedules the subscription, call it before the subscription is deleted"""
+        schedule_events.publish([(self.subscription.pk, None)])
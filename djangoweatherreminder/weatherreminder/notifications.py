@@ -0,0 +1,99 @@
+from functools import lru_cache
+
+from django.core.mail import EmailMultiAlternatives
+from django.template.loader import get_template
+from django.utils.html import escape
+
+from djangoweatherreminder.settings import WEATHER_CACHE_MAXSIZE, WEATHER_CACHE_TTL
+from weatherreminder.cache import TTLCache
+from weatherreminder.formatting import format_weather, weather_age, weather_reading
+from weatherreminder.mail import mailer
+from weatherreminder.utils import CityName
+
+SUBJECT = "Weather notification"
+FROM_EMAIL = "rollbar1990@gmail.com"
+
+# Per-recipient fields are rendered as these markers and spliced in afterwards
+EMAIL_MARKER = 'RECIPIENTEMAILMARKER'
+PERIOD_MARKER = 'RECIPIENTPERIODMARKER'
+
+
+@lru_cache(maxsize=None)
+def message_template():
+    """Notification template, compiled once per process"""
+    return get_template("weatherreminder/message.html")
+
+
+def render_message(name, email, content) -> str:
+    return message_template().render({'name': name, 'email': email, 'content': content})
+
+
+def create_message(email, body):
+    """Email with the same body as text and html, like the notifications always had"""
+    msg = EmailMultiAlternatives(SUBJECT, body, FROM_EMAIL, to=[email])
+    msg.attach_alternative(body, 'text/html')
+    return msg
+
+
+def send_message(name, email, content):
+    mailer.send([create_message(email, render_message(name, email, content))])
+
+
+class NotificationRenderer:
+    """Renders notification emails. The template is rendered once per (city, service)
+    weather refresh; every recipient only costs substitution of their own fields."""
+
+    def __init__(self, maxsize=WEATHER_CACHE_MAXSIZE, ttl=WEATHER_CACHE_TTL):
+        self.bodies = TTLCache(maxsize, ttl)
+        self.contents = TTLCache(maxsize, ttl)
+
+    @staticmethod
+    def weather_key(weather):
+        return weather.pk, weather.updated_at, weather_age(weather.updated_at)['stale']
+
+    def weather_content(self, weather) -> str:
+        key = self.weather_key(weather)
+        content = self.contents.get(key)
+        if content is None:
+            formatted = format_weather(weather_reading(weather))
+            content = f"<p>Period of notifications : every {PERIOD_MARKER} hours</p><hr>" \
+                      f"Service: {weather.service}<hr>" \
+                      f"Country code: {formatted['country_code']}<hr>" \
+                      f"Coordinate: {formatted['coordinate']}<hr>" \
+                      f"Temperature: {formatted['temp']}<hr>" \
+                      f"Pressure: {formatted['pressure']}<hr>" \
+                      f"Humidity: {formatted['humidity']}<hr>"
+            if key[2] and weather.updated_at:
+                # The service was unavailable since then, say how old the weather is
+                content += f"Last updated: {weather.updated_at:%Y-%m-%d %H:%M} UTC<hr>"
+            self.contents.set(key, content)
+        return content
+
+    def weather_body(self, city, weather) -> str:
+        key = self.weather_key(weather)
+        body = self.bodies.get(key)
+        if body is None:
+            body = render_message(CityName(city.name).view(), EMAIL_MARKER, self.weather_content(weather))
+            self.bodies.set(key, body)
+        return body
+
+    def render(self, subscription, weather) -> str:
+        body = self.weather_body(subscription.city, weather)
+        return body.replace(EMAIL_MARKER, escape(subscription.user.email)) \
+            .replace(PERIOD_MARKER, str(int(subscription.period_notifications)))
+
+    def message(self, subscription, weather):
+        return create_message(subscription.user.email, self.render(subscription, weather))
+
+    def digest(self, user, subscriptions) -> str:
+        """One email with weather of all the (subscription, weather) pairs of the user"""
+        names = [CityName(subscription.city.name).view() for subscription, _ in subscriptions]
+        content = ''.join(
+            f"<h3>{escape(name)}</h3>" +
+            self.weather_content(weather).replace(PERIOD_MARKER, str(int(subscription.period_notifications)))
+            for name, (subscription, weather) in zip(names, subscriptions)
+        )
+        return create_message(user.email, render_message(', '.join(dict.fromkeys(names)), user.email, content))
+
+
+renderer = NotificationRenderer()
@@ -0,0 +1,33 @@
+from collections import OrderedDict
+
+from rest_framework.pagination import CursorPagination
+from rest_framework.response import Response
+
+from djangoweatherreminder.settings import API_PAGE_SIZE, API_MAX_PAGE_SIZE
+
+
+class PrimaryKeyCursorPagination(CursorPagination):
+    """Keyset pagination by primary key: every page is one indexed `WHERE id > cursor LIMIT n`
+    query, so the cost of a page doesn't grow with the table or with the page number.
+    The page is returned under `results_key` to keep the existing response shape."""
+    ordering = 'pk'
+    page_size = API_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = API_MAX_PAGE_SIZE
+
+    def __init__(self, results_key='results'):
+        self.results_key = results_key
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            (self.results_key, data),
+        ]))
+
+
+def paginated_response(request, view, queryset, serializer_class, results_key):
+    """Serializes one page of the queryset, the rest is reachable through the `next` link"""
+    paginator = PrimaryKeyCursorPagination(results_key)
+    page = paginator.paginate_queryset(queryset, request, view=view)
+    return paginator.get_paginated_response(serializer_class(page, many=True).data)
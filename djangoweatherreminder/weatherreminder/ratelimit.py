@@ -0,0 +1,114 @@
+import hashlib
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.core.cache import caches
+
+from djangoweatherreminder.settings import WEATHER_RATE_LIMITS, WEATHER_RATE_LIMIT_ALIAS, \
+    WEATHER_RATE_LIMIT_MAX_WAIT, WEATHER_RATE_LIMIT_DEFAULT
+
+
+class RateLimited(Exception):
+    """The call would have to wait longer than allowed for the provider quota"""
+
+    def __init__(self, wait):
+        super().__init__(f"Provider quota is exhausted for the next {wait:.1f} seconds")
+        self.wait = wait
+
+
+class TokenBucket:
+    """Token bucket of `rate` calls per second with bursts of up to `burst` calls.
+    The state is a single "theoretical arrival time" (GCRA), so every call either fits
+    in the bucket or reserves the moment it may be sent, and bursts are smoothed to the
+    allowed rate instead of being rejected by the provider.
+
+    With `alias` from CACHES the state is shared by all web and celery processes and
+    updated under a short `cache.add` lock, otherwise it lives in the process memory."""
+    lock_timeout = 5  # seconds a crashed holder can keep the shared lock
+
+    def __init__(self, name, rate, burst=1, alias=None, timer=time.time):
+        self.name = name
+        self.interval = 1 / rate
+        self.burst = burst
+        self.alias = alias
+        self.timer = timer
+        self.tat = 0
+        self.lock = threading.Lock()
+
+    @property
+    def shared(self):
+        return caches[self.alias] if self.alias else None
+
+    @property
+    def key(self):
+        return f'ratelimit:{self.name}'
+
+    @contextmanager
+    def locked(self):
+        if self.shared is None:
+            with self.lock:
+                yield
+            return
+        lock_key, token = f'{self.key}:lock', uuid.uuid4().hex
+        deadline = time.monotonic() + self.lock_timeout
+        while not self.shared.add(lock_key, token, self.lock_timeout):
+            if time.monotonic() > deadline:
+                break
+            time.sleep(0.005)
+        try:
+            yield
+        finally:
+            if self.shared.get(lock_key) == token:
+                self.shared.delete(lock_key)
+
+    def load(self):
+        return self.tat if self.shared is None else self.shared.get(self.key, 0)
+
+    def store(self, tat):
+        if self.shared is None:
+            self.tat = tat
+        else:
+            self.shared.set(self.key, tat, max(int(tat - self.timer()) + 1, 1))
+
+    def reserve(self, tokens=1, max_wait=None) -> float:
+        """Takes `tokens` from the bucket and returns the seconds to wait before the call.
+        Raises RateLimited and takes nothing if the wait would be longer than `max_wait`."""
+        with self.locked():
+            now = self.timer()
+            tat = max(self.load(), now) + tokens * self.interval
+            wait = max(tat - now - self.burst * self.interval, 0)
+            if max_wait is not None and wait > max_wait:
+                raise RateLimited(wait)
+            self.store(tat)
+        return wait
+
+    def acquire(self, tokens=1, max_wait=None):
+        """Blocks until the call is allowed"""
+        wait = self.reserve(tokens, max_wait)
+        if wait:
+            time.sleep(wait)
+
+
+buckets = {}
+buckets_lock = threading.Lock()
+
+
+def get_bucket(service, token) -> TokenBucket:
+    """Bucket of the API key with the limits of the key from WEATHER_RATE_LIMITS,
+    of the service if the key has none, or WEATHER_RATE_LIMIT_DEFAULT.
+    Every key has its own bucket, shared by all callers using the same key."""
+    name = f'{service}:{hashlib.sha256(str(token).encode()).hexdigest()[:16]}'
+    with buckets_lock:
+        if name not in buckets:
+            limits = WEATHER_RATE_LIMITS.get(str(token)) or WEATHER_RATE_LIMITS.get(service) \
+                or WEATHER_RATE_LIMIT_DEFAULT
+            buckets[name] = TokenBucket(name, limits['per_minute'] / 60, limits['burst'], WEATHER_RATE_LIMIT_ALIAS)
+        return buckets[name]
+
+
+def throttle(service, token):
+    """Waits for a free slot of the service quota before a blocking provider call,
+    at most WEATHER_RATE_LIMIT_MAX_WAIT seconds"""
+    get_bucket(service, token).acquire(max_wait=WEATHER_RATE_LIMIT_MAX_WAIT)
@@ -0,0 +1,88 @@
+import threading
+from collections import OrderedDict
+
+from django.core.cache import caches
+from django.db import transaction
+
+from djangoweatherreminder.settings import NOTIFICATION_EVENTS_ALIAS, NOTIFICATION_EVENTS_TTL, \
+    NOTIFICATION_EVENTS_MAXSIZE
+
+
+class ScheduleEvents:
+    """Log of changes of subscription due times, applied incrementally by HeapScheduler.
+    Writers publish batches of (subscription id, due time or None for a deleted subscription),
+    numbered by a counter; the scheduler reads the batches after the last number it has seen.
+    A batch is appended when the transaction of the change commits, so beat never sees
+    a due time that was rolled back.
+    The log lives in the `alias` cache shared with celery beat, or in the memory of the process,
+    where only the last `maxsize` batches are kept."""
+    prefix = 'schedule-events'
+
+    def __init__(self, alias=NOTIFICATION_EVENTS_ALIAS, ttl=NOTIFICATION_EVENTS_TTL,
+                 maxsize=NOTIFICATION_EVENTS_MAXSIZE):
+        self.alias = alias
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.local = OrderedDict()
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    @property
+    def shared(self):
+        return caches[self.alias] if self.alias else None
+
+    def key(self, number):
+        return f'{self.prefix}:{number}'
+
+    def publish(self, changes):
+        """Appends one batch of (subscription id, due datetime or None) changes
+        once the current transaction commits, or right away outside of transactions"""
+        changes = [(pk, due.timestamp() if due is not None else None) for pk, due in changes]
+        if changes:
+            transaction.on_commit(lambda: self.append(changes))
+
+    def append(self, changes):
+        if self.shared is None:
+            with self.lock:
+                self.counter += 1
+                self.local[self.key(self.counter)] = changes
+                while len(self.local) > self.maxsize:
+                    self.local.popitem(last=False)
+            return
+        self.shared.add(self.key('counter'), 0, None)
+        self.shared.set(self.key(self.shared.incr(self.key('counter'))), changes, self.ttl)
+
+    def last(self) -> int:
+        """Number of the last published batch"""
+        if self.shared is None:
+            return self.counter
+        return self.shared.get(self.key('counter'), 0)
+
+    def read(self, cursor):
+        """Returns the changes published after the `cursor` batch and the new cursor.
+        Reading stops at a batch that is missing: a writer may have taken its number
+        and not stored it yet. The cursor is None if the log was reset or its batches have expired."""
+        last = self.last()
+        if last < cursor:
+            return [], None
+        numbers = range(cursor + 1, last + 1)
+        if self.shared is None:
+            batches = {self.key(number): self.local.get(self.key(number)) for number in numbers}
+        else:
+            batches = self.shared.get_many([self.key(number) for number in numbers])
+        changes = []
+        for number in numbers:
+            batch = batches.get(self.key(number))
+            if batch is None:
+                break
+            changes.extend(batch)
+            cursor = number
+        return changes, cursor
+
+    def clear(self):
+        with self.lock:
+            self.local.clear()
+            self.counter = 0
+
+
+schedule_events = ScheduleEvents()
@@ -0,0 +1,122 @@
+import heapq
+import logging
+import time
+
+from celery.beat import PersistentScheduler
+
+from djangoweatherreminder.settings import NOTIFICATION_EVENTS_POLL, NOTIFICATION_EVENTS_GAP_TIMEOUT
+from weatherreminder.models import Subscription
+from weatherreminder.schedule_events import schedule_events
+
+logger = logging.getLogger(__name__)
+
+
+class DueHeap:
+    """Min-heap of due timestamps by key with O(log n) set, remove and pop.
+    A changed or removed key leaves its old heap entry behind; such entries are skipped
+    when they reach the top instead of being searched for, and the heap is rebuilt
+    once they make up most of it."""
+
+    def __init__(self, items=()):
+        self.due = dict(items)
+        self.rebuild()
+
+    def rebuild(self):
+        self.heap = [(due, key) for key, due in self.due.items()]
+        heapq.heapify(self.heap)
+
+    def set(self, key, due):
+        if self.due.get(key) == due:
+            return
+        self.due[key] = due
+        heapq.heappush(self.heap, (due, key))
+        if len(self.heap) > 2 * len(self.due) + 1024:
+            self.rebuild()
+
+    def remove(self, key):
+        self.due.pop(key, None)
+
+    def peek(self):
+        """Returns the earliest due timestamp or None"""
+        while self.heap and self.due.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now) -> list:
+        """Removes and returns the keys due at `now`"""
+        keys = []
+        while (due := self.peek()) is not None and due <= now:
+            _, key = heapq.heappop(self.heap)
+            del self.due[key]
+            keys.append(key)
+        return keys
+
+    def __len__(self):
+        return len(self.due)
+
+
+class HeapScheduler(PersistentScheduler):
+    """Celery beat scheduler that sends `dispatch_notifications_task` right when the first
+    subscription is due, instead of waiting for the next NOTIFICATION_DISPATCH_INTERVAL.
+    Due times are loaded once into an in-memory heap and kept current by the changes
+    published to `schedule_events`, so subscription churn costs O(log n) per change
+    and no reload of the schedule. CELERY_BEAT_SCHEDULE entries run as with the default scheduler.
+
+    celery -A djangoweatherreminder beat -S weatherreminder.scheduler:HeapScheduler
+    """
+    dispatch_task = 'dispatch_notifications_task'
+
+    def __init__(self, *args, events=schedule_events, **kwargs):
+        self.events = events
+        self.due = DueHeap()
+        self.cursor = 0
+        self.gap_since = None
+        super().__init__(*args, **kwargs)
+        self.max_interval = min(self.max_interval, NOTIFICATION_EVENTS_POLL)
+
+    def setup_schedule(self):
+        super().setup_schedule()
+        if self.events.alias is None:
+            logger.warning("NOTIFICATION_EVENTS_ALIAS is not set: due time changes of other processes "
+                           "don't reach beat, notifications rely on the dispatcher interval")
+        self.load_due()
+
+    def load_due(self):
+        """Full load of due times: at start and only when published changes were lost"""
+        self.cursor = self.events.last()
+        self.gap_since = None
+        self.due = DueHeap(
+            (pk, due.timestamp()) for pk, due in
+            Subscription.objects.filter(next_notification_at__isnull=False)
+            .values_list('pk', 'next_notification_at').iterator()
+        )
+
+    def apply_events(self):
+        changes, cursor = self.events.read(self.cursor)
+        if cursor is None:
+            return self.load_due()
+        for pk, due in changes:
+            if due is None:
+                self.due.remove(pk)
+            else:
+                self.due.set(pk, due)
+        if cursor != self.cursor or cursor == self.events.last():
+            self.gap_since = None
+        elif self.gap_since is None:
+            self.gap_since = time.monotonic()
+        elif time.monotonic() - self.gap_since > NOTIFICATION_EVENTS_GAP_TIMEOUT:
+            # The missing batch has expired or its writer has failed
+            return self.load_due()
+        self.cursor = cursor
+
+    def tick(self, *args, **kwargs):
+        self.apply_events()
+        now = time.time()
+        if self.due.pop_due(now):
+            # The dispatcher picks all due rows; the new due times come back as events
+            self.send_task(self.dispatch_task)
+        wait = super().tick(*args, **kwargs)
+        next_due = self.due.peek()
+        if next_due is not None:
+            wait = min(wait, max(next_due - now, 0))
+        return wait
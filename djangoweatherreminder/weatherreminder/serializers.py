@@ -1,10 +1,14 @@
 from datetime import datetime
 
 import environ
-from rest_framework import serializers, status
-
-from djangoweatherreminder.settings import OPEN_WEATHER_API_URL
-from weatherreminder.models import Subscription, City, Service, User
+from rest_framework import exceptions, serializers, status
+
+from djangoweatherreminder.settings import OPEN_WEATHER_API_URL, SUBSCRIPTIONS_BULK_MAX_OPERATIONS
+from weatherreminder.breaker import ProviderUnavailable
+from weatherreminder.models import Subscription, City, Service, User, next_notification_time
+from weatherreminder.gazetteer import get_gazetteer
+from weatherreminder.schedule_events import schedule_events
+from weatherreminder.ratelimit import RateLimited
 from weatherreminder.utils import CityName, CheckCity
 import pytz
 
@@ -39,6 +43,109 @@ class SubscriptionSerializer(serializers.Serializer):
 
 
 
+class SubscriptionOperationSerializer(serializers.Serializer):
+    """One operation of the bulk subscriptions request"""
+    REQUIRED_FIELDS = {
+        'create': ('city', 'service', 'period_notifications'),
+        'update': ('id', 'period_notifications'),
+        'delete': ('id',),
+    }
+
+    op = serializers.ChoiceField(choices=list(REQUIRED_FIELDS))
+    id = serializers.IntegerField(required=False)
+    city = serializers.IntegerField(required=False)
+    service = serializers.ChoiceField(choices=Service.choices, required=False)
+    period_notifications = serializers.ChoiceField(choices=Subscription.Period.choices, required=False)
+
+    def validate(self, attrs):
+        missing = {field: ["This field is required."]
+                   for field in self.REQUIRED_FIELDS[attrs['op']] if field not in attrs}
+        if missing:
+            raise serializers.ValidationError(missing)
+        return attrs
+
+
+class BulkSubscriptionSerializer(serializers.Serializer):
+    """Creates, updates and deletes many subscriptions of the request user at once.
+    All operations are validated with a fixed number of queries and applied with
+    bulk_create/bulk_update, so the cost doesn't grow with a query per operation."""
+    operations = serializers.ListField(child=SubscriptionOperationSerializer(), allow_empty=False,
+                                       max_length=SUBSCRIPTIONS_BULK_MAX_OPERATIONS)
+
+    def validate_operations(self, operations):
+        user = self.context['request'].user
+        ids = {operation['id'] for operation in operations if operation['op'] != 'create'}
+        creates = [operation for operation in operations if operation['op'] == 'create']
+        subscriptions = Subscription.objects.filter(user=user, pk__in=ids).in_bulk()
+        cities = set(City.objects.filter(pk__in={operation['city'] for operation in creates})
+                     .values_list('pk', flat=True))
+        subscribed = set(Subscription.objects.filter(user=user, city_id__in=cities)
+                         .values_list('city_id', 'service'))
+        errors = {}
+        seen_ids = set()
+        seen_pairs = set()
+        for index, operation in enumerate(operations):
+            if operation['op'] == 'create':
+                pair = (operation['city'], operation['service'])
+                if operation['city'] not in cities:
+                    errors[index] = {'city': ["Such city does not exist"]}
+                elif pair in subscribed or pair in seen_pairs:
+                    errors[index] = {'non_field_errors': ["Such subscription already exists!"]}
+                seen_pairs.add(pair)
+            else:
+                if operation['id'] not in subscriptions:
+                    errors[index] = {'id': ["Such subscription does not exist"]}
+                elif operation['id'] in seen_ids:
+                    errors[index] = {'id': ["Subscription is changed more than once"]}
+                seen_ids.add(operation['id'])
+        if errors:
+            raise serializers.ValidationError(errors)
+        self.subscriptions = subscriptions
+        return operations
+
+    def create(self, validated_data):
+        user = self.context['request'].user
+        now = datetime.now(tz=pytz._UTC())
+        created, updated, deleted = [], [], []
+        for operation in validated_data['operations']:
+            if operation['op'] == 'create':
+                created.append(Subscription(
+                    user=user,
+                    city_id=operation['city'],
+                    service=operation['service'],
+                    period_notifications=operation['period_notifications'],
+                    date_of_subscription=now,
+                    next_notification_at=next_notification_time(operation['period_notifications'], now),
+                ))
+            elif operation['op'] == 'update':
+                subscription = self.subscriptions[operation['id']]
+                subscription.period_notifications = operation['period_notifications']
+                subscription.date_of_subscription = now
+                subscription.next_notification_at = next_notification_time(operation['period_notifications'], now)
+                updated.append(subscription)
+            else:
+                deleted.append(operation['id'])
+        Subscription.objects.filter(pk__in=deleted).delete()
+        Subscription.objects.bulk_update(updated, ['period_notifications', 'date_of_subscription',
+                                                   'next_notification_at'])
+        created = Subscription.objects.bulk_create(created)
+        schedule_events.publish([(pk, None) for pk in deleted] +
+                                [(s.pk, s.next_notification_at) for s in updated + created])
+        return {'created': created, 'updated': updated, 'deleted': deleted}
+
+    def to_representation(self, instance):
+        return {
+            'created': SubscriptionSerializer(instance['created'], many=True).data,
+            'updated': SubscriptionSerializer(instance['updated'], many=True).data,
+            'deleted': instance['deleted'],
+        }
+
+
+class CityCheckUnavailable(exceptions.APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "The city can't be checked now, please try again later."
+
+
 class CitySerializer(serializers.Serializer):
     id = serializers.IntegerField(read_only=True)
     name = serializers.CharField(max_length=100)
@@ -46,11 +153,20 @@ class CitySerializer(serializers.Serializer):
     def validate_name(self, value):
         """Before we create a new city in database we need to check and replace some symbols.
         Than needs to check if there already city in database and if it's not needs to
-        check exists this city at all"""
+        check exists this city at all: in the gazetteer first and only then with the service"""
         new_value = CityName(value).serializer()
         city = City.objects.filter(name=new_value).first()
         if city is None:
-            if CheckCity(new_value, OPEN_WEATHER_API_URL, WEATHER_API_KEY).check_existing_OpenWeather_city():
+            if new_value in get_gazetteer():
+                return new_value
+            try:
+                check = CheckCity(new_value, OPEN_WEATHER_API_URL, WEATHER_API_KEY)
+                not_exists = check.check_existing_OpenWeather_city()
+            except RateLimited as e:
+                raise exceptions.Throttled(wait=e.wait)
+            except ProviderUnavailable:
+                raise CityCheckUnavailable()
+            if not_exists:
                 raise serializers.ValidationError("Such city does not exits")
             return new_value
         elif city is not None:
@@ -60,14 +176,22 @@ class CitySerializer(serializers.Serializer):
         return City.objects.create(**validated_data)
 
 
+class GazetteerCitySerializer(serializers.Serializer):
+    name = serializers.CharField(read_only=True)
+    country = serializers.CharField(read_only=True)
+    lat = serializers.FloatField(read_only=True)
+    lon = serializers.FloatField(read_only=True)
+
+
 class WeatherSerializer(serializers.Serializer):
     id = serializers.IntegerField(read_only=True)
     city = serializers.PrimaryKeyRelatedField(queryset=City.objects.all())
     city_name = serializers.CharField(max_length=100, read_only=True)
     service = serializers.ChoiceField(choices=Service.choices, read_only=True)
     country_code = serializers.CharField(max_length=100, read_only=True)
-    coordinate = serializers.CharField(max_length=100, read_only=True)
-    temp = serializers.CharField(max_length=100, read_only=True)
-    pressure = serializers.CharField(max_length=100, read_only=True)
-    humidity = serializers.CharField(max_length=100, read_only=True)
+    lat = serializers.FloatField(read_only=True)
+    lon = serializers.FloatField(read_only=True)
+    temp = serializers.FloatField(read_only=True)
+    pressure = serializers.FloatField(read_only=True)
+    humidity = serializers.IntegerField(read_only=True)
 
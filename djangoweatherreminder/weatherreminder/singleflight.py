@@ -0,0 +1,78 @@
+import threading
+import time
+import uuid
+
+from django.core.cache import caches
+
+from djangoweatherreminder.settings import WEATHER_SINGLEFLIGHT_ALIAS, WEATHER_SINGLEFLIGHT_TIMEOUT
+
+
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one.
+    Threads of the process wait for the first caller and share its result or exception.
+    With `alias` from CACHES processes also take a short `cache.add` lock: the owner makes
+    the call, the others poll `lookup()` for the result the owner stores (e.g. in a shared
+    cache) and make the call themselves only if the lock is released without a result
+    or held longer than `timeout` seconds."""
+    poll_interval = 0.05
+
+    def __init__(self, alias=WEATHER_SINGLEFLIGHT_ALIAS, timeout=WEATHER_SINGLEFLIGHT_TIMEOUT):
+        self.alias = alias
+        self.timeout = timeout
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    @property
+    def shared(self):
+        return caches[self.alias] if self.alias else None
+
+    def do(self, key, function, lookup=None):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+        if not leader:
+            if not call.done.wait(self.timeout):
+                return function()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = self.run_shared(key, function, lookup)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+            call.done.set()
+
+    def run_shared(self, key, function, lookup):
+        if self.shared is None or lookup is None:
+            return function()
+        lock_key, token = f'singleflight:{key}', uuid.uuid4().hex
+        deadline = time.monotonic() + self.timeout
+        while not self.shared.add(lock_key, token, self.timeout):
+            result = lookup()
+            if result is not None:
+                return result
+            if time.monotonic() > deadline:
+                return function()
+            time.sleep(self.poll_interval)
+        try:
+            return function()
+        finally:
+            if self.shared.get(lock_key) == token:
+                self.shared.delete(lock_key)
+
+
+single_flight = SingleFlight()
@@ -0,0 +1,152 @@
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+STUB_CITIES = {
+    'london': {'country': 'GB', 'lat': 51.5085, 'lon': -0.1257, 'id': 2643743},
+    'new york': {'country': 'US', 'lat': 40.7143, 'lon': -74.006, 'id': 5128581},
+    'kyiv': {'country': 'UA', 'lat': 50.4333, 'lon': 30.5167, 'id': 703448},
+    'lublin': {'country': 'PL', 'lat': 51.25, 'lon': 22.5667, 'id': 765876},
+    'las vegas': {'country': 'US', 'lat': 36.175, 'lon': -115.1372, 'id': 5506956},
+}
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Benchmarks open hundreds of connections at once
+    request_queue_size = 1024
+
+
+class StubProvider:
+    """Local stand-in for OpenWeatherMap and WeatherBit current weather APIs,
+    used by tests and benchmarks instead of the real services.
+
+    with StubProvider() as stub:
+        OpenWeatherMap uses stub.open_weather_url and stub.open_weather_group_url,
+        WeatherBit uses stub.weather_bit_url
+    """
+    open_weather_path = '/data/2.5/weather'
+    open_weather_group_path = '/data/2.5/group'
+    weather_bit_path = '/v2.0/current'
+
+    def __init__(self, cities=None, delay=0, delays=None):
+        self.cities = cities or STUB_CITIES
+        self.delay = delay
+        # Response delay of single endpoints by path, e.g. {StubProvider.weather_bit_path: 1}
+        self.delays = delays or {}
+        self.requests = []
+        self.lock = threading.Lock()
+        self.server = StubServer(('127.0.0.1', 0), self.handler_class())
+        self.thread = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_port}'
+
+    @property
+    def open_weather_url(self):
+        return self.url + self.open_weather_path
+
+    @property
+    def open_weather_group_url(self):
+        return self.url + self.open_weather_group_path
+
+    @property
+    def weather_bit_url(self):
+        return self.url + self.weather_bit_path
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def find_city(self, name):
+        return self.cities.get(name.replace('_', ' ').lower())
+
+    def find_city_by_id(self, city_id):
+        return next((city for city in self.cities.values() if str(city['id']) == city_id), None)
+
+    def find_city_by_coordinates(self, lat, lon):
+        return next((city for city in self.cities.values()
+                     if abs(city['lat'] - float(lat)) < 0.01 and abs(city['lon'] - float(lon)) < 0.01), None)
+
+    def open_weather_data(self, city):
+        return {
+            'id': city['id'],
+            'coord': {'lon': city['lon'], 'lat': city['lat']},
+            'sys': {'country': city['country']},
+            'main': {'temp': 9.08, 'pressure': 1019, 'humidity': 62},
+        }
+
+    def open_weather(self, query):
+        city = self.find_city(query.get('q', [''])[0])
+        if city is None:
+            return 404, {'cod': '404', 'message': 'city not found'}
+        return 200, self.open_weather_data(city)
+
+    def open_weather_group(self, query):
+        """Like the real group endpoint, unknown ids are left out of the list"""
+        ids = query.get('id', [''])[0].split(',')
+        if len(ids) > 20:
+            return 400, {'cod': '400', 'message': 'Too many ids'}
+        cities = [city for city in map(self.find_city_by_id, ids) if city is not None]
+        return 200, {'cnt': len(cities), 'list': [self.open_weather_data(city) for city in cities]}
+
+    def weather_bit(self, query):
+        if 'lat' in query and 'lon' in query:
+            city = self.find_city_by_coordinates(query['lat'][0], query['lon'][0])
+        else:
+            city = self.find_city(query.get('city', [''])[0])
+        if city is None:
+            # The real API answers an unknown city with 204 and no body
+            return 204, None
+        return 200, {'count': 1, 'data': [{
+            'country_code': city['country'], 'lon': city['lon'], 'lat': city['lat'],
+            'temp': 9.1, 'pres': 1018.5, 'rh': 60,
+        }]}
+
+    def handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                with stub.lock:
+                    stub.requests.append(self.path)
+                delay = stub.delays.get(url.path, stub.delay)
+                if delay:
+                    threading.Event().wait(delay)
+                if url.path == stub.open_weather_path:
+                    code, body = stub.open_weather(parse_qs(url.query))
+                elif url.path == stub.open_weather_group_path:
+                    code, body = stub.open_weather_group(parse_qs(url.query))
+                elif url.path == stub.weather_bit_path:
+                    code, body = stub.weather_bit(parse_qs(url.query))
+                else:
+                    code, body = 404, {}
+                payload = json.dumps(body).encode() if body is not None else b''
+                try:
+                    self.send_response(code)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                except ConnectionError:
+                    # The client has cancelled the request, e.g. the slower services of a fan-out
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
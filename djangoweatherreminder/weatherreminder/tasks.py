@@ -1,41 +1,220 @@
+import logging
+from collections import defaultdict
 
 from celery import shared_task
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Min, OuterRef, Subquery
+from django.utils import timezone
 
-from weatherreminder.models import Subscription, Weather, City
-from weatherreminder.utils import send_message, OpenWeatherMap, WeatherBit, CityName
-import environ
-env = environ.Env()
+from weatherreminder.models import Subscription, Weather, City, next_notification_time
+from weatherreminder.clients import fetch_cities
+from weatherreminder.formatting import weather_age
+from weatherreminder.history import observation, record_observations, downsample_history
+from weatherreminder.mail import mailer
+from weatherreminder.notifications import renderer
+from weatherreminder.schedule_events import schedule_events
+from weatherreminder.utils import CITY_ID_FIELDS, fetch_weather, store_weather, store_weathers
+
+logger = logging.getLogger(__name__)
+
+
+def with_weather(subscriptions):
+    """Pairs subscriptions with their Weather rows, loaded with one query.
+    Subscriptions without weather yet are skipped."""
+    subscriptions = list(subscriptions)
+    weathers = Weather.objects.filter(city_id__in={s.city_id for s in subscriptions},
+                                      service__in={s.service for s in subscriptions})
+    weathers = {(weather.city_id, weather.service): weather for weather in weathers}
+    pairs = []
+    for subscription in subscriptions:
+        weather = weathers.get((subscription.city_id, subscription.service))
+        if weather is None:
+            logger.warning("There is no %s weather for %s yet", subscription.service, subscription.city)
+            continue
+        pairs.append((subscription, weather))
+    return pairs
+
+
+def notification_messages(subscriptions):
+    return [renderer.message(subscription, weather) for subscription, weather in with_weather(subscriptions)]
+
+
+def digest_messages(subscriptions):
+    """One email per user with all the user's subscriptions"""
+    users = {}
+    for subscription, weather in with_weather(subscriptions):
+        users.setdefault(subscription.user_id, (subscription.user, []))[1].append((subscription, weather))
+    return [renderer.digest(user, pairs) for user, pairs in users.values()]
 
 
 @shared_task(name="send_email_task")
 def send_email_task(sub_id):
-    subscription = Subscription.objects.get(pk=sub_id)
-    weather = Weather.objects.filter(city_id=subscription.city.id, service=subscription.service).first()
-    city_name = CityName(subscription.city.name).view()
-    content = f"<p>Period of notifications : every {subscription.period_notifications} hours</p><hr>" \
-              f"Service: {subscription.service}<hr>" \
-              f"Country code: {weather.country_code}<hr>" \
-              f"Coordinate: {weather.coordinate}<hr>" \
-              f"Temperature: {weather.temp}<hr>" \
-              f"Pressure: {weather.pressure}<hr>" \
-              f"Humidity: {weather.humidity}<hr>"
-    send_message(city_name, subscription.user.email, content)
+    subscriptions = Subscription.objects.filter(pk=sub_id).select_related('user', 'city')
+    mailer.send(notification_messages(subscriptions))
+
+
+@shared_task(name="send_notifications_task")
+def send_notifications_task(sub_ids):
+    """Sends notifications for one batch of subscriptions picked by the dispatcher
+    over the worker's pooled connection. Subscriptions deleted after dispatching are skipped."""
+    subscriptions = Subscription.objects.filter(pk__in=sub_ids).select_related('user', 'city')
+    return mailer.send(notification_messages(subscriptions))
+
+
+@shared_task(name="send_digests_task")
+def send_digests_task(sub_ids):
+    """Sends one digest email per user for the subscriptions picked by the dispatcher"""
+    subscriptions = Subscription.objects.filter(pk__in=sub_ids).select_related('user', 'city').order_by('pk')
+    return mailer.send(digest_messages(subscriptions))
+
+
+def advance_subscriptions(due, now):
+    """Moves due time of the (id, period) subscriptions to their next period"""
+    periods = defaultdict(list)
+    for sub_id, period in due:
+        periods[period].append(sub_id)
+    for period, ids in periods.items():
+        due = next_notification_time(period, now)
+        Subscription.objects.filter(pk__in=ids).update(next_notification_at=due)
+        schedule_events.publish([(sub_id, due) for sub_id in ids])
+
+
+@shared_task(name="dispatch_notifications_task")
+def dispatch_notifications_task():
+    """Runs every NOTIFICATION_DISPATCH_INTERVAL minutes from a single beat entry.
+    Selects due subscriptions by the `next_notification_at` index, moves their due time
+    to the next period and enqueues them in batches of NOTIFICATION_DISPATCH_BATCH_SIZE."""
+    now = timezone.now()
+    batch_size = settings.NOTIFICATION_DISPATCH_BATCH_SIZE
+    due = Subscription.objects.filter(next_notification_at__lte=now)
+    dispatched = 0
+    while True:
+        with transaction.atomic():
+            batch = list(
+                due.filter(user__digest_notifications=False)
+                .select_for_update(skip_locked=True, of=('self',))
+                .order_by('next_notification_at')
+                .values_list('id', 'period_notifications')[:batch_size]
+            )
+            if not batch:
+                break
+            advance_subscriptions(batch, now)
+        send_notifications_task.delay([sub_id for sub_id, _ in batch])
+        dispatched += len(batch)
+    # Users with digest mode get all their due subscriptions in one email
+    while True:
+        with transaction.atomic():
+            user_ids = list(due.filter(user__digest_notifications=True)
+                            .order_by('user_id').values_list('user_id', flat=True).distinct()[:batch_size])
+            batch = list(
+                due.filter(user_id__in=user_ids)
+                .select_for_update(skip_locked=True)
+                .values_list('id', 'period_notifications')
+            )
+            if not batch:
+                break
+            advance_subscriptions(batch, now)
+        send_digests_task.delay([sub_id for sub_id, _ in batch])
+        dispatched += len(batch)
+    return dispatched
+
+
+def refresh_pairs(pairs) -> int:
+    """Fetches weather of (City model, service) pairs with as few provider requests as possible
+    and writes it back with a bulk upsert. City ids resolved on the way are saved for the next refresh."""
+    pairs = list(pairs)
+    results, resolved = fetch_cities(pairs)
+    observed_at = timezone.now()
+    readings = {}
+    observations = []
+    for city, service in pairs:
+        weather_data = results.get((city.name, service))
+        if isinstance(weather_data, Exception):
+            logger.warning("Could not refresh %s weather for %s: %r", service, city.name, weather_data)
+            continue
+        readings[city, service] = weather_data
+        observations.append(observation(city.pk, service, weather_data, observed_at))
+    store_weathers(readings)
+    record_observations(observations)
+    City.objects.bulk_update(resolved, CITY_ID_FIELDS)
+    return len(observations)
+
+
+def subscribed_pairs(pairs):
+    """(City model, service) pairs for (city id, service) pairs, with one query for the cities"""
+    pairs = list(pairs)
+    cities = City.objects.in_bulk({city_id for city_id, _ in pairs})
+    return [(cities[city_id], service) for city_id, service in pairs if city_id in cities]
+
+
+def refresh_plan(now=None, lead=None, max_age=None):
+    """Plans the refresh of subscribed (city id, service) pairs with one query.
+    A pair is fetched once its next notification is due within `lead`, unless its weather
+    was already updated in that window. Weather older than `max_age` is fetched anyway,
+    so pairs of long periods or without a scheduled notification are never shown too old.
+    Returns the pairs to fetch and the number of subscribed pairs."""
+    now = now or timezone.now()
+    lead = lead or settings.WEATHER_REFRESH_LEAD
+    max_age = max_age or settings.WEATHER_REFRESH_MAX_AGE
+    rows = Subscription.objects.values('city_id', 'service').annotate(
+        next_due=Min('next_notification_at'),
+        updated_at=Subquery(Weather.objects.filter(city_id=OuterRef('city_id'), service=OuterRef('service'))
+                            .values('updated_at')[:1]),
+    ).order_by()
+    pairs = []
+    subscribed = 0
+    for row in rows:
+        subscribed += 1
+        updated_at, next_due = row['updated_at'], row['next_due']
+        if updated_at is None or updated_at < now - max_age:
+            pairs.append((row['city_id'], row['service']))
+        elif next_due is not None and next_due <= now + lead and updated_at < next_due - lead:
+            pairs.append((row['city_id'], row['service']))
+    return pairs, subscribed
+
+
+@shared_task(name="refresh_weather_task")
+def refresh_weather_task():
+    """Runs every hour from a single beat entry.
+    Fetches weather once per (city, service) pair, and only for the pairs with a notification
+    due within WEATHER_REFRESH_LEAD or with weather older than WEATHER_REFRESH_MAX_AGE,
+    so pairs whose subscribers are on long periods aren't fetched every hour."""
+    pairs, subscribed = refresh_plan()
+    refreshed = refresh_pairs(subscribed_pairs(pairs))
+    logger.info("Refreshed %s of %s subscribed pairs, %s provider fetches saved against the hourly refresh",
+                refreshed, subscribed, subscribed - len(pairs))
+    return refreshed
+
+
+@shared_task(name="fetch_missing_weather_task")
+def fetch_missing_weather_task(pairs):
+    """Fetches weather for the [city id, service] pairs that have no Weather row yet,
+    e.g. after a bulk of new subscriptions"""
+    pairs = {(city_id, service) for city_id, service in pairs}
+    existing = set(Weather.objects.filter(city_id__in={city_id for city_id, _ in pairs})
+                   .values_list('city_id', 'service'))
+    return refresh_pairs(subscribed_pairs(pairs - existing))
 
 
 @shared_task(name="get_weather_task")
-def get_weather_task(sub_id):
-    subscription = Subscription.objects.get(pk=sub_id)
-    city = City.objects.get(pk=subscription.city.id)
-    weather = Weather.objects.filter(city=city, service=subscription.service).first()
-    if subscription.service == "OpenWeatherMap":
-        weather_data = OpenWeatherMap(city.name).get_context_mixin(token=env('WEATHER_API_KEY'))
-    else:
-        weather_data = WeatherBit(city.name).get_context_mixin(env('WEATHER_BIT_KEY'))
-    weather.temp = weather_data['temp']
-    weather.humidity = weather_data['humidity']
-    weather.pressure = weather_data['pressure']
-    weather.coordinate = weather_data['coordinate']
-    weather.country_code = weather_data['country_code']
-    weather.save()
+def get_weather_task(city_id, service):
+    city = City.objects.filter(pk=city_id).first()
+    if city is None:
+        return
+    try:
+        reading = fetch_weather(city.name, service)
+    except Exception as e:
+        stored = Weather.objects.filter(city=city, service=service).first()
+        logger.warning("Could not refresh %s weather for %s, the stored one is %s old: %r", service, city.name,
+                       weather_age(stored.updated_at)['age'] if stored else 'not', e)
+        return
+    store_weather(city, service, reading)
+    record_observations([observation(city.id, service, reading)])
 
 
+@shared_task(name="downsample_weather_history_task")
+def downsample_weather_history_task():
+    """Runs daily. Rolls raw observations older than WEATHER_HISTORY_RAW_DAYS into
+    daily aggregates and prunes both tables in batches, so the history stays bounded."""
+    return downsample_history()
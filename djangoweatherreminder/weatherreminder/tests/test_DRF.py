@@ -7,6 +7,8 @@ from django.utils.datetime_safe import datetime
 from rest_framework import status, serializers
 from rest_framework.test import APITestCase
 from weatherreminder.models import City, Subscription, Weather, User, Service
+from weatherreminder.ratelimit import RateLimited
+from weatherreminder.schedule_events import schedule_events
 from weatherreminder.serializers import CitySerializer
 from freezegun import freeze_time
 
@@ -28,6 +30,28 @@ class CityApiViewTests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response.data['users_cities']), 1)
 
+    def test_cities_list_is_paginated_by_cursor(self):
+        City.objects.bulk_create([City(name=f'City_{index}') for index in range(4)])
+        self.client.force_authenticate(self.user)
+        response = self.client.get(reverse("cities-list"), {'page_size': 2})
+        self.assertEqual([city['name'] for city in response.data['users_cities']], ['New_York', 'City_0'])
+        self.assertIsNone(response.data['previous'])
+        names = []
+        next_link = response.data['next']
+        while next_link:
+            response = self.client.get(next_link)
+            names += [city['name'] for city in response.data['users_cities']]
+            next_link = response.data['next']
+        self.assertEqual(names, ['City_1', 'City_2', 'City_3'])
+
+    @patch('weatherreminder.pagination.PrimaryKeyCursorPagination.max_page_size', 3)
+    def test_cities_page_size_is_limited(self):
+        City.objects.bulk_create([City(name=f'City_{index}') for index in range(4)])
+        self.client.force_authenticate(self.user)
+        response = self.client.get(reverse("cities-list"), {'page_size': 1000})
+        self.assertEqual(len(response.data['users_cities']), 3)
+        self.assertIsNotNone(response.data['next'])
+
     def test_fail_get_one_city(self):
         self.client.force_authenticate(self.user)
         response = self.client.get(reverse("one-city", kwargs={'pk': 50}))
@@ -35,9 +59,9 @@ class CityApiViewTests(APITestCase):
 
     def test_get_one_city(self):
         self.client.force_authenticate(self.user)
-        response = self.client.get(reverse("one-city", kwargs={'pk': 1}))
+        response = self.client.get(reverse("one-city", kwargs={'pk': self.city.pk}))
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual({'city': {'id': 1, 'name': 'New_York'}}, response.data)
+        self.assertEqual({'city': {'id': self.city.pk, 'name': 'New_York'}}, response.data)
 
     def test_unauthorized_create_city(self):
         response = self.client.post(reverse("cities-list"), self.data, format='json')
@@ -55,13 +79,20 @@ class CityApiViewTests(APITestCase):
             serializer = CitySerializer(data={'name': 'test_city'})
             serializer.is_valid(raise_exception=True)
 
+    @patch('weatherreminder.utils.CheckCity.check_existing_OpenWeather_city', side_effect=RateLimited(3))
+    def test_create_city_while_throttled(self, check_mock):
+        self.client.force_authenticate(self.user)
+        response = self.client.post(reverse("cities-list"), {'name': 'Atlantis'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertFalse(City.objects.filter(name='Atlantis').exists())
+
     @patch('weatherreminder.utils.CheckCity.check_existing_OpenWeather_city')
     def test_create_city(self, check_mock):
         check_mock.return_value = False
         self.client.force_authenticate(self.user)
         response = self.client.post(reverse("cities-list"), self.data, format='json')
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
-        self.assertEqual(response.data, {'city': {'id': 2, 'name': 'Las_Vegas'}})
+        self.assertEqual(response.data, {'city': {'id': City.objects.get(name='Las_Vegas').pk, 'name': 'Las_Vegas'}})
 
     def test_fail_create_city(self):
         self.client.force_authenticate(self.user)
@@ -71,21 +102,62 @@ class CityApiViewTests(APITestCase):
         self.assertDictEqual(response.data, expected_response)
 
     def test_delete_city_unauthorized(self):
-        response = self.client.delete(reverse("one-city", kwargs={'pk': 1}))
+        response = self.client.delete(reverse("one-city", kwargs={'pk': self.city.pk}))
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
         self.assertEqual(response.data, {'detail': 'Authentication credentials were not provided.'})
 
     def test_delete_city(self):
         self.client.force_authenticate(self.user)
-        response = self.client.delete(reverse("one-city", kwargs={'pk': 1}))
+        response = self.client.delete(reverse("one-city", kwargs={'pk': self.city.pk}))
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
 
+    def test_delete_city_unschedules_subscriptions_of_all_users(self):
+        other = User.objects.create_user(username='other_name', password='test_pass', email='other@email.com')
+        subscriptions = [Subscription.objects.create(user=user, city=self.city, period_notifications=1,
+                                                     service=Service.open_weather) for user in (self.user, other)]
+        schedule_events.clear()
+        self.addCleanup(schedule_events.clear)
+        self.client.force_authenticate(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(reverse("one-city", kwargs={'pk': self.city.pk}))
+        self.assertFalse(Subscription.objects.exists())
+        self.assertCountEqual(schedule_events.read(0)[0], [(subscription.pk, None) for subscription in subscriptions])
+
     def test_wrong_delete_city(self):
         self.client.force_authenticate(self.user)
         response = self.client.delete(reverse("one-city", kwargs={'pk': 50}))
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
 
+class CityAutocompleteApiViewTests(APITestCase):
+    def setUp(self) -> None:
+        self.user = User.objects.create_user(username='test_name', password='test_pass', email='test@email.com')
+
+    def test_unauthorized(self):
+        response = self.client.get(reverse("cities-autocomplete"), {'q': 'Lo'})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_autocomplete(self):
+        self.client.force_authenticate(self.user)
+        response = self.client.get(reverse("cities-autocomplete"), {'q': 'new y'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['cities'][0]['name'], 'New York')
+        self.assertEqual(response.data['cities'][0]['country'], 'US')
+
+    def test_autocomplete_limit(self):
+        self.client.force_authenticate(self.user)
+        response = self.client.get(reverse("cities-autocomplete"), {'q': 'l', 'limit': 2})
+        self.assertEqual(len(response.data['cities']), 2)
+        response = self.client.get(reverse("cities-autocomplete"), {'q': 'l', 'limit': 'a'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @patch('weatherreminder.utils.CheckCity.check_existing_OpenWeather_city')
+    def test_city_from_gazetteer_is_not_checked(self, check_mock):
+        serializer = CitySerializer(data={'name': 'las vegas'})
+        self.assertTrue(serializer.is_valid())
+        check_mock.assert_not_called()
+
+
 class WeatherApiViewTests(APITestCase):
 
     def setUp(self) -> None:
@@ -96,10 +168,11 @@ class WeatherApiViewTests(APITestCase):
             city_name=self.city.name,
             service="OpenWeatherMap",
             country_code='US',
-            coordinate='-74.006 40.7143',
-            temp='14.6с',
-            pressure='1028',
-            humidity='21%'
+            lat=40.7143,
+            lon=-74.006,
+            temp=14.6,
+            pressure=1028,
+            humidity=21
         )
 
     def test_unauthorized(self):
@@ -127,41 +200,50 @@ class SubscriptionApiView(APITestCase):
             service=Service.open_weather,
         )
         self.data = {
-            'user': 1,
-            'city': 1,
+            'user': self.user.pk,
+            'city': self.city.pk,
             'period_notifications': 1,
             'service': Service.weather_bit
         }
         tz = pytz.timezone('Europe/Moscow')
         self.date_of_subscription = datetime.now(tz)
         self.date_of_subscription = self.date_of_subscription.astimezone(pytz.utc)
-        self.fake_weather = {'city': 'Lublin', 'country_code': 'US', 'coordinate': '-115.1372 36.175', 'temp': '9.08с',
-                             'pressure': '1019', 'humidity': '62%'}
+        self.fake_weather = {'country_code': 'US', 'lat': 36.175, 'lon': -115.1372, 'temp': 9.08,
+                             'pressure': 1019.0, 'humidity': 62}
 
     @freeze_time('2023-03-21T00:00:00', tz_offset=-2)
     def test_get_one_subscription(self):
         self.client.force_authenticate(self.user)
-        response = self.client.get(reverse("one-subscription", kwargs={'pk': 1}))
+        response = self.client.get(reverse("one-subscription", kwargs={'pk': self.subscription.pk}))
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual({'subscription': {'id': 1, 'user': self.user.id, 'city': self.city.id,
+        self.assertEqual({'subscription': {'id': self.subscription.pk, 'user': self.user.id, 'city': self.city.id,
                                            'period_notifications': 1,
                                            'date_of_subscription': '2023-03-21T00:00:00+02:00',
                                            'service': 'OpenWeatherMap'}}, response.data)
 
     @override_settings(USE_TZ=True)
-    @patch('weatherreminder.utils.WeatherBit.get_context_mixin')
+    @patch('weatherreminder.utils.WeatherBit.get_weather_reading')
     @freeze_time('2023-03-21T00:00:00', tz_offset=-2)
     def test_post_subscription(self, mixin_mock):
-        self.fake_weather['city'] = 'New_York'
         mixin_mock.return_value = self.fake_weather
         self.client.force_authenticate(self.user)
         response = self.client.post(reverse('subscriptions-list'), self.data, format='json')
-        self.assertEqual({'subscription': {'id': 2, 'user': 1, 'city': 1, 'period_notifications': 1,
+        created = Subscription.objects.get(service=Service.weather_bit)
+        self.assertEqual({'subscription': {'id': created.pk, 'user': self.user.pk, 'city': self.city.pk,
+                                           'period_notifications': 1,
                                            'date_of_subscription': '2023-03-21T00:00:00+02:00',
                                            'service': 'WeatherBit'}}, response.data)
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         self.assertEqual(len(Subscription.objects.all()), 2)
 
+    def test_post_duplicate_subscription(self):
+        self.client.force_authenticate(self.user)
+        self.data.update(service=Service.open_weather, period_notifications=3)
+        response = self.client.post(reverse('subscriptions-list'), self.data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response.data, "Such subscription already exists!")
+        self.assertEqual(Subscription.objects.count(), 1)
+
     def test_get_unauthorized(self):
         response = self.client.get(reverse("subscriptions-list"))
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
@@ -173,6 +255,18 @@ class SubscriptionApiView(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response.data['users_cities']), 1)
 
+    def test_get_subscriptions_queries_do_not_depend_on_subscriptions(self):
+        self.client.force_authenticate(self.user)
+        with self.assertNumQueries(1):
+            self.client.get(reverse('subscriptions-list'))
+        for index in range(10):
+            city = City.objects.create(name=f'City_{index}')
+            Subscription.objects.create(user=self.user, city=city, period_notifications=1,
+                                        service=Service.open_weather)
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('subscriptions-list'))
+        self.assertEqual(len(response.data['users_cities']), 11)
+
     def test_fail_get_one_subscription(self):
         self.client.force_authenticate(self.user)
         response = self.client.get(reverse("one-subscription", kwargs={'pk': 50}))
@@ -199,8 +293,8 @@ class SubscriptionApiView(APITestCase):
         self.assertDictEqual(response.data, expected_response)
 
     def test_put_unauthorized(self):
-        response = self.client.put(reverse('one-subscription', kwargs={'pk': 1}), {"period_notifications": 3},
-                                   format='json')
+        response = self.client.put(reverse('one-subscription', kwargs={'pk': self.subscription.pk}),
+                                   {"period_notifications": 3}, format='json')
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
         self.assertEqual(response.data, {'detail': 'Authentication credentials were not provided.'})
 
@@ -208,10 +302,11 @@ class SubscriptionApiView(APITestCase):
     @freeze_time('2023-03-21T00:00:00', tz_offset=-2)
     def test_put_subscription(self):
         self.client.force_authenticate(self.user)
-        response = self.client.put(reverse('one-subscription', kwargs={'pk': 1}), {"period_notifications": 3},
-                                   format='json')
+        response = self.client.put(reverse('one-subscription', kwargs={'pk': self.subscription.pk}),
+                                   {"period_notifications": 3}, format='json')
         self.assertEqual(response.status_code, status.HTTP_205_RESET_CONTENT)
-        self.assertEqual({'subscription': {'id': 1, 'user': 1, 'city': 1, 'period_notifications': 3,
+        self.assertEqual({'subscription': {'id': self.subscription.pk, 'user': self.user.pk, 'city': self.city.pk,
+                                           'period_notifications': 3,
                                            'date_of_subscription': '2023-03-21T00:00:00+02:00',
                                            'service': 'OpenWeatherMap'}}, response.data)
 
@@ -223,7 +318,7 @@ class SubscriptionApiView(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
     def test_delete_subscription_unauthorized(self):
-        response = self.client.delete(reverse('one-subscription', kwargs={'pk': 1}), format='json')
+        response = self.client.delete(reverse('one-subscription', kwargs={'pk': self.subscription.pk}), format='json')
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
         self.assertEqual(response.data, {'detail': 'Authentication credentials were not provided.'})
 
@@ -235,7 +330,63 @@ class SubscriptionApiView(APITestCase):
 
     def test_delete_subscription(self):
         self.client.force_authenticate(self.user)
-        response = self.client.delete(reverse('one-subscription', kwargs={'pk': 1}), format='json')
+        response = self.client.delete(reverse('one-subscription', kwargs={'pk': self.subscription.pk}), format='json')
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
-        self.assertEqual(response.data, {'subscription': 'delete subscription 1'})
+        self.assertEqual(response.data, {'subscription': f'delete subscription {self.subscription.pk}'})
+
 
+
+class SubscriptionBulkApiViewTests(APITestCase):
+    def setUp(self) -> None:
+        self.user = User.objects.create_user(username='test_name', password='test_pass', email='test@email.com')
+        self.other = User.objects.create_user(username='other_name', password='test_pass', email='other@email.com')
+        self.cities = City.objects.bulk_create([City(name=f'City_{index}') for index in range(5)])
+        self.subscription = Subscription.objects.create(user=self.user, city=self.cities[0], period_notifications=1,
+                                                        service=Service.open_weather)
+        self.removed = Subscription.objects.create(user=self.user, city=self.cities[1], period_notifications=1,
+                                                   service=Service.open_weather)
+        self.foreign = Subscription.objects.create(user=self.other, city=self.cities[0], period_notifications=1,
+                                                   service=Service.open_weather)
+        self.client.force_authenticate(self.user)
+
+    def post(self, operations):
+        return self.client.post(reverse('subscriptions-bulk'), {'operations': operations}, format='json')
+
+    @patch('weatherreminder.api_views.fetch_missing_weather_task.delay')
+    def test_bulk_operations(self, delay_mock):
+        operations = [{'op': 'create', 'city': city.id, 'service': Service.weather_bit, 'period_notifications': 3}
+                      for city in self.cities]
+        operations += [{'op': 'update', 'id': self.subscription.id, 'period_notifications': 6},
+                       {'op': 'delete', 'id': self.removed.id}]
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertNumQueries(8):
+                response = self.post(operations)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['created']), 5)
+        self.assertEqual(response.data['updated'][0]['period_notifications'], 6)
+        self.assertEqual(response.data['deleted'], [self.removed.id])
+        self.assertEqual(Subscription.objects.filter(user=self.user, service=Service.weather_bit).count(), 5)
+        self.assertFalse(Subscription.objects.filter(pk=self.removed.pk).exists())
+        self.assertFalse(Subscription.objects.filter(user=self.user, next_notification_at=None)
+                         .exclude(pk=self.subscription.pk).exists())
+        delay_mock.assert_called_once_with([(city.id, Service.weather_bit) for city in self.cities])
+
+    @patch('weatherreminder.api_views.fetch_missing_weather_task.delay')
+    def test_invalid_bulk_changes_nothing(self, delay_mock):
+        response = self.post([
+            {'op': 'create', 'city': self.cities[2].id, 'service': Service.open_weather, 'period_notifications': 1},
+            {'op': 'create', 'city': self.cities[0].id, 'service': Service.open_weather, 'period_notifications': 1},
+            {'op': 'create', 'city': 1000, 'service': Service.open_weather, 'period_notifications': 1},
+            {'op': 'update', 'id': self.foreign.id, 'period_notifications': 3},
+            {'op': 'delete', 'id': self.removed.id},
+            {'op': 'update', 'id': self.removed.id, 'period_notifications': 3},
+        ])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(set(response.data['operations']), {1, 2, 3, 5})
+        self.assertEqual(Subscription.objects.count(), 3)
+        delay_mock.assert_not_called()
+
+    def test_operation_fields_are_required(self):
+        response = self.post([{'op': 'delete'}, {'op': 'create', 'city': self.cities[2].id}])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(set(response.data['operations'][1]), {'service', 'period_notifications'})
@@ -0,0 +1,124 @@
+import asyncio
+from unittest.mock import patch
+from urllib.parse import urlencode
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import AnonymousUser
+from django.test import AsyncRequestFactory, TestCase
+
+from weatherreminder import async_views, breaker, ratelimit
+from weatherreminder.cache import city_validation_cache, provider_cache
+from weatherreminder.clients import close_view_client
+from weatherreminder.models import User, City, Subscription, Weather, Service
+from weatherreminder.stub_provider import StubProvider
+
+
+class TestAsyncViews(TestCase):
+
+    def setUp(self):
+        self.stub = StubProvider().start()
+        patchers = [
+            patch('weatherreminder.utils.OPEN_WEATHER_API_URL', self.stub.open_weather_url),
+            patch('weatherreminder.utils.WEATHER_BIT_API_URL', self.stub.weather_bit_url),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(self.stub.stop)
+        for cache in (provider_cache, city_validation_cache, ratelimit.buckets, breaker.breakers):
+            self.addCleanup(cache.clear)
+        self.user = User.objects.create_user(username='test_username', password='test_password',
+                                             email='test_email@mail.com')
+        self.factory = AsyncRequestFactory()
+
+    def post(self, view, data, user=None):
+        request = self.factory.post('/', urlencode(data), content_type='application/x-www-form-urlencoded')
+        request.user = user or self.user
+        return view(request)
+
+    async def test_home(self):
+        try:
+            response = await self.post(async_views.home, {'city': 'Las Vegas', 'token': 'token'}, AnonymousUser())
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b'Las Vegas', response.content)
+            self.assertIn(b'9.08', response.content)
+
+            provider_cache.clear()
+            self.stub.requests.clear()
+            responses = await asyncio.gather(*(self.post(async_views.home, {'city': 'Kyiv', 'token': 'token'},
+                                                         AnonymousUser()) for _ in range(5)))
+            self.assertTrue(all(b'Kyiv' in response.content for response in responses))
+            self.assertEqual(len(self.stub.requests), 1)
+        finally:
+            await close_view_client()
+
+    async def test_new_city_subscription(self):
+        try:
+            response = await self.post(async_views.WeatherBitView.as_view(), {'city': 'Lublin', 'period': 3})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(self.stub.requests), 1)
+            weather = await Weather.objects.select_related('city').aget(service=Service.weather_bit)
+            self.assertEqual((weather.city.name, weather.temp), ('Lublin', 9.1))
+            self.assertEqual((weather.city.lat, weather.city.lon), (51.25, 22.5667))
+            self.assertTrue(await Subscription.objects.filter(user=self.user, period_notifications=3).aexists())
+
+            response = await self.post(async_views.WeatherBitView.as_view(), {'city': 'lublin', 'period': 6})
+            self.assertEqual(response.status_code, 302)
+            self.assertIn(b'Lublin', response.content)
+            self.assertEqual(len(self.stub.requests), 1)
+            subscription = await Subscription.objects.aget(user=self.user)
+            self.assertEqual(subscription.period_notifications, 6)
+        finally:
+            await close_view_client()
+
+    async def test_existing_city_weather_is_not_requested(self):
+        city = await City.objects.acreate(name='London')
+        await sync_to_async(Weather.objects.create)(
+            city=city, city_name=city.name, service=Service.open_weather, country_code='GB',
+            lat=51.5085, lon=-0.1257, temp=10.0, pressure=1012.0, humidity=80)
+        response = await self.post(async_views.OpenWeatherView.as_view(), {'city': 'London', 'period': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.stub.requests, [])
+        self.assertEqual(await Subscription.objects.filter(city=city).acount(), 1)
+
+    async def test_unknown_city(self):
+        try:
+            for view in (async_views.OpenWeatherView, async_views.WeatherBitView):
+                self.stub.requests.clear()
+                for _ in range(2):
+                    response = await self.post(view.as_view(), {'city': 'Londn', 'period': 1})
+                    self.assertEqual(response.status_code, 302)
+                self.assertEqual(len(self.stub.requests), 1)
+            self.assertFalse(await City.objects.aexists())
+            self.assertEqual(breaker.get_breaker(Service.weather_bit).load()['failures'], 0)
+        finally:
+            await close_view_client()
+
+    async def test_throttled_provider(self):
+        try:
+            throttled = ratelimit.RateLimited(5)
+            with patch('weatherreminder.clients.AsyncWeatherClient.get_reading', side_effect=throttled), \
+                    patch('weatherreminder.async_views.fetch_missing_weather_task.delay') as delay_mock:
+                response = await self.post(async_views.OpenWeatherView.as_view(), {'city': 'Atlantis', 'period': 1})
+                self.assertEqual(response.status_code, 429)
+                self.assertFalse(await City.objects.aexists())
+
+                response = await self.post(async_views.OpenWeatherView.as_view(), {'city': 'Las Vegas', 'period': 1})
+                self.assertEqual(response.status_code, 200)
+                subscription = await Subscription.objects.aget(user=self.user)
+                delay_mock.assert_called_once_with([[subscription.city_id, Service.open_weather]])
+        finally:
+            await close_view_client()
+
+    async def test_unexpected_error_is_not_hidden(self):
+        try:
+            with patch('weatherreminder.clients.AsyncWeatherClient.get_reading', side_effect=KeyError('main')):
+                with self.assertRaises(KeyError):
+                    await self.post(async_views.OpenWeatherView.as_view(), {'city': 'Las Vegas', 'period': 1})
+        finally:
+            await close_view_client()
+
+    async def test_login_required(self):
+        response = await self.post(async_views.OpenWeatherView.as_view(), {'city': 'London'}, AnonymousUser())
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('/login/', response.url)
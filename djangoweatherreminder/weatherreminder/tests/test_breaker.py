@@ -0,0 +1,123 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+import requests
+from django.test import TestCase
+from django.utils import timezone
+
+from weatherreminder.breaker import CircuitBreaker, ProviderUnavailable, breakers, get_breaker, is_provider_failure
+from weatherreminder.cache import provider_cache
+from weatherreminder.models import City, Service, Weather, User, Subscription
+from weatherreminder.notifications import renderer
+from weatherreminder.ratelimit import RateLimited, buckets, get_bucket
+from weatherreminder.tasks import get_weather_task
+from weatherreminder.utils import OpenWeatherMap
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def not_found():
+    response = requests.Response()
+    response.status_code = 404
+    raise requests.HTTPError(response=response)
+
+
+def timeout():
+    raise requests.Timeout()
+
+
+class TestCircuitBreaker(TestCase):
+    def setUp(self) -> None:
+        self.timer = FakeTimer()
+        self.breaker = CircuitBreaker('test', failures=2, slow_call=1, reset=30, alias=None, timer=self.timer)
+
+    def test_opens_after_failures_and_closes_after_probe(self):
+        for _ in range(2):
+            with self.assertRaises(requests.Timeout):
+                self.breaker.call(timeout)
+        self.assertTrue(self.breaker.is_open)
+        with self.assertRaises(ProviderUnavailable):
+            self.breaker.call(lambda: 'weather')
+        self.assertEqual(self.breaker.call(lambda: 'weather', probe=True), 'weather')
+        self.assertFalse(self.breaker.is_open)
+
+    def test_reopens_after_reset_timeout(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.timer.now += 31
+        self.assertFalse(self.breaker.is_open)
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.is_open)
+
+    def test_slow_calls_and_client_errors(self):
+        self.breaker.record_success(elapsed=2)
+        for _ in range(3):
+            with self.assertRaises(requests.HTTPError):
+                self.breaker.call(not_found)
+        self.assertFalse(self.breaker.is_open)
+        self.breaker.record_success(elapsed=2)
+        self.assertTrue(self.breaker.is_open)
+
+    @patch('weatherreminder.ratelimit.WEATHER_RATE_LIMIT_MAX_WAIT', 0)
+    @patch('weatherreminder.utils.http_session.get')
+    def test_burst_over_quota_leaves_circuit_closed(self, get_mock):
+        self.addCleanup(buckets.clear)
+        self.addCleanup(breakers.clear)
+        bucket = get_bucket(Service.open_weather, 'limited')
+        for _ in range(bucket.burst):
+            bucket.reserve()
+        for index in range(get_breaker(Service.open_weather).failures + 1):
+            with self.assertRaises(RateLimited):
+                OpenWeatherMap(city=f'City{index}').get_weather_data('limited')
+        get_mock.assert_not_called()
+        self.assertFalse(get_breaker(Service.open_weather).is_open)
+        self.assertFalse(is_provider_failure(RateLimited(1)))
+
+
+class TestStaleWeather(TestCase):
+    def setUp(self) -> None:
+        self.city = City.objects.create(name='London')
+        self.weather = Weather.objects.create(city=self.city, city_name='London', service=Service.open_weather,
+                                              country_code='GB', lat=51.5085, lon=-0.1257, temp=9.1, pressure=1018,
+                                              humidity=60)
+        Weather.objects.filter(pk=self.weather.pk).update(updated_at=timezone.now() - timedelta(hours=3))
+        self.weather.refresh_from_db()
+        breaker = get_breaker(Service.open_weather)
+        for _ in range(breaker.failures):
+            breaker.record_failure()
+        self.addCleanup(breakers.clear)
+        self.addCleanup(provider_cache.clear)
+
+    @patch('weatherreminder.utils.http_session.get')
+    def test_view_context_is_served_from_stored_weather(self, get_mock):
+        context = OpenWeatherMap(city='London').get_context_mixin('token', index=True)
+        get_mock.assert_not_called()
+        self.assertEqual(context['temp'], '9.1с')
+        self.assertTrue(context['stale'])
+        self.assertEqual(context['age'], '3\xa0hours')
+
+    @patch('weatherreminder.utils.http_session.get')
+    def test_unknown_city_is_not_served(self, get_mock):
+        with self.assertRaises(ProviderUnavailable):
+            OpenWeatherMap(city='Kyiv').get_context_mixin('token')
+
+    def test_email_tells_weather_age(self):
+        user = User.objects.create_user(username='test_username', password='test_pass', email='test@mail.com')
+        subscription = Subscription.objects.create(user=user, city=self.city, period_notifications=1,
+                                                   service=Service.open_weather)
+        self.assertIn(f"Last updated: {self.weather.updated_at:%Y-%m-%d %H:%M} UTC",
+                      renderer.render(subscription, self.weather))
+
+    @patch('weatherreminder.utils.http_session.get', side_effect=requests.ConnectionError())
+    def test_background_refresh_probes_and_logs_age(self, get_mock):
+        with self.assertLogs('weatherreminder.tasks', 'WARNING') as logs:
+            get_weather_task(self.city.id, Service.open_weather)
+        get_mock.assert_called_once()
+        self.assertIn('3\xa0hours old', logs.output[0])
+        self.assertEqual(Weather.objects.get(pk=self.weather.pk).updated_at, self.weather.updated_at)
@@ -0,0 +1,122 @@
+from unittest.mock import patch
+
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+from freezegun import freeze_time
+
+from weatherreminder.breaker import ProviderUnavailable
+from weatherreminder.cache import TTLCache, ProviderCache, provider_cache, CityValidationCache, \
+    city_validation_cache
+from weatherreminder.models import Service, CityValidation
+from weatherreminder.ratelimit import buckets
+from weatherreminder.stub_provider import StubProvider
+from weatherreminder.utils import OpenWeatherMap, WeatherBit, CheckCity
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTTLCache(TestCase):
+    def test_expiration(self):
+        timer = FakeTimer()
+        cache = TTLCache(maxsize=10, ttl=60, timer=timer)
+        cache.set('London', 1)
+        timer.now = 59
+        self.assertEqual(cache.get('London'), 1)
+        timer.now = 60
+        self.assertIsNone(cache.get('London'))
+        self.assertEqual(len(cache), 0)
+
+    def test_lru_eviction(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set('London', 1)
+        cache.set('Kyiv', 2)
+        cache.get('London')
+        cache.set('Lublin', 3)
+        self.assertEqual(cache.get('London'), 1)
+        self.assertIsNone(cache.get('Kyiv'))
+        self.assertEqual(cache.get('Lublin'), 3)
+
+
+class TestProviderCache(TestCase):
+    def setUp(self) -> None:
+        self.stub = StubProvider().start()
+        patchers = [
+            patch('weatherreminder.utils.OPEN_WEATHER_API_URL', self.stub.open_weather_url),
+            patch('weatherreminder.utils.WEATHER_BIT_API_URL', self.stub.weather_bit_url),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(self.stub.stop)
+        provider_cache.clear()
+        self.addCleanup(provider_cache.clear)
+        self.addCleanup(buckets.clear)
+
+    def test_key_normalizes_city(self):
+        self.assertEqual(ProviderCache.key(Service.open_weather, 'New%20York'),
+                         ProviderCache.key(Service.open_weather, ' new_york'))
+        self.assertNotEqual(ProviderCache.key(Service.open_weather, 'London'),
+                            ProviderCache.key(Service.weather_bit, 'London'))
+
+    def test_context_mixin_hits_service_once(self):
+        first = OpenWeatherMap(city='New York').get_context_mixin('token', index=True)
+        second = OpenWeatherMap(city='new_york').get_context_mixin('token')
+        WeatherBit(city='New York').get_context_mixin('token')
+        self.assertEqual(first['temp'], second['temp'])
+        self.assertEqual(len(self.stub.requests), 2)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_shared_tier(self):
+        worker1 = ProviderCache(ttl=60, maxsize=10, alias='default')
+        worker2 = ProviderCache(ttl=60, maxsize=10, alias='default')
+        worker1.set(Service.weather_bit, 'London', {'data': []})
+        self.assertEqual(worker2.get(Service.weather_bit, 'london'), {'data': []})
+        caches['default'].clear()
+
+
+class TestCityValidationCache(TestCase):
+    def setUp(self) -> None:
+        self.stub = StubProvider().start()
+        self.addCleanup(self.stub.stop)
+        city_validation_cache.clear()
+        self.addCleanup(city_validation_cache.clear)
+
+    def test_valid_and_invalid_names_are_checked_once(self):
+        for _ in range(2):
+            self.assertFalse(CheckCity('London', self.stub.open_weather_url, 'token').check_existing_OpenWeather_city())
+            self.assertTrue(CheckCity('Londn', self.stub.open_weather_url, 'token').check_existing_OpenWeather_city())
+        self.assertFalse(CheckCity('london', self.stub.open_weather_url, 'token').check_existing_OpenWeather_city())
+        self.assertEqual(len(self.stub.requests), 2)
+        self.assertEqual(CityValidation.objects.count(), 2)
+
+    def test_results_are_persistent(self):
+        CheckCity('Londn', self.stub.weather_bit_url, 'token').check_existing_WeatherBit_city()
+        CheckCity('Kyiv', self.stub.weather_bit_url, 'token').check_existing_WeatherBit_city()
+        new_process_cache = CityValidationCache()
+        self.assertIs(new_process_cache.get(Service.weather_bit, 'Londn'), False)
+        self.assertIs(new_process_cache.get(Service.weather_bit, 'Kyiv'), True)
+        self.assertIsNone(new_process_cache.get(Service.open_weather, 'Kyiv'))
+
+    def test_names_found_bad_by_other_processes_are_not_requested(self):
+        running_cache = CityValidationCache()
+        self.assertIsNone(running_cache.get(Service.weather_bit, 'Kyiv'))
+        CityValidationCache().set(Service.weather_bit, 'Londn', False)
+        self.assertIs(running_cache.get(Service.weather_bit, 'Londn'), False)
+
+    def test_invalid_names_expire(self):
+        with freeze_time('2023-03-21T00:00:00'):
+            CheckCity('Londn', self.stub.open_weather_url, 'token').check_existing_OpenWeather_city()
+        with freeze_time('2023-03-23T00:00:00'):
+            self.assertIsNone(CityValidationCache().get(Service.open_weather, 'Londn'))
+
+    def test_errors_are_not_cached(self):
+        with self.assertRaises(ProviderUnavailable):
+            city_validation_cache.check(Service.open_weather, 'London', lambda: 502)
+        self.assertFalse(CityValidation.objects.exists())
+        self.assertIsNone(city_validation_cache.get(Service.open_weather, 'London'))
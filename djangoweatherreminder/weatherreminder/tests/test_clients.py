@@ -0,0 +1,187 @@
+import threading
+import time
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from django.core.cache import caches
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+
+from weatherreminder.cache import provider_cache
+from weatherreminder import breaker
+from weatherreminder.clients import AsyncWeatherClient, fetch_fanout, fetch_many, fetch_cities, off_loop
+from weatherreminder.models import User, City, Subscription, Service, Weather
+from weatherreminder.ratelimit import buckets
+from weatherreminder.stub_provider import StubProvider
+from weatherreminder.tasks import refresh_weather_task
+from weatherreminder.utils import OpenWeatherMap, merge_readings
+
+
+class TestOffLoop(SimpleTestCase):
+    async def test_only_shared_stores_leave_the_event_loop(self):
+        loop_thread = threading.get_ident()
+        local = SimpleNamespace(shared=None)
+        shared = SimpleNamespace(shared=caches['default'])
+        self.assertEqual(await off_loop(local, threading.get_ident), loop_thread)
+        self.assertNotEqual(await off_loop(shared, threading.get_ident), loop_thread)
+
+    @patch('weatherreminder.ratelimit.WEATHER_RATE_LIMIT_ALIAS', 'default')
+    async def test_client_with_shared_stores(self):
+        stub = StubProvider().start()
+        self.addCleanup(stub.stop)
+        for cache in (provider_cache, buckets, breaker.breakers, caches['default']):
+            self.addCleanup(cache.clear)
+        breaker.breakers[Service.open_weather] = breaker.CircuitBreaker(Service.open_weather, alias='default')
+        with patch.object(provider_cache, 'alias', 'default'), \
+                patch('weatherreminder.utils.OPEN_WEATHER_API_URL', stub.open_weather_url):
+            async with AsyncWeatherClient() as client:
+                readings = [await client.get_reading('London', Service.open_weather) for _ in range(2)]
+        self.assertEqual(readings[0]['country_code'], 'GB')
+        self.assertEqual(len(stub.requests), 1)
+        self.assertIsNotNone(caches['default'].get(provider_cache.key(Service.open_weather, 'London')))
+
+
+class TestAsyncWeatherClient(TestCase):
+    def setUp(self) -> None:
+        self.stub = StubProvider().start()
+        patchers = [
+            patch('weatherreminder.utils.OPEN_WEATHER_API_URL', self.stub.open_weather_url),
+            patch('weatherreminder.utils.OPEN_WEATHER_GROUP_API_URL', self.stub.open_weather_group_url),
+            patch('weatherreminder.utils.WEATHER_BIT_API_URL', self.stub.weather_bit_url),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(self.stub.stop)
+        self.addCleanup(provider_cache.clear)
+        self.addCleanup(buckets.clear)
+
+    def test_fetch_many(self):
+        results = fetch_many([('London', Service.open_weather), ('New_York', Service.weather_bit),
+                              ('London', Service.open_weather), ('Unknown', Service.open_weather)])
+        self.assertEqual(len(results), 3)
+        self.assertEqual(len(self.stub.requests), 3)
+        self.assertEqual(results['London', Service.open_weather]['country_code'], 'GB')
+        self.assertEqual(results['London', Service.open_weather]['temp'], 9.08)
+        self.assertEqual(results['New_York', Service.weather_bit]['lat'], 40.7143)
+        self.assertEqual(results['New_York', Service.weather_bit]['lon'], -74.006)
+        self.assertIsInstance(results['Unknown', Service.open_weather], Exception)
+
+    def test_refresh_weather_task(self):
+        user = User.objects.create_user(username='test_username', password='test_pass', email='test@mail.com')
+        london = City.objects.create(name='London')
+        unknown = City.objects.create(name='Unknown')
+        for city in (london, unknown):
+            for service, period in ((Service.open_weather, 1), (Service.weather_bit, 3)):
+                Subscription.objects.create(user=user, city=city, period_notifications=period, service=service,
+                                            next_notification_at=timezone.now())
+        with self.assertLogs('weatherreminder.tasks', 'WARNING'):
+            self.assertEqual(refresh_weather_task(), 2)
+        self.assertEqual(len(self.stub.requests), 4)
+        self.assertEqual(Weather.objects.get(city=london, service=Service.weather_bit).humidity, 60)
+        self.assertFalse(Weather.objects.filter(city=unknown).exists())
+
+    def test_refresh_resolves_ids_and_groups_requests(self):
+        user = User.objects.create_user(username='test_username', password='test_pass', email='test@mail.com')
+        cities = [City.objects.create(name=name) for name in ('London', 'New_York', 'Kyiv', 'Lublin', 'Las_Vegas')]
+        for city in cities:
+            Subscription.objects.create(user=user, city=city, period_notifications=1, service=Service.open_weather,
+                                        next_notification_at=timezone.now())
+        Subscription.objects.create(user=user, city=cities[0], period_notifications=1, service=Service.weather_bit,
+                                    next_notification_at=timezone.now())
+        self.assertEqual(refresh_weather_task(), 6)
+        self.assertEqual(len(self.stub.requests), 6)
+        london = City.objects.get(name='London')
+        self.assertEqual((london.open_weather_id, london.lat, london.lon), (2643743, 51.5085, -0.1257))
+
+        self.stub.requests.clear()
+        provider_cache.clear()
+        Weather.objects.update(updated_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(refresh_weather_task(), 6)
+        self.assertEqual(len(self.stub.requests), 2)
+        self.assertEqual(sum('/group?id=' in request for request in self.stub.requests), 1)
+        self.assertTrue(any('lat=51.5085&lon=-0.1257' in request for request in self.stub.requests))
+
+    @patch.object(OpenWeatherMap, 'supports_group', False)
+    def test_services_without_group_requests_are_fetched_one_by_one(self):
+        cities = [City.objects.create(name=name, open_weather_id=city_id)
+                  for name, city_id in (('London', 2643743), ('Kyiv', 703448))]
+        results, _ = fetch_cities([(city, Service.open_weather) for city in cities])
+        self.assertEqual(results['Kyiv', Service.open_weather]['country_code'], 'UA')
+        self.assertEqual(len(self.stub.requests), 2)
+        self.assertFalse(any('/group?' in request for request in self.stub.requests))
+
+    @patch.object(OpenWeatherMap, 'group_size', 2)
+    def test_groups_are_limited_and_missing_ids_fail_alone(self):
+        cities = [City.objects.create(name=name, open_weather_id=city_id)
+                  for name, city_id in (('London', 2643743), ('Kyiv', 703448), ('Nowhere', 1))]
+        results, resolved = fetch_cities([(city, Service.open_weather) for city in cities])
+        self.assertEqual(len(self.stub.requests), 2)
+        self.assertEqual(results['Kyiv', Service.open_weather]['country_code'], 'UA')
+        self.assertIsInstance(results['Nowhere', Service.open_weather], LookupError)
+        self.assertEqual(resolved, [])
+
+
+class TestFanOut(TestCase):
+    def setUp(self) -> None:
+        self.stub = StubProvider(delays={StubProvider.weather_bit_path: 1}).start()
+        patchers = [
+            patch('weatherreminder.utils.OPEN_WEATHER_API_URL', self.stub.open_weather_url),
+            patch('weatherreminder.utils.WEATHER_BIT_API_URL', self.stub.weather_bit_url),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(self.stub.stop)
+        self.addCleanup(provider_cache.clear)
+        self.addCleanup(buckets.clear)
+        self.addCleanup(breaker.breakers.clear)
+
+    def test_fastest_does_not_wait_for_slow_service(self):
+        started = time.monotonic()
+        reading, services = fetch_fanout('London', 'fastest')
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(services, [Service.open_weather])
+        self.assertEqual(reading['temp'], 9.08)
+        self.assertEqual(len(self.stub.requests), 2)
+
+    def test_consensus_merges_readings_within_budget(self):
+        self.stub.delays = {}
+        reading, services = fetch_fanout('London', 'consensus', budget=1)
+        self.assertEqual(services, [Service.open_weather, Service.weather_bit])
+        self.assertEqual(reading, {'country_code': 'GB', 'lat': 51.5085, 'lon': -0.1257,
+                                   'temp': 9.09, 'pressure': 1018.75, 'humidity': 61})
+
+        provider_cache.clear()
+        self.stub.delays = {StubProvider.weather_bit_path: 1}
+        started = time.monotonic()
+        reading, services = fetch_fanout('London', 'consensus', budget=0.3)
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(services, [Service.open_weather])
+
+    def test_services_are_requested_concurrently(self):
+        self.stub.delays = {}
+        self.stub.delay = 0.3
+        started = time.monotonic()
+        fetch_fanout('Kyiv', 'consensus', budget=2)
+        self.assertLess(time.monotonic() - started, 0.55)
+
+    def test_cached_and_unavailable_services_are_not_requested(self):
+        fetch_many([('Kyiv', Service.open_weather)])
+        self.stub.requests.clear()
+        reading, services = fetch_fanout('Kyiv', 'fastest')
+        self.assertEqual(services, [Service.open_weather])
+        self.assertEqual(self.stub.requests, [])
+
+        provider_cache.clear()
+        for _ in range(breaker.WEATHER_BREAKER_FAILURES):
+            breaker.get_breaker(Service.weather_bit).record_failure()
+        reading, services = fetch_fanout('Kyiv', 'consensus')
+        self.assertEqual(services, [Service.open_weather])
+        self.assertTrue(all('/data/2.5/weather' in request for request in self.stub.requests))
+
+    def test_merge_readings_takes_the_median(self):
+        readings = [{'country_code': 'GB', 'lat': 51.5, 'lon': -0.1, 'temp': temp, 'pressure': 1000.0,
+                     'humidity': 60} for temp in (9.0, 10.0, 30.0)]
+        self.assertEqual(merge_readings(readings)['temp'], 10.0)
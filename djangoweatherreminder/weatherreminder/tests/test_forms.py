@@ -56,6 +56,15 @@ class TestForms(TestCase):
         })
         self.assertTrue(form.is_valid())
 
+    def test_ChangeProfileForm_digest_notifications(self):
+        form = ChangeProfileForm(data={
+            'username': 'test_username',
+            'email': 'test_email@mail.com',
+            'digest_notifications': 'on'
+        })
+        self.assertTrue(form.is_valid())
+        self.assertTrue(form.cleaned_data['digest_notifications'])
+
     def test_test_ChangeProfileForm_no_data(self):
         form = ChangeProfileForm({})
         self.assertFalse(form.is_valid())
@@ -0,0 +1,45 @@
+import gzip
+import json
+import os
+import tempfile
+
+from django.test import SimpleTestCase
+
+from weatherreminder.gazetteer import Gazetteer, GazetteerCity, get_gazetteer
+
+
+class TestGazetteer(SimpleTestCase):
+    def setUp(self) -> None:
+        self.gazetteer = Gazetteer([
+            GazetteerCity('Paris', 'FR', 48.8534, 2.3488, 2988507, None),
+            GazetteerCity('Paris', 'US', 33.6609, -95.5555, None, None),
+            GazetteerCity('Lviv', 'UA', 49.8383, 24.0232, None, None),
+            GazetteerCity('Las Vegas', 'US', 36.175, -115.1372, None, None),
+            GazetteerCity('London', 'GB', 51.5085, -0.1257, None, None),
+        ])
+
+    def test_contains(self):
+        self.assertIn('las_vegas', self.gazetteer)
+        self.assertIn('Las%20Vegas', self.gazetteer)
+        self.assertNotIn('Las', self.gazetteer)
+        self.assertEqual([city.country for city in self.gazetteer.get('paris')], ['FR', 'US'])
+
+    def test_search(self):
+        self.assertEqual([city.name for city in self.gazetteer.search('L')], ['Las Vegas', 'London', 'Lviv'])
+        self.assertEqual([city.name for city in self.gazetteer.search('lo')], ['London'])
+        self.assertEqual(len(self.gazetteer.search('l', limit=2)), 2)
+        self.assertEqual(self.gazetteer.search(''), [])
+        self.assertEqual(self.gazetteer.search('x'), [])
+
+    def test_load_open_weather_list(self):
+        data = [{'id': 703448, 'name': 'Kyiv', 'state': '', 'country': 'UA', 'coord': {'lon': 30.5167, 'lat': 50.4333}}]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'city.list.json.gz')
+            with gzip.open(path, 'wt', encoding='utf-8') as file:
+                json.dump(data, file)
+            gazetteer = Gazetteer.load(path)
+        self.assertEqual(gazetteer.get('Kyiv')[0].open_weather_id, 703448)
+
+    def test_bundled_gazetteer(self):
+        self.assertIn('New_York', get_gazetteer())
+        self.assertIn('Kyiv', get_gazetteer())
@@ -0,0 +1,61 @@
+from datetime import date, datetime, timezone
+from unittest.mock import patch
+
+from django.test import TestCase
+from freezegun import freeze_time
+
+from weatherreminder.history import observation, record_observations, downsample_history
+from weatherreminder.models import City, Service, WeatherObservation, WeatherDaily
+
+
+class TestWeatherHistory(TestCase):
+    def setUp(self) -> None:
+        self.city = City.objects.create(name='New_York')
+
+    def observe(self, day, hour, temp, service=Service.open_weather):
+        observed_at = datetime(2023, 3, day, hour, tzinfo=timezone.utc)
+        return observation(self.city.id, service, {'temp': temp, 'pressure': 1000 + hour, 'humidity': 50},
+                           observed_at)
+
+    @freeze_time('2023-03-20T12:00:00Z')
+    def test_old_days_are_rolled_into_aggregates(self):
+        record_observations([self.observe(1, hour, temp) for hour, temp in ((0, 2.0), (12, 8.0), (23, 5.0))] +
+                            [self.observe(1, 12, 1.0, Service.weather_bit), self.observe(2, 6, 3.0),
+                             self.observe(19, 6, 7.0)])
+        self.assertEqual(downsample_history(), {'downsampled': 5, 'pruned': 0})
+        daily = WeatherDaily.objects.get(city=self.city, service=Service.open_weather, date=date(2023, 3, 1))
+        self.assertEqual((daily.temp_min, daily.temp_max, daily.temp_avg, daily.samples), (2.0, 8.0, 5.0, 3))
+        self.assertEqual(WeatherDaily.objects.count(), 3)
+        self.assertEqual(list(WeatherObservation.objects.values_list('temp', flat=True)), [7.0])
+
+    @freeze_time('2023-03-20T12:00:00Z')
+    def test_late_points_are_merged_into_existing_aggregate(self):
+        record_observations([self.observe(1, 0, 2.0), self.observe(1, 1, 4.0)])
+        downsample_history()
+        record_observations([self.observe(1, 2, 9.0)])
+        downsample_history()
+        daily = WeatherDaily.objects.get()
+        self.assertEqual((daily.temp_min, daily.temp_max, daily.temp_avg, daily.samples), (2.0, 9.0, 5.0, 3))
+
+    @freeze_time('2023-03-20T12:00:00Z')
+    def test_rows_are_pruned_in_batches(self):
+        record_observations([self.observe(1, hour, float(hour)) for hour in range(24)])
+        WeatherDaily.objects.create(city=self.city, service=Service.open_weather, date=date(2020, 1, 1), samples=1)
+        with patch('weatherreminder.history.WEATHER_HISTORY_PRUNE_BATCH_SIZE', 5):
+            self.assertEqual(downsample_history(), {'downsampled': 24, 'pruned': 1})
+        self.assertFalse(WeatherObservation.objects.exists())
+        daily = WeatherDaily.objects.get()
+        self.assertEqual((daily.temp_min, daily.temp_max, daily.temp_avg, daily.samples), (0.0, 23.0, 11.5, 24))
+
+    @freeze_time('2023-03-20T12:00:00Z')
+    def test_failed_batch_leaves_committed_batches_consistent(self):
+        record_observations([self.observe(1, hour, float(hour)) for hour in range(10)])
+        with patch('weatherreminder.history.WEATHER_HISTORY_PRUNE_BATCH_SIZE', 5), \
+                patch('weatherreminder.history.merge_daily', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                downsample_history()
+        self.assertEqual(WeatherObservation.objects.count(), 5)
+        self.assertEqual(WeatherDaily.objects.get().samples, 5)
+        downsample_history()
+        self.assertFalse(WeatherObservation.objects.exists())
+        self.assertEqual(WeatherDaily.objects.get().samples, 10)
@@ -0,0 +1,41 @@
+from unittest import skipUnless
+
+from django.db import connection
+from django.test import TestCase
+
+from weatherreminder.models import User, City, Subscription, Service, Weather
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Query plans are checked on PostgreSQL only')
+class TestLookupIndexes(TestCase):
+    def setUp(self) -> None:
+        self.user = User.objects.create_user(username='test_username', password='test_pass', email='test@mail.com')
+        self.city = City.objects.create(name='New_York')
+        Subscription.objects.create(user=self.user, city=self.city, period_notifications=1,
+                                    service=Service.open_weather)
+        Weather.objects.create(city=self.city, city_name=self.city.name, service=Service.open_weather)
+        with connection.cursor() as cursor:
+            # Tiny test tables are cheaper to scan, make the planner show which index it would use
+            cursor.execute('SET LOCAL enable_seqscan = off')
+
+    def assertUsesIndex(self, queryset, index=None):
+        plan = queryset.explain()
+        self.assertNotIn('Seq Scan', plan)
+        self.assertIn('Index', plan)
+        if index is not None:
+            self.assertIn(index, plan)
+
+    def test_weather_lookups(self):
+        self.assertUsesIndex(Weather.objects.filter(city=self.city, service=Service.open_weather))
+        self.assertUsesIndex(Weather.objects.filter(city_name=self.city.name, service=Service.open_weather),
+                             'weather_city_name_service')
+
+    def test_subscription_lookups(self):
+        # The single-column foreign key indexes may win on tiny tables, so only the scan type is checked
+        self.assertUsesIndex(Subscription.objects.filter(user=self.user, service=Service.open_weather))
+        self.assertUsesIndex(Subscription.objects.filter(city=self.city, service=Service.open_weather))
+        self.assertUsesIndex(Subscription.objects.filter(user=self.user, city=self.city,
+                                                         service=Service.open_weather))
+
+    def test_city_iexact_lookup(self):
+        self.assertUsesIndex(City.objects.filter(name__iexact='new_york'), 'city_upper_name')
@@ -0,0 +1,126 @@
+import smtplib
+from unittest.mock import patch
+
+from django.core import mail
+from django.core.mail import EmailMessage
+from django.core.mail.backends.locmem import EmailBackend
+from django.test import TestCase
+
+from weatherreminder.mail import PooledMailer
+from weatherreminder.notifications import NotificationRenderer, render_message
+from weatherreminder.models import User, City, Subscription, Service, Weather
+from weatherreminder.tasks import send_notifications_task, send_digests_task
+
+
+class CountingBackend(EmailBackend):
+    opened = 0
+    fail_next = 0
+    refused = set()
+
+    def open(self):
+        CountingBackend.opened += 1
+        return True
+
+    def send_messages(self, messages):
+        if CountingBackend.fail_next:
+            CountingBackend.fail_next -= 1
+            raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+        for message in messages:
+            refused = CountingBackend.refused.intersection(message.to)
+            if refused:
+                raise smtplib.SMTPRecipientsRefused({address: (550, b'No such user') for address in refused})
+        return super().send_messages(messages)
+
+
+class TestPooledMailer(TestCase):
+    def setUp(self) -> None:
+        CountingBackend.opened = 0
+        CountingBackend.fail_next = 0
+        CountingBackend.refused = set()
+        self.mailer = PooledMailer(batch_size=2, backend='weatherreminder.tests.test_mail.CountingBackend')
+        self.messages = [EmailMessage('Weather notification', 'body', 'from@mail.com', [f'{i}@mail.com'])
+                         for i in range(5)]
+
+    def test_connection_is_reused(self):
+        self.assertEqual(self.mailer.send(self.messages[:2]), 2)
+        self.assertEqual(self.mailer.send(self.messages[2:]), 3)
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(CountingBackend.opened, 3)
+
+    def test_reconnect_on_failure(self):
+        CountingBackend.fail_next = 1
+        self.assertEqual(self.mailer.send(self.messages[:1]), 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(CountingBackend.opened, 2)
+
+    def test_failure_after_reconnect(self):
+        CountingBackend.fail_next = 2
+        with self.assertLogs('weatherreminder.mail', 'WARNING'):
+            self.assertEqual(self.mailer.send(self.messages[:1]), 0)
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_refused_message_does_not_stop_the_batch(self):
+        CountingBackend.refused = {'2@mail.com'}
+        with self.assertLogs('weatherreminder.mail', 'WARNING') as logs:
+            self.assertEqual(self.mailer.send(self.messages), 4)
+        self.assertIn('2@mail.com', logs.output[0])
+        self.assertEqual([message.to for message in mail.outbox],
+                         [['0@mail.com'], ['1@mail.com'], ['3@mail.com'], ['4@mail.com']])
+
+
+class TestSendNotificationsTask(TestCase):
+    def setUp(self) -> None:
+        self.city = City.objects.create(name='New_York')
+        self.weather = Weather.objects.create(city=self.city, city_name=self.city.name, service=Service.open_weather,
+                               country_code='US', lat=40.7143, lon=-74.006, temp=14.6, pressure=1028,
+                               humidity=21)
+        self.subscriptions = []
+        for i in range(3):
+            user = User.objects.create_user(username=f'test_username_{i}', password='test_pass',
+                                            email=f'test_{i}@mail.com')
+            self.subscriptions.append(Subscription.objects.create(
+                user=user, city=self.city, period_notifications=[1, 3, 6][i], service=Service.open_weather))
+
+    def test_send_batch(self):
+        self.assertEqual(send_notifications_task([s.id for s in self.subscriptions] + [50]), 3)
+        self.assertCountEqual([message.to[0] for message in mail.outbox],
+                              ['test_0@mail.com', 'test_1@mail.com', 'test_2@mail.com'])
+        self.assertIn('New York', mail.outbox[0].body)
+
+    def test_send_batch_queries(self):
+        with self.assertNumQueries(2):
+            send_notifications_task([s.id for s in self.subscriptions])
+
+    @patch('weatherreminder.notifications.render_message', wraps=render_message)
+    def test_template_rendered_once_per_weather_refresh(self, render_mock):
+        renderer = NotificationRenderer()
+        subscriptions = Subscription.objects.select_related('user', 'city').order_by('pk')
+        bodies = [renderer.render(subscription, self.weather) for subscription in subscriptions]
+        self.assertEqual(render_mock.call_count, 1)
+        self.assertIn('test_1@mail.com', bodies[1])
+        self.assertIn('every 3 hours', bodies[1])
+        self.assertNotIn('test_0@mail.com', bodies[1])
+        self.assertEqual(bodies[0].replace('test_0@mail.com', 'test_2@mail.com').replace('every 1 hours', 'every 6 hours'),
+                         bodies[2])
+        self.weather.temp = 15.1
+        self.weather.save()
+        self.assertIn('15.1с', renderer.render(subscriptions[0], self.weather))
+        self.assertEqual(render_mock.call_count, 2)
+
+    def test_send_digests(self):
+        london = City.objects.create(name='London')
+        Weather.objects.create(city=london, city_name=london.name, service=Service.open_weather,
+                               country_code='GB', lat=51.5085, lon=-0.1257, temp=9.1, pressure=1018,
+                               humidity=60)
+        user = self.subscriptions[0].user
+        user.digest_notifications = True
+        user.save()
+        london_subscription = Subscription.objects.create(user=user, city=london, period_notifications=12,
+                                                          service=Service.open_weather)
+        sent = send_digests_task([self.subscriptions[0].id, london_subscription.id, self.subscriptions[1].id])
+        self.assertEqual(sent, 2)
+        digest = next(message for message in mail.outbox if message.to == ['test_0@mail.com'])
+        self.assertIn('City: New York, London', digest.body)
+        self.assertIn('every 12 hours', digest.body)
+        self.assertIn('9.1с', digest.body)
+        self.assertIn('14.6с', digest.body)
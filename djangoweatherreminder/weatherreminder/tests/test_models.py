@@ -1,6 +1,7 @@
 from django.test import TestCase, Client, override_settings
 from freezegun.api import freeze_time
 
+from weatherreminder.formatting import format_weather, weather_reading
 from weatherreminder.models import User, City, Subscription, Service, Weather
 
 
@@ -22,39 +23,48 @@ class TestModels(TestCase):
             city_name=self.city.name,
             service="OpenWeatherMap",
             country_code='US',
-            coordinate='-74.006 40.7143',
-            temp='14.6с',
-            pressure='1028',
-            humidity='21%'
+            lat=40.7143,
+            lon=-74.006,
+            temp=14.6,
+            pressure=1028,
+            humidity=21
         )
 
     def test_User_model(self):
-        self.test_user = User.objects.get(pk=1)
+        self.test_user = User.objects.get(pk=self.user.pk)
         self.assertEqual(self.test_user.username, 'test_username')
         self.assertEqual(self.test_user.email, 'test@mail.com')
 
     def test_City_model(self):
-        self.test_city = City.objects.get(pk=1)
+        self.test_city = City.objects.get(pk=self.city.pk)
         self.assertEqual(self.city.name, 'New_York')
         self.assertEqual(len(self.city.users.all()), 1)
 
     def test_Subscription_model(self):
-        self.test_subscription = Subscription.objects.get(pk=1)
+        self.test_subscription = Subscription.objects.get(pk=self.subsciption.pk)
         self.assertEqual(self.test_subscription.user, self.user)
         self.assertEqual(self.test_subscription.city, self.city)
         self.assertEqual(self.test_subscription.period_notifications, 1)
         self.assertEqual(self.test_subscription.service, Service.open_weather)
 
     def test_Weather_model(self):
-        self.test_weather = Weather.objects.get(pk=1)
+        self.test_weather = Weather.objects.get(pk=self.weather.pk)
         self.assertEqual(self.test_weather.city, self.city)
         self.assertEqual(self.test_weather.city_name, 'New_York')
         self.assertEqual(self.test_weather.service, Service.open_weather)
         self.assertEqual(self.test_weather.country_code, 'US')
-        self.assertEqual(self.test_weather.coordinate, '-74.006 40.7143')
-        self.assertEqual(self.test_weather.temp, '14.6с')
-        self.assertEqual(self.test_weather.pressure, '1028')
-        self.assertEqual(self.test_weather.humidity, '21%')
+        self.assertEqual(self.test_weather.lat, 40.7143)
+        self.assertEqual(self.test_weather.lon, -74.006)
+        self.assertEqual(self.test_weather.temp, 14.6)
+        self.assertEqual(self.test_weather.pressure, 1028)
+        self.assertEqual(self.test_weather.humidity, 21)
+
+    def test_Weather_formatting(self):
+        formatted = format_weather(weather_reading(Weather.objects.get(pk=self.weather.pk)))
+        self.assertEqual(formatted['coordinate'], '-74.006 40.7143')
+        self.assertEqual(formatted['temp'], '14.6с')
+        self.assertEqual(formatted['pressure'], '1028')
+        self.assertEqual(formatted['humidity'], '21%')
 
 
 
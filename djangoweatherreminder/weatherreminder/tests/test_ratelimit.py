@@ -0,0 +1,72 @@
+from unittest.mock import patch
+
+from django.core.cache import caches
+from django.test import TestCase
+
+from weatherreminder.cache import city_validation_cache
+from weatherreminder.models import Service
+from weatherreminder.ratelimit import TokenBucket, RateLimited, get_bucket, buckets
+from weatherreminder.utils import CheckCity
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTokenBucket(TestCase):
+    def setUp(self) -> None:
+        self.timer = FakeTimer()
+
+    def test_bursts_are_smoothed_to_rate(self):
+        bucket = TokenBucket('test', rate=2, burst=3, timer=self.timer)
+        self.assertEqual([bucket.reserve() for _ in range(3)], [0, 0, 0])
+        self.assertEqual([bucket.reserve() for _ in range(3)], [0.5, 1.0, 1.5])
+        self.timer.now += 10
+        self.assertEqual(bucket.reserve(), 0)
+
+    def test_max_wait(self):
+        bucket = TokenBucket('test', rate=1, burst=1, timer=self.timer)
+        bucket.reserve()
+        with self.assertRaises(RateLimited):
+            bucket.reserve(max_wait=0.5)
+        self.assertEqual(bucket.reserve(max_wait=1), 1)
+
+    def test_state_is_shared_through_cache(self):
+        self.addCleanup(caches['default'].clear)
+        first = TokenBucket('shared', rate=1, burst=1, alias='default', timer=self.timer)
+        second = TokenBucket('shared', rate=1, burst=1, alias='default', timer=self.timer)
+        self.assertEqual(first.reserve(), 0)
+        self.assertEqual(second.reserve(), 1)
+        self.assertIsNone(caches['default'].get('ratelimit:shared:lock'))
+
+    def test_buckets_per_api_key(self):
+        self.addCleanup(buckets.clear)
+        self.assertIs(get_bucket(Service.open_weather, 'key'), get_bucket(Service.open_weather, 'key'))
+        self.assertIsNot(get_bucket(Service.open_weather, 'key'), get_bucket(Service.open_weather, 'other'))
+        self.assertNotIn('key', get_bucket(Service.open_weather, 'key').name)
+
+    @patch.dict('weatherreminder.ratelimit.WEATHER_RATE_LIMITS', {'premium': {'per_minute': 600, 'burst': 50}})
+    @patch('weatherreminder.ratelimit.WEATHER_RATE_LIMIT_DEFAULT', {'per_minute': 6, 'burst': 1})
+    def test_limits_by_key_service_and_default(self):
+        self.addCleanup(buckets.clear)
+        self.assertEqual(get_bucket(Service.weather_bit, 'premium').burst, 50)
+        self.assertEqual(get_bucket(Service.weather_bit, 'key').burst, 5)
+        # A registered provider without limits in settings
+        self.assertEqual(get_bucket('NewProvider', 'key').burst, 1)
+        self.assertEqual(get_bucket('NewProvider', 'key').interval, 10)
+
+    @patch('weatherreminder.utils.http_session.get')
+    def test_city_check_is_not_sent_over_quota(self, get_mock):
+        self.addCleanup(buckets.clear)
+        bucket = get_bucket(Service.weather_bit, 'limited')
+        for _ in range(bucket.burst):
+            bucket.reserve()
+        with patch('weatherreminder.ratelimit.WEATHER_RATE_LIMIT_MAX_WAIT', 0):
+            with self.assertRaises(RateLimited):
+                CheckCity('London', 'http://weather.bit', 'limited').check_existing_WeatherBit_city()
+        get_mock.assert_not_called()
+        self.assertIsNone(city_validation_cache.get(Service.weather_bit, 'London'))
@@ -0,0 +1,148 @@
+import tempfile
+import time
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.core.cache import caches
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+
+from djangoweatherreminder.celery import app
+from weatherreminder.models import User, City, Subscription, Service, SubscriptionTask
+from weatherreminder.schedule_events import ScheduleEvents, schedule_events
+from weatherreminder.scheduler import DueHeap, HeapScheduler
+from weatherreminder.tasks import dispatch_notifications_task
+
+
+class TestDueHeap(SimpleTestCase):
+    def test_due_keys_are_popped_in_order(self):
+        due = DueHeap([(1, 30.0), (2, 10.0), (3, 20.0)])
+        due.set(4, 5.0)
+        self.assertEqual(due.peek(), 5.0)
+        self.assertEqual(due.pop_due(20.0), [4, 2, 3])
+        self.assertEqual(len(due), 1)
+        self.assertEqual(due.pop_due(20.0), [])
+
+    def test_changed_and_removed_keys_are_skipped(self):
+        due = DueHeap([(1, 10.0), (2, 20.0)])
+        due.set(1, 40.0)
+        due.remove(2)
+        self.assertEqual(due.peek(), 40.0)
+        self.assertEqual(due.pop_due(30.0), [])
+        self.assertEqual(due.pop_due(40.0), [1])
+
+    def test_stale_entries_are_bounded(self):
+        due = DueHeap()
+        for i in range(5000):
+            due.set(1, float(i))
+        self.assertLess(len(due.heap), 2000)
+        self.assertEqual(due.pop_due(5000.0), [1])
+
+
+class TestScheduleEvents(TestCase):
+    def test_read_after_cursor(self):
+        events = ScheduleEvents(alias=None)
+        now = timezone.now()
+        with self.captureOnCommitCallbacks(execute=True):
+            events.publish([(1, now)])
+            events.publish([(2, None), (3, now)])
+        changes, cursor = events.read(0)
+        self.assertEqual(changes, [(1, now.timestamp()), (2, None), (3, now.timestamp())])
+        self.assertEqual(cursor, 2)
+        self.assertEqual(events.read(cursor), ([], 2))
+        events.clear()
+        self.assertEqual(events.read(cursor), ([], None))
+
+    def test_shared_log_stops_at_missing_batch(self):
+        self.addCleanup(caches['default'].clear)
+        events = ScheduleEvents(alias='default')
+        now = timezone.now()
+        with self.captureOnCommitCallbacks(execute=True):
+            events.publish([(1, now)])
+        # A writer that has taken the number and not stored its batch yet
+        caches['default'].incr('schedule-events:counter')
+        with self.captureOnCommitCallbacks(execute=True):
+            events.publish([(3, now)])
+        self.assertEqual(events.read(0), ([(1, now.timestamp())], 1))
+        self.assertEqual(events.last(), 3)
+
+
+class TestHeapScheduler(TestCase):
+    def setUp(self) -> None:
+        self.user = User.objects.create_user(username='test_username', password='test_pass', email='test@mail.com')
+        city = City.objects.create(name='London')
+        self.subscription = Subscription.objects.create(
+            user=self.user, city=city, service=Service.open_weather, period_notifications=1,
+            next_notification_at=timezone.now() + timedelta(hours=1),
+        )
+        schedule_events.clear()
+        self.addCleanup(schedule_events.clear)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        for method in ('apply_entry', 'send_task'):
+            patcher = patch.object(HeapScheduler, method)
+            setattr(self, method, patcher.start())
+            self.addCleanup(patcher.stop)
+        self.scheduler = HeapScheduler(app, schedule_filename=f'{directory.name}/celerybeat-schedule')
+        self.addCleanup(self.scheduler.close)
+
+    def dispatches(self):
+        return [call for call in self.send_task.call_args_list if call.args == ('dispatch_notifications_task',)]
+
+    def test_sleeps_until_first_due_subscription(self):
+        self.assertEqual(len(self.scheduler.due), 1)
+        self.assertLessEqual(self.scheduler.tick(), 5)
+        self.assertEqual(self.dispatches(), [])
+
+    def test_changes_are_applied_without_reload(self):
+        with patch.object(HeapScheduler, 'load_due') as load_due:
+            self.subscription.next_notification_at = None
+            self.subscription.period_notifications = 3
+            with self.captureOnCommitCallbacks(execute=True):
+                SubscriptionTask(self.subscription).create_task()
+                other = Subscription.objects.create(user=self.user, city=City.objects.create(name='Kyiv'),
+                                                    service=Service.weather_bit, period_notifications=6)
+                SubscriptionTask(other).create_task()
+            self.scheduler.tick()
+            self.assertEqual(self.scheduler.due.due, {
+                self.subscription.pk: self.subscription.next_notification_at.timestamp(),
+                other.pk: other.next_notification_at.timestamp(),
+            })
+            with self.captureOnCommitCallbacks(execute=True):
+                SubscriptionTask(other).delete_task()
+            self.scheduler.tick()
+            self.assertEqual(list(self.scheduler.due.due), [self.subscription.pk])
+        load_due.assert_not_called()
+
+    def test_due_subscription_triggers_dispatch_once(self):
+        Subscription.objects.filter(pk=self.subscription.pk).update(next_notification_at=timezone.now())
+        with self.captureOnCommitCallbacks(execute=True):
+            schedule_events.publish([(self.subscription.pk, timezone.now())])
+        self.scheduler.tick()
+        self.scheduler.tick()
+        self.assertEqual(len(self.dispatches()), 1)
+
+        with patch('weatherreminder.tasks.send_notifications_task.delay'), \
+                self.captureOnCommitCallbacks(execute=True):
+            dispatch_notifications_task()
+        self.scheduler.tick()
+        self.subscription.refresh_from_db()
+        self.assertEqual(self.scheduler.due.due,
+                         {self.subscription.pk: self.subscription.next_notification_at.timestamp()})
+
+    @patch('weatherreminder.scheduler.NOTIFICATION_EVENTS_GAP_TIMEOUT', 0)
+    def test_lost_changes_reload_due_times(self):
+        schedule_events.counter += 1
+        self.scheduler.tick()
+        self.assertEqual(self.scheduler.cursor, 0)
+        Subscription.objects.all().delete()
+        time.sleep(0.01)
+        self.scheduler.tick()
+        self.assertEqual(self.scheduler.cursor, 1)
+        self.assertEqual(len(self.scheduler.due), 0)
+
+    def test_rolled_back_changes_are_not_published(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            SubscriptionTask(self.subscription).edit_task()
+        self.assertEqual(schedule_events.last(), 0)
+        self.assertEqual(len(callbacks), 1)
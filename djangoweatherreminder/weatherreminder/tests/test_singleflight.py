@@ -0,0 +1,87 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+from django.core.cache import caches
+from django.test import SimpleTestCase
+
+from weatherreminder.breaker import breakers
+from weatherreminder.cache import provider_cache
+from weatherreminder.ratelimit import buckets
+from weatherreminder.singleflight import SingleFlight
+from weatherreminder.stub_provider import StubProvider
+from weatherreminder.utils import OpenWeatherMap
+
+
+class TestSingleFlight(SimpleTestCase):
+    def setUp(self) -> None:
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def slow_call(self):
+        self.calls += 1
+        self.started.set()
+        self.release.wait(5)
+        return {'temp': 9.08}
+
+    def run_concurrently(self, flight, function, callers=8):
+        with ThreadPoolExecutor(callers) as executor:
+            futures = [executor.submit(flight.do, 'key', function) for _ in range(callers)]
+            self.started.wait(5)
+            threading.Event().wait(0.1)
+            self.release.set()
+            return futures
+
+    def test_concurrent_calls_share_one_result(self):
+        futures = self.run_concurrently(SingleFlight(alias=None), self.slow_call)
+        self.assertEqual([future.result() for future in futures], [{'temp': 9.08}] * 8)
+        self.assertEqual(self.calls, 1)
+
+    def test_concurrent_calls_share_the_exception(self):
+        def failing_call():
+            self.slow_call()
+            raise ConnectionError('provider is down')
+
+        futures = self.run_concurrently(SingleFlight(alias=None), failing_call)
+        for future in futures:
+            self.assertIsInstance(future.exception(), ConnectionError)
+        self.assertEqual(self.calls, 1)
+
+    def test_other_process_result_is_shared_through_cache(self):
+        self.addCleanup(caches['default'].clear)
+        shared = {}
+        caches['default'].add('singleflight:key', 'other process', 5)
+        timer = threading.Timer(0.1, shared.update, kwargs={'result': 'from other process'})
+        timer.start()
+        self.addCleanup(timer.cancel)
+        result = SingleFlight(alias='default').do('key', self.slow_call, lookup=lambda: shared.get('result'))
+        self.assertEqual(result, 'from other process')
+        self.assertEqual(self.calls, 0)
+
+    def test_call_is_made_when_other_process_gives_up(self):
+        self.addCleanup(caches['default'].clear)
+        caches['default'].add('singleflight:key', 'other process', 5)
+        threading.Timer(0.1, caches['default'].delete, args=['singleflight:key']).start()
+        self.release.set()
+        result = SingleFlight(alias='default').do('key', self.slow_call, lookup=lambda: None)
+        self.assertEqual(result, {'temp': 9.08})
+        self.assertEqual(self.calls, 1)
+
+
+class TestCoalescedWeatherRequests(SimpleTestCase):
+    def setUp(self) -> None:
+        self.stub = StubProvider(delay=0.2).start()
+        patcher = patch('weatherreminder.utils.OPEN_WEATHER_API_URL', self.stub.open_weather_url)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.stub.stop)
+        for cleanup in (provider_cache.clear, buckets.clear, breakers.clear):
+            self.addCleanup(cleanup)
+
+    def test_concurrent_requests_for_one_city(self):
+        with ThreadPoolExecutor(10) as executor:
+            readings = list(executor.map(lambda _: OpenWeatherMap(city='London').get_weather_reading('token'),
+                                         range(10)))
+        self.assertEqual(len(self.stub.requests), 1)
+        self.assertEqual({reading['country_code'] for reading in readings}, {'GB'})
@@ -0,0 +1,184 @@
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+import pytz
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from freezegun import freeze_time
+
+from weatherreminder.models import User, City, Subscription, Service, Weather, SubscriptionTask, \
+    WeatherObservation, next_notification_time
+from weatherreminder.tasks import dispatch_notifications_task, refresh_weather_task, get_weather_task, \
+    fetch_missing_weather_task, refresh_plan
+
+
+class TestNotificationsDispatcher(TestCase):
+    def setUp(self) -> None:
+        self.user = User.objects.create_user(username='test_username', password='test_pass', email='test@mail.com')
+        self.city = City.objects.create(name='New_York')
+        self.weather = Weather.objects.create(
+            city=self.city,
+            city_name=self.city.name,
+            service="OpenWeatherMap",
+            country_code='US',
+            lat=40.7143,
+            lon=-74.006,
+            temp=14.6,
+            pressure=1028,
+            humidity=21
+        )
+
+    def test_next_notification_time(self):
+        # 2023-03-21 10:20 UTC is 12:20 in Kyiv
+        after = datetime(2023, 3, 21, 10, 20, tzinfo=pytz.utc)
+        self.assertEqual(next_notification_time(1, after), datetime(2023, 3, 21, 11, 0, tzinfo=pytz.utc))
+        self.assertEqual(next_notification_time(3, after), datetime(2023, 3, 21, 13, 0, tzinfo=pytz.utc))
+        self.assertEqual(next_notification_time(12, after), datetime(2023, 3, 21, 22, 0, tzinfo=pytz.utc))
+
+    @freeze_time('2023-03-21T10:20:00+00:00')
+    def test_create_task_schedules_subscription(self):
+        subscription = Subscription.objects.create(user=self.user, city=self.city, period_notifications=3,
+                                                   service=Service.open_weather)
+        SubscriptionTask(subscription).create_task()
+        subscription.refresh_from_db()
+        self.assertEqual(subscription.next_notification_at, datetime(2023, 3, 21, 13, 0, tzinfo=pytz.utc))
+
+    @override_settings(NOTIFICATION_DISPATCH_BATCH_SIZE=2)
+    @freeze_time('2023-03-21T10:20:00+00:00')
+    @patch('weatherreminder.tasks.send_notifications_task.delay')
+    def test_dispatch_due_subscriptions(self, delay_mock):
+        due = []
+        for period in (1, 3, 6):
+            user = User.objects.create_user(username=f'test_username_{period}', password='test_pass',
+                                            email=f'{period}@mail.com')
+            due.append(Subscription.objects.create(
+                user=user, city=self.city, period_notifications=period, service=Service.open_weather,
+                next_notification_at=datetime(2023, 3, 21, 10, 0, tzinfo=pytz.utc)))
+        not_due = Subscription.objects.create(
+            user=self.user, city=self.city, period_notifications=1, service=Service.weather_bit,
+            next_notification_at=datetime(2023, 3, 21, 11, 0, tzinfo=pytz.utc))
+
+        self.assertEqual(dispatch_notifications_task(), 3)
+        self.assertEqual(delay_mock.call_count, 2)
+        dispatched = [sub_id for call in delay_mock.call_args_list for sub_id in call.args[0]]
+        self.assertCountEqual(dispatched, [s.id for s in due])
+        for subscription in due:
+            subscription.refresh_from_db()
+            self.assertGreater(subscription.next_notification_at, datetime(2023, 3, 21, 10, 20, tzinfo=pytz.utc))
+        self.assertEqual(Subscription.objects.get(pk=not_due.pk).next_notification_at,
+                         datetime(2023, 3, 21, 11, 0, tzinfo=pytz.utc))
+
+    @freeze_time('2023-03-21T10:20:00+00:00')
+    @patch('weatherreminder.tasks.send_digests_task.delay')
+    @patch('weatherreminder.tasks.send_notifications_task.delay')
+    def test_dispatch_digest_users(self, delay_mock, digest_mock):
+        digest_user = User.objects.create_user(username='digest_username', password='test_pass',
+                                               email='digest@mail.com', digest_notifications=True)
+        london = City.objects.create(name='London')
+        due = datetime(2023, 3, 21, 10, 0, tzinfo=pytz.utc)
+        single = Subscription.objects.create(user=self.user, city=self.city, period_notifications=1,
+                                             service=Service.open_weather, next_notification_at=due)
+        digest = [Subscription.objects.create(user=digest_user, city=city, period_notifications=1,
+                                              service=service, next_notification_at=due)
+                  for city in (self.city, london) for service in (Service.open_weather, Service.weather_bit)]
+        self.assertEqual(dispatch_notifications_task(), 5)
+        delay_mock.assert_called_once_with([single.id])
+        digest_mock.assert_called_once()
+        self.assertCountEqual(digest_mock.call_args.args[0], [s.id for s in digest])
+
+    @patch('weatherreminder.tasks.send_notifications_task.delay')
+    def test_dispatch_nothing_due(self, delay_mock):
+        Subscription.objects.create(user=self.user, city=self.city, period_notifications=1,
+                                    service=Service.open_weather,
+                                    next_notification_at=datetime.now(tz=pytz.utc) + timedelta(hours=1))
+        self.assertEqual(dispatch_notifications_task(), 0)
+        delay_mock.assert_not_called()
+
+
+class TestWeatherRefresh(TestCase):
+    def setUp(self) -> None:
+        self.user1 = User.objects.create_user(username='test_username_1', password='test_pass', email='1@mail.com')
+        self.user2 = User.objects.create_user(username='test_username_2', password='test_pass', email='2@mail.com')
+        self.city = City.objects.create(name='New_York')
+        self.fake_weather = {'country_code': 'US', 'lat': 40.7143, 'lon': -74.006,
+                             'temp': 9.08, 'pressure': 1019.0, 'humidity': 62}
+        self.due = timezone.now() + timedelta(minutes=15)
+
+    @patch('weatherreminder.tasks.fetch_cities')
+    def test_refresh_once_per_city_and_service(self, fetch_mock):
+        fetch_mock.return_value = ({('New_York', Service.open_weather): self.fake_weather,
+                                   ('New_York', Service.weather_bit): self.fake_weather}, [])
+        user3 = User.objects.create_user(username='test_username_3', password='test_pass', email='3@mail.com')
+        for user, period in ((self.user1, 1), (self.user2, 12), (user3, 12)):
+            Subscription.objects.create(user=user, city=self.city, period_notifications=period,
+                                        service=Service.open_weather, next_notification_at=self.due)
+        Subscription.objects.create(user=self.user1, city=self.city, period_notifications=3,
+                                    service=Service.weather_bit, next_notification_at=self.due)
+        self.assertEqual(refresh_weather_task(), 2)
+        fetch_mock.assert_called_once()
+        self.assertCountEqual(fetch_mock.call_args.args[0],
+                              [(self.city, Service.open_weather), (self.city, Service.weather_bit)])
+        self.assertEqual(Weather.objects.filter(city=self.city).count(), 2)
+        self.assertEqual(WeatherObservation.objects.filter(city=self.city).count(), 2)
+
+    @patch('weatherreminder.tasks.fetch_cities')
+    def test_refresh_upserts_weather_in_bulk(self, fetch_mock):
+        cities = [City.objects.create(name=f'City_{index}') for index in range(30)]
+        for city in cities:
+            Subscription.objects.create(user=self.user1, city=city, period_notifications=1,
+                                        service=Service.open_weather, next_notification_at=self.due)
+        Weather.objects.create(city=cities[0], city_name=cities[0].name, service=Service.open_weather, temp=1.0)
+        Weather.objects.update(updated_at=timezone.now() - timedelta(hours=1))
+        fetch_mock.return_value = ({(city.name, Service.open_weather): self.fake_weather for city in cities}, [])
+        with self.assertNumQueries(4):
+            self.assertEqual(refresh_weather_task(), 30)
+        self.assertEqual(Weather.objects.count(), 30)
+        self.assertEqual(Weather.objects.get(city=cities[0]).temp, 9.08)
+
+    def test_refresh_plan_fetches_ahead_of_notifications_and_old_weather(self):
+        now = timezone.now()
+        later, fresh, stale, old = (City.objects.create(name=name) for name in ('Later', 'Fresh', 'Stale', 'Old'))
+        Subscription.objects.create(user=self.user1, city=self.city, period_notifications=1,
+                                    service=Service.open_weather, next_notification_at=now + timedelta(minutes=20))
+        # The earliest subscriber of a pair decides when it is fetched
+        Subscription.objects.create(user=self.user2, city=self.city, period_notifications=12,
+                                    service=Service.open_weather, next_notification_at=now + timedelta(hours=6))
+        # Not scheduled and without weather
+        Subscription.objects.create(user=self.user1, city=self.city, period_notifications=6,
+                                    service=Service.weather_bit)
+        for city, due in ((fresh, timedelta(minutes=10)), (stale, timedelta(minutes=10)),
+                          (later, timedelta(hours=6)), (old, timedelta(hours=6))):
+            Subscription.objects.create(user=self.user1, city=city, period_notifications=12,
+                                        service=Service.open_weather, next_notification_at=now + due)
+            Weather.objects.create(city=city, city_name=city.name, service=Service.open_weather)
+        Weather.objects.filter(city=stale).update(updated_at=now - timedelta(minutes=30))
+        Weather.objects.filter(city=old).update(updated_at=now - timedelta(hours=4))
+
+        with self.assertNumQueries(1):
+            pairs, subscribed = refresh_plan(now, timedelta(minutes=30), timedelta(hours=3))
+        self.assertCountEqual(pairs, [(self.city.id, Service.open_weather), (self.city.id, Service.weather_bit),
+                                      (stale.id, Service.open_weather), (old.id, Service.open_weather)])
+        self.assertEqual(subscribed, 6)
+
+    @patch('weatherreminder.tasks.fetch_cities')
+    def test_fetch_missing_weather_skips_existing_pairs(self, fetch_mock):
+        Weather.objects.create(city=self.city, city_name=self.city.name, service=Service.open_weather)
+        fetch_mock.return_value = ({('New_York', Service.weather_bit): self.fake_weather}, [])
+        self.assertEqual(fetch_missing_weather_task([[self.city.id, Service.open_weather],
+                                                     [self.city.id, Service.weather_bit], [1000, Service.weather_bit]]), 1)
+        self.assertEqual(list(fetch_mock.call_args.args[0]), [(self.city, Service.weather_bit)])
+
+    @patch('weatherreminder.utils.OpenWeatherMap.get_weather_reading')
+    def test_get_weather_task_creates_and_updates_weather(self, mixin_mock):
+        mixin_mock.return_value = self.fake_weather
+        get_weather_task(self.city.id, Service.open_weather)
+        self.fake_weather['temp'] = 11.5
+        get_weather_task(self.city.id, Service.open_weather)
+        weather = Weather.objects.get(city=self.city, service=Service.open_weather)
+        self.assertEqual(weather.temp, 11.5)
+        self.assertEqual(Weather.objects.count(), 1)
+
+    @patch('weatherreminder.utils.OpenWeatherMap.get_weather_reading')
+    def test_get_weather_task_deleted_city(self, mixin_mock):
+        get_weather_task(50, Service.open_weather)
+        mixin_mock.assert_not_called()
@@ -1,10 +1,23 @@
 from unittest.mock import patch
 
+import requests
+
 from django.test import TestCase, Client, override_settings
 from django.urls import reverse
 from freezegun import freeze_time
 from rest_framework import status
+from weatherreminder import breaker, ratelimit
+from weatherreminder.cache import city_validation_cache, provider_cache
 from weatherreminder.models import User, City, Subscription, Weather, Service
+from weatherreminder.ratelimit import RateLimited
+from weatherreminder.stub_provider import StubProvider
+from weatherreminder.views import OpenWeatherView
+
+
+def not_found():
+    response = requests.Response()
+    response.status_code = 404
+    return requests.HTTPError(response=response)
 
 
 class TestOpenWeatherMapViews(TestCase):
@@ -29,15 +42,16 @@ class TestOpenWeatherMapViews(TestCase):
             city_name=self.city1.name,
             service="OpenWeatherMap",
             country_code='US',
-            coordinate='-74.006 40.7143',
-            temp='14.6с',
-            pressure='1028',
-            humidity='21%'
+            lat=40.7143,
+            lon=-74.006,
+            temp=14.6,
+            pressure=1028,
+            humidity=21
         )
 
         self.client.login(username='test_username_1', password='test_password')
-        self.fake_weather = {'city': 'Lublin', 'country_code': 'US', 'coordinate': '-115.1372 36.175', 'temp': '9.08с',
-                             'pressure': '1019', 'humidity': '62%'}
+        self.fake_weather = {'country_code': 'US', 'lat': 36.175, 'lon': -115.1372, 'temp': 9.08,
+                             'pressure': 1019.0, 'humidity': 62}
 
 
     def test_homepage(self):
@@ -58,17 +72,16 @@ class TestOpenWeatherMapViews(TestCase):
         self.assertEqual(response.headers['Content-Type'], 'text/html; charset=utf-8')
         self.assertTemplateUsed(response, 'weatherreminder/open_weather.html')
 
-    @patch('weatherreminder.views.CheckCity.check_existing_OpenWeather_city')
-    def test_OpenWeatherView_post_city_not_exists(self, check_mock):
-        check_mock.return_data = False
+    @patch('weatherreminder.utils.OpenWeatherMap.get_weather_reading')
+    def test_OpenWeatherView_post_city_not_exists(self, reading_mock):
+        reading_mock.side_effect = not_found()
         response = self.client.post(reverse('open-weather'), data={'city': 'asd'})
         self.assertEqual(response.status_code, 302)
         self.assertEqual(response.headers['Content-Type'], 'text/html; charset=utf-8')
         self.assertTemplateUsed(response, 'weatherreminder/open_weather.html')
 
-    @patch('weatherreminder.views.OpenWeatherMap.get_context_mixin')
+    @patch('weatherreminder.views.OpenWeatherMap.get_weather_reading')
     def test_OpenWeatherView_post_existing_subscription(self, mixin_mock):
-        self.fake_weather['city'] = self.city1.name
         mixin_mock.return_value = self.fake_weather
         response = self.client.post(reverse('open-weather'),
                                     data={'period': 1, 'service': "OpenWatherMap",
@@ -77,9 +90,8 @@ class TestOpenWeatherMapViews(TestCase):
         self.assertEqual(response.headers['Content-Type'], 'text/html; charset=utf-8')
         self.assertTemplateUsed(response, 'weatherreminder/open_weather.html')
 
-    @patch('weatherreminder.views.OpenWeatherMap.get_context_mixin')
+    @patch('weatherreminder.views.OpenWeatherMap.get_weather_reading')
     def test_OpenWeatherView_post_existing_city_no_subscription(self, mixin_mock):
-        self.fake_weather['city'] = 'London'
         mixin_mock.return_value = self.fake_weather
         response = self.client.post(reverse('open-weather'),
                                     data={'period': 6, 'service': "OpenWatherMap",
@@ -88,11 +100,8 @@ class TestOpenWeatherMapViews(TestCase):
         self.assertEqual(response.headers['Content-Type'], 'text/html; charset=utf-8')
         self.assertTemplateUsed(response, 'weatherreminder/open_weather.html')
 
-    @patch('weatherreminder.views.OpenWeatherMap.get_context_mixin')
-    @patch('weatherreminder.views.CheckCity.check_existing_OpenWeather_city')
-    def test_OpenWeatherView_new_city_new_subscription(self, check_mock, context_mock):
-        self.fake_weather['city'] = "Las_Vegas"
-        check_mock.return_value = False
+    @patch('weatherreminder.views.OpenWeatherMap.get_weather_reading')
+    def test_OpenWeatherView_new_city_new_subscription(self, context_mock):
         context_mock.return_value = self.fake_weather
         response = self.client.post(reverse('open-weather'),
                                     data={'period': 1, 'service': "OpenWatherMap",
@@ -101,13 +110,11 @@ class TestOpenWeatherMapViews(TestCase):
         self.assertEqual(response.headers['Content-Type'], 'text/html; charset=utf-8')
         self.assertTemplateUsed(response, 'weatherreminder/open_weather.html')
 
-    @patch('weatherreminder.views.CheckCity.check_existing_OpenWeather_city')
-    @patch('weatherreminder.utils.OpenWeatherMap.get_context_mixin')
-    def test_OpenWeatherView_to_many_requests(self, context_mixin, check_mock):
-        check_mock.return_value = False
-        context_mixin.return_value = status.HTTP_429_TOO_MANY_REQUESTS
+    @patch('weatherreminder.utils.OpenWeatherMap.get_weather_reading')
+    def test_OpenWeatherView_to_many_requests(self, context_mixin):
+        context_mixin.side_effect = RateLimited(1)
         response = self.client.post(reverse('open-weather'), data={'period': 1, 'service': "OpenWatherMap",
-                                          'city': "Las_Vegas"})
+                                          'city': "Atlantis"})
         self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
 
 
@@ -134,13 +141,15 @@ class TestWeatherBitViews(TestCase):
             city_name=self.city2.name,
             service="WeatherBit",
             country_code='US',
-            coordinate='-74.006 40.7143',
-            temp='14.6с',
-            pressure='1028',
-            humidity='21%'
+            lat=40.7143,
+            lon=-74.006,
+            temp=14.6,
+            pressure=1028,
+            humidity=21
         )
         self.client.login(username='test_username_2', password='test_password_2')
-        self.fake_weather = {'city': 'Lublin', 'country_code': 'US', 'coordinate': '-115.1372 36.175', 'temp': '9.08с', 'pressure': '1019', 'humidity': '62%'}
+        self.fake_weather = {'country_code': 'US', 'lat': 36.175, 'lon': -115.1372, 'temp': 9.08,
+                             'pressure': 1019.0, 'humidity': 62}
 
     def test_WeatherBitView_get(self):
         response = self.client.get(reverse('weather-bit'))
@@ -154,9 +163,9 @@ class TestWeatherBitViews(TestCase):
         self.assertEqual(response.headers['Content-Type'], 'text/html; charset=utf-8')
         self.assertTemplateUsed(response, 'weatherreminder/weather_bit.html')
 
-    @patch('weatherreminder.views.CheckCity.check_existing_OpenWeather_city')
-    def test_WeatherBitView_post_city_not_exists(self, status_mock):
-        status_mock.return_value = True
+    @patch('weatherreminder.utils.WeatherBit.get_weather_reading')
+    def test_WeatherBitView_post_city_not_exists(self, reading_mock):
+        reading_mock.side_effect = not_found()
         self.client.login(username='test_username_2', password='test_password_2')
         response = self.client.post(reverse('weather-bit'), data={'city': 'unknown_city'})
         self.assertEqual(response.status_code, 302)
@@ -181,11 +190,9 @@ class TestWeatherBitViews(TestCase):
         self.assertEqual(response.headers['Content-Type'], 'text/html; charset=utf-8')
         self.assertTemplateUsed(response, 'weatherreminder/weather_bit.html')
 
-    @patch('weatherreminder.views.CheckCity.check_existing_OpenWeather_city')
-    @patch('weatherreminder.views.WeatherBit.get_context_mixin')
-    def test_WeatherBitView_new_city_new_subscription(self, context_mock, status_mock):
+    @patch('weatherreminder.views.WeatherBit.get_weather_reading')
+    def test_WeatherBitView_new_city_new_subscription(self, context_mock):
         context_mock.return_value = self.fake_weather
-        status_mock.return_value = False
         response = self.client.post(reverse('weather-bit'),
                                     data={'period': 3, 'service': "WeatherBit",
                                           'city': "Lublin"})
@@ -193,19 +200,87 @@ class TestWeatherBitViews(TestCase):
         self.assertEqual(response.headers['Content-Type'], 'text/html; charset=utf-8')
         self.assertTemplateUsed(response, 'weatherreminder/weather_bit.html')
         self.assertEqual(len(Weather.objects.all()), 2)
-        self.assertEqual(Weather.objects.get(pk=2).city_name, 'Lublin')
+        self.assertEqual(Weather.objects.exclude(pk=self.weather_bit.pk).get().city_name, 'Lublin')
 
-    @patch('weatherreminder.views.CheckCity.check_existing_OpenWeather_city')
-    @patch('weatherreminder.utils.WeatherBit.get_context_mixin')
-    def test_WeatherBitView_to_many_requests(self, context_mixin, status_mock):
-        context_mixin.return_value = status.HTTP_429_TOO_MANY_REQUESTS
-        status_mock.return_value = False
+    @patch('weatherreminder.utils.WeatherBit.get_weather_reading')
+    def test_WeatherBitView_to_many_requests(self, context_mixin):
+        context_mixin.side_effect = RateLimited(1)
         response = self.client.post(reverse('weather-bit'), data={'period': 1, 'service': "WeatherBit",
-                                          'city': "Las_Vegas"})
+                                          'city': "Atlantis"})
         self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
 
 
 
+class TestSubscribePipeline(TestCase):
+
+    def setUp(self):
+        self.stub = StubProvider().start()
+        patchers = [
+            patch('weatherreminder.utils.OPEN_WEATHER_API_URL', self.stub.open_weather_url),
+            patch('weatherreminder.utils.WEATHER_BIT_API_URL', self.stub.weather_bit_url),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(self.stub.stop)
+        for cache in (provider_cache, city_validation_cache, ratelimit.buckets, breaker.breakers):
+            self.addCleanup(cache.clear)
+        self.user = User.objects.create_user(username='test_username', password='test_password',
+                                             email='test_email@mail.com')
+        self.client.login(username='test_username', password='test_password')
+
+    def test_new_city_costs_one_call(self):
+        for url, service in ((reverse('open-weather'), Service.open_weather),
+                             (reverse('weather-bit'), Service.weather_bit)):
+            with self.subTest(service=service):
+                self.stub.requests.clear()
+                response = self.client.post(url, data={'period': 3, 'city': 'Kyiv'})
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(len(self.stub.requests), 1)
+                self.assertEqual(response.context['city'], 'Kyiv')
+                weather = Weather.objects.get(city__name='Kyiv', service=service)
+                self.assertEqual(weather.country_code, 'UA')
+                self.assertTrue(Subscription.objects.filter(user=self.user, city__name='Kyiv',
+                                                            service=service).exists())
+        city = City.objects.get(name='Kyiv')
+        self.assertEqual((city.lat, city.lon), (50.4333, 30.5167))
+
+    def test_existing_weather_costs_no_calls(self):
+        city = City.objects.create(name='London')
+        Weather.objects.create(city=city, city_name=city.name, service=Service.open_weather, country_code='GB',
+                               lat=51.5085, lon=-0.1257, temp=10.0, pressure=1012.0, humidity=80)
+        response = self.client.post(reverse('open-weather'), data={'period': 3, 'city': 'london'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.stub.requests, [])
+
+    def test_unknown_city_is_remembered(self):
+        for _ in range(2):
+            response = self.client.post(reverse('weather-bit'), data={'period': 3, 'city': 'Londn'})
+            self.assertEqual(response.status_code, 302)
+            self.assertTrue(response.context['error'])
+        self.assertEqual(len(self.stub.requests), 1)
+        self.assertFalse(City.objects.exists())
+        self.assertEqual(breaker.get_breaker(Service.weather_bit).load()['failures'], 0)
+
+    @patch('weatherreminder.views.fetch_missing_weather_task.delay')
+    @patch('weatherreminder.utils.WeatherBit.get_weather_reading', side_effect=RateLimited(1))
+    def test_gazetteer_city_is_subscribed_while_throttled(self, reading_mock, delay_mock):
+        response = self.client.post(reverse('weather-bit'), data={'period': 3, 'city': 'Las_Vegas'})
+        self.assertEqual(response.status_code, 200)
+        subscription = Subscription.objects.get(user=self.user, city__name='Las_Vegas')
+        delay_mock.assert_called_once_with([[subscription.city_id, Service.weather_bit]])
+        self.assertFalse(Weather.objects.exists())
+
+    def test_concurrently_created_subscription_is_updated(self):
+        city = City.objects.create(name='London')
+        view = OpenWeatherView()
+        first = view.create_subscription(self.user, city, city.name, 1)
+        # The second request has not seen the subscription of the first one
+        second = view.create_subscription(self.user, city, city.name, 6)
+        self.assertEqual(second.pk, first.pk)
+        self.assertEqual(Subscription.objects.get().period_notifications, 6)
+
+
 class TestOther(TestCase):
 
     def setUp(self):
@@ -225,10 +300,11 @@ class TestOther(TestCase):
             city_name=self.city1.name,
             service="OpenWeatherMap",
             country_code='US',
-            coordinate='-74.006 40.7143',
-            temp='14.6с',
-            pressure='1028',
-            humidity='21%'
+            lat=40.7143,
+            lon=-74.006,
+            temp=14.6,
+            pressure=1028,
+            humidity=21
         )
         self.client.login(username='test_username_1', password='test_password')
 
@@ -239,6 +315,30 @@ class TestOther(TestCase):
         assert response.headers['Content-Type'] == 'text/html; charset=utf-8'
         self.assertTemplateUsed(response, 'weatherreminder/profile.html')
 
+    def add_subscriptions(self, count):
+        for index in range(count):
+            city = City.objects.create(name=f'City_{index}')
+            for service in Service:
+                Subscription.objects.create(user=self.user1, city=city, period_notifications=Subscription.Period.SIX,
+                                            service=service)
+
+    def test_profile_queries_do_not_depend_on_subscriptions(self):
+        with self.assertNumQueries(5):
+            self.client.get(reverse('profile'))
+        self.add_subscriptions(10)
+        with self.assertNumQueries(5):
+            response = self.client.get(reverse('profile'))
+        self.assertEqual(len(response.context['open_weather']), 11)
+        self.assertEqual(response.context['weather_bit']['City 9'], [Service.weather_bit, 6])
+
+    def test_change_profile_queries_do_not_depend_on_subscriptions(self):
+        with self.assertNumQueries(4):
+            self.client.get(reverse('change_profile'))
+        self.add_subscriptions(10)
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('change_profile'))
+        self.assertEqual(len(response.context['weather_bit']), 10)
+
     def test_change_profile_get(self):
         response = self.client.get(reverse('change_profile'))
         self.assertEqual(response.status_code, 200)
@@ -253,7 +353,7 @@ class TestOther(TestCase):
         }, format='json')
         self.assertEqual(response.status_code, 302)
         self.assertEqual(response.headers['Content-Type'], 'text/html; charset=utf-8')
-        new_user = User.objects.get(pk=1)
+        new_user = User.objects.get(pk=self.user1.pk)
         self.assertEqual(new_user.username, 'New_username')
         self.assertEqual(new_user.email, 'new_mail@mail.com')
 
@@ -3,9 +3,13 @@ from django.urls import path
 from django.contrib.auth.views import LogoutView
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView, TokenVerifyView
 
+from djangoweatherreminder.settings import ASYNC_VIEWS
 from .api_views import *
 from .views import *
 
+if ASYNC_VIEWS:
+    from .async_views import home, OpenWeatherView, WeatherBitView
+
 urlpatterns = [
     path('', home, name='home'),
     path('about/', AboutView.as_view(), name='about'),
@@ -19,9 +23,11 @@ urlpatterns = [
     path('change_profile/', ChangeProfile.as_view(), name='change_profile'),
 
     path('api/v1/subscriptions/', SubscriptionAPIList.as_view(), name='subscriptions-list'),
+    path('api/v1/subscriptions/bulk/', SubscriptionBulkView.as_view(), name='subscriptions-bulk'),
     path('api/v1/subscriptions/<int:pk>/', SubscriptionAPIList.as_view(), name='one-subscription'),
     path('api/v1/cities/', CitiesListView.as_view(), name='cities-list'),
     path('api/v1/cities/<int:pk>/', CitiesListView.as_view(), name='one-city'),
+    path('api/v1/cities/autocomplete/', CityAutocompleteView.as_view(), name='cities-autocomplete'),
     path('api/v1/get_weather/', GetWeather.as_view(), name='weather-list'),
     path('api/v1/token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('api/v1/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
@@ -1,19 +1,31 @@
-from django.core.mail import EmailMultiAlternatives
-from django.template.loader import get_template
 from rest_framework import serializers
 import re
-import urllib
+from collections import Counter
+from statistics import median
 from rest_framework import status
 import environ
 import requests
+from requests.adapters import HTTPAdapter
 from rest_framework.response import Response
-from djangoweatherreminder.settings import OPEN_WEATHER_API_URL, WEATHER_BIT_API_URL
+from djangoweatherreminder.settings import OPEN_WEATHER_API_URL, WEATHER_BIT_API_URL, OPEN_WEATHER_GROUP_API_URL, \
+    WEATHER_API_TIMEOUT, WEATHER_API_CONCURRENCY, WEATHER_UPSERT_BATCH_SIZE, WEATHER_PROVIDERS, \
+    OPEN_WEATHER_GROUP_SIZE
+from .cache import provider_cache, city_validation_cache
+from .ratelimit import throttle
+from .breaker import ProviderUnavailable, get_breaker
+from .singleflight import single_flight
+from .formatting import READING_FIELDS, format_weather, weather_age, weather_reading
 from .models import *
 
 env = environ.Env()
 WEATHER_API_KEY = env('WEATHER_API_KEY')
 WEATHER_BIT_KEY = env('WEATHER_BIT_KEY')
 
+# One keep-alive connection pool per process for all blocking provider calls
+http_session = requests.Session()
+http_session.mount('http://', HTTPAdapter(pool_maxsize=WEATHER_API_CONCURRENCY))
+http_session.mount('https://', HTTPAdapter(pool_maxsize=WEATHER_API_CONCURRENCY))
+
 
 class DataMixin:
     def get_user_context(self, **kwargs):
@@ -28,16 +40,27 @@ class CheckCity:
         self.api_token = api_token
 
     def check_existing_OpenWeather_city(self):
-        url = f'{self.service_url}?q={CityName(self.city_name).api()}&appid={self.api_token}'
-        r = requests.get(url)
-        print(r)
-        return r.status_code != 200
+        """Returns True if there is no such city.
+        Raises RateLimited or ProviderUnavailable when the service can't tell now"""
+        return not city_validation_cache.check(Service.open_weather, self.city_name, self.request_OpenWeather_city)
 
     def check_existing_WeatherBit_city(self):
+        """Returns True if there is no such city.
+        Raises RateLimited or ProviderUnavailable when the service can't tell now"""
+        return not city_validation_cache.check(Service.weather_bit, self.city_name, self.request_WeatherBit_city)
+
+    def request_OpenWeather_city(self):
+        url = f'{self.service_url}?q={CityName(self.city_name).api()}&appid={self.api_token}'
+        return self.request_status(Service.open_weather, url)
+
+    def request_WeatherBit_city(self):
         url = f'{self.service_url}?key={self.api_token}&city={CityName(self.city_name).api()}'
-        r = requests.get(url)
-        print(r, 'bit')
-        return r.status_code != 200
+        return self.request_status(Service.weather_bit, url)
+
+    def request_status(self, service, url):
+        """Raises RateLimited instead of sending the check over the quota"""
+        throttle(service, self.api_token)
+        return http_session.get(url, timeout=WEATHER_API_TIMEOUT).status_code
 
 
 def delete_city_and_subscription(request, cities: list):
@@ -49,7 +72,6 @@ def delete_city_and_subscription(request, cities: list):
             city = City.objects.filter(name=CityName(c[0]).serializer()).first()
             subscription = Subscription.objects.filter(user=request.user, city=city, service=service).first()
             SubscriptionTask(subscription).delete_task()
-            WeatherTask(subscription).delete_subscription_weather_task()
             subscription.delete()
 
             all_subscriptions = Subscription.objects.filter(city=city)
@@ -82,7 +104,27 @@ def change_period(request, periods):
             SubscriptionTask(subscription).edit_task()
 
 
+providers = {}
+
+
+def register_provider(provider_class):
+    """Class decorator that plugs a weather service in under its `service` name.
+    Registered services are used by subscriptions, refreshes and the fan-out fetch."""
+    providers[provider_class.service] = provider_class
+    return provider_class
+
+
 class BaseWeather:
+    service = None
+    units = 'metric'
+    api_key = None
+    # Services with group requests set supports_group and implement get_group_url and
+    # get_group_data; group_id_field is the City model field with the service id of the city
+    # and group_size the most ids per request
+    supports_group = False
+    group_id_field = None
+    group_size = None
+
     def __init__(self, city=None):
         if city:
             if "_" in city or " " in city:
@@ -90,70 +132,145 @@ class BaseWeather:
             else:
                 self.city = city
 
-    def __get_weather(self, token):
+    def get_url(self, token):
         pass
 
-    def get_context_mixin(self, token, index=None):
-        context = {}
-        return context
-
-    def create_weather(self, new_city, service, token):
-        weather_data = self.get_context_mixin(token)
-        return Weather.objects.create(
-            city=new_city,
-            city_name=CityName(weather_data['city']).serializer(),
-            country_code=weather_data['country_code'],
-            coordinate=weather_data['coordinate'],
-            temp=weather_data['temp'],
-            pressure=weather_data['pressure'],
-            humidity=weather_data['humidity'],
-            service=service,
-        )
+    def get_city_url(self, city_model, token):
+        """Url of the City model weather, by its ids when the service supports them"""
+        return self.get_url(token)
 
+    def get_group_url(self, city_ids, token):
+        raise NotImplementedError(f"{self.service} has no group requests")
 
-class OpenWeatherMap(BaseWeather):
-    def __init__(self, city=None):
-        super().__init__(city)
-        self.OPEN_WEATHER_API_URL = OPEN_WEATHER_API_URL
+    def get_group_data(self, list_of_data) -> dict:
+        """Returns {city id: service response of the city} from a group response"""
+        raise NotImplementedError(f"{self.service} has no group requests")
 
     def __get_weather(self, token):
-        source = urllib.request.urlopen(
-            f'{self.OPEN_WEATHER_API_URL}?q={self.city}&appid={token}&units=metric').read()
-        return json.loads(source)
+        response = http_session.get(self.get_url(token), timeout=WEATHER_API_TIMEOUT)
+        response.raise_for_status()
+        if response.status_code == 204:
+            # WeatherBit answers an unknown city with an empty response
+            raise CityNotFound(self.city)
+        return response.json()
+
+    def get_weather_data(self, token, probe=False) -> dict:
+        """Returns service response for the city, at most once per WEATHER_CACHE_TTL
+        and with one call for concurrent requests of the same city.
+        Raises ProviderUnavailable while the service circuit is open, unless it's a background probe."""
+        list_of_data = provider_cache.get(self.service, self.city, self.units)
+        if list_of_data is None:
+            list_of_data = single_flight.do(provider_cache.key(self.service, self.city, self.units),
+                                            lambda: self.__fetch_weather_data(token, probe),
+                                            lookup=lambda: provider_cache.get(self.service, self.city, self.units))
+        return list_of_data
+
+    def __fetch_weather_data(self, token, probe):
+        """Concurrent callers for the same city share this one call.
+        The quota is taken before the breaker call: waiting for our own quota is no provider failure."""
+        breaker = get_breaker(self.service)
+        if not probe:
+            breaker.check()
+        throttle(self.service, token)
+        list_of_data = breaker.call(self.__get_weather, token, probe=probe)
+        provider_cache.set(self.service, self.city, list_of_data, self.units)
+        return list_of_data
+
+    def get_weather_reading(self, token, probe=False) -> dict:
+        """Returns typed weather values for the city from service"""
+        return self.get_reading_from_data(self.get_weather_data(token, probe))
 
     def get_context_mixin(self, token, index=None) -> dict:
-        """Returns context dict directly from service in proper view"""
-        list_of_data = self.__get_weather(token)
-        # print(list_of_data, 'openw')
+        """Returns context dict from service in proper view.
+        When the service is unavailable the last stored weather is returned with its age."""
+        try:
+            reading = self.get_weather_reading(token)
+        except (ProviderUnavailable, requests.RequestException):
+            stored = Weather.objects.filter(city_name=CityName(CityName(self.city).view()).serializer(),
+                                            service=self.service).first()
+            if stored is None:
+                raise
+            return self.get_context_from_weather(stored, index)
+        return self.get_context_from_reading(reading, index)
+
+    def get_context_from_reading(self, reading, index=None) -> dict:
         city = CityName(self.city).view()
         if index:
             city = city.replace("_", " ")
-        context_mixin = {
-            'city': city,
-            "country_code": str(list_of_data['sys']['country']),
-            "coordinate": str(list_of_data['coord']['lon']) + ' ' + str(list_of_data['coord']['lat']),
-            "temp": str(list_of_data['main']['temp']) + 'с',
-            "pressure": str(list_of_data['main']['pressure']),
-            "humidity": str(list_of_data['main']['humidity']) + '%'
-        }
+        context_mixin = {'city': city}
+        context_mixin.update(format_weather(reading))
         return context_mixin
 
+    def get_reading_from_data(self, list_of_data) -> dict:
+        reading = {}
+        return reading
+
     def get_existing_weather_mixin(self, existing_city, index=None) -> dict:
         """Returns context dict from database"""
-        weather_model = Weather.objects.filter(city=existing_city, service=Service.open_weather).first()
+        weather_model = Weather.objects.filter(city=existing_city, service=self.service).first()
+        return self.get_context_from_weather(weather_model, index)
+
+    def get_context_from_weather(self, weather_model, index=None) -> dict:
+        """Returns context dict of the stored weather with its age"""
         city = CityName(weather_model.city_name).serializer()
         if index:
             city = city.replace("_", " ")
-        context_mixin = {
-            'city': city,
-            "country_code": weather_model.country_code,
-            "coordinate": weather_model.coordinate,
-            "temp": weather_model.temp,
-            "pressure": weather_model.pressure,
-            "humidity": weather_model.humidity
-        }
+        context_mixin = {'city': city}
+        context_mixin.update(format_weather(weather_reading(weather_model)))
+        context_mixin.update(weather_age(weather_model.updated_at))
         return context_mixin
 
+    def get_city_ids(self, list_of_data) -> dict:
+        """Returns the stable ids of the city from the service response"""
+        reading = self.get_reading_from_data(list_of_data)
+        return {'lat': reading['lat'], 'lon': reading['lon']}
+
+    def create_weather(self, new_city, service, token):
+        reading = self.get_weather_reading(token)
+        if resolve_city(new_city, {'lat': reading['lat'], 'lon': reading['lon']}):
+            new_city.save(update_fields=['lat', 'lon'])
+        return store_weather(new_city, service, reading)
+
+
+@register_provider
+class OpenWeatherMap(BaseWeather):
+    service = Service.open_weather
+    api_key = WEATHER_API_KEY
+    supports_group = True
+    group_id_field = 'open_weather_id'
+    group_size = OPEN_WEATHER_GROUP_SIZE
+
+    def __init__(self, city=None):
+        super().__init__(city)
+        self.OPEN_WEATHER_API_URL = OPEN_WEATHER_API_URL
+        self.OPEN_WEATHER_GROUP_API_URL = OPEN_WEATHER_GROUP_API_URL
+
+    def get_url(self, token):
+        return f'{self.OPEN_WEATHER_API_URL}?q={self.city}&appid={token}&units={self.units}'
+
+    def get_group_url(self, city_ids, token):
+        ids = ','.join(str(city_id) for city_id in city_ids)
+        return f'{self.OPEN_WEATHER_GROUP_API_URL}?id={ids}&appid={token}&units={self.units}'
+
+    def get_group_data(self, list_of_data) -> dict:
+        return {data['id']: data for data in list_of_data.get('list', [])}
+
+    def get_city_ids(self, list_of_data) -> dict:
+        city_ids = super().get_city_ids(list_of_data)
+        city_ids['open_weather_id'] = list_of_data.get('id') or None
+        return city_ids
+
+    def get_reading_from_data(self, list_of_data) -> dict:
+        """Returns typed weather values from the service response"""
+        return {
+            "country_code": str(list_of_data['sys']['country']),
+            "lat": float(list_of_data['coord']['lat']),
+            "lon": float(list_of_data['coord']['lon']),
+            "temp": float(list_of_data['main']['temp']),
+            "pressure": float(list_of_data['main']['pressure']),
+            "humidity": int(list_of_data['main']['humidity']),
+        }
+
 
 class CityName:
     def __init__(self, city):
@@ -189,57 +306,140 @@ class CityName:
         return city
 
 
+@register_provider
 class WeatherBit(BaseWeather):
+    service = Service.weather_bit
+    api_key = WEATHER_BIT_KEY
+
     def __init__(self, city=None):
         super().__init__(city)
         self.WEATHER_BIT_API_URL = WEATHER_BIT_API_URL
 
-    def __get_weather(self, token):
-        source = urllib.request.urlopen(
-            f'{self.WEATHER_BIT_API_URL}?city={self.city}&key={token}&units=metric').read()
-        return json.loads(source)
-
-    def get_context_mixin(self, token, index=None):
-        list_of_data = self.__get_weather(token)
-        # print(list_of_data, 'weatherb')
-        city = CityName(self.city).view()
-        if index:
-            city = city.replace("_", " ")
-        context_mixin = {
-            'city': city,
-            "country_code": str(list_of_data['data'][0]['country_code']),
-            "coordinate": str(list_of_data['data'][0]['lon']) + ' ' + str(list_of_data['data'][0]['lat']),
-            "temp": str(list_of_data['data'][0]['temp']) + 'с',
-            "pressure": str(list_of_data['data'][0]['pres']),
-            "humidity": str(list_of_data['data'][0]['rh']) + '%'
-        }
-        return context_mixin
-
-    def get_existing_weather_mixin(self, existing_city, index=None) -> dict:
-        """Returns context dict from database"""
-        weather_model = Weather.objects.filter(city=existing_city, service=Service.weather_bit).first()
-        city = CityName(weather_model.city_name).serializer()
-        if index:
-            city = city.replace("_", " ")
-        context_mixin = {
-            'city': city,
-            "country_code": weather_model.country_code,
-            "coordinate": weather_model.coordinate,
-            "temp": weather_model.temp,
-            "pressure": weather_model.pressure,
-            "humidity": weather_model.humidity
+    def get_url(self, token):
+        return f'{self.WEATHER_BIT_API_URL}?city={self.city}&key={token}&units={self.units}'
+
+    def get_coordinates_url(self, lat, lon, token):
+        return f'{self.WEATHER_BIT_API_URL}?lat={lat}&lon={lon}&key={token}&units={self.units}'
+
+    def get_city_url(self, city_model, token):
+        """WeatherBit has no multi-city requests, but coordinates are less ambiguous than names"""
+        if city_model.lat is not None and city_model.lon is not None:
+            return self.get_coordinates_url(city_model.lat, city_model.lon, token)
+        return self.get_url(token)
+
+    def get_reading_from_data(self, list_of_data) -> dict:
+        """Returns typed weather values from the service response"""
+        data = list_of_data['data'][0]
+        return {
+            "country_code": str(data['country_code']),
+            "lat": float(data['lat']),
+            "lon": float(data['lon']),
+            "temp": float(data['temp']),
+            "pressure": float(data['pres']),
+            "humidity": int(data['rh']),
         }
-        return context_mixin
 
 
 def check_or_create_weather(city_model, city_name, service):
     weather = Weather.objects.filter(city_name=city_name, service=service).first()
     if weather:
         return
-    if service == Service.open_weather:
-        OpenWeatherMap(city=city_name).create_weather(city_model, service, WEATHER_API_KEY)
-    else:
-        WeatherBit(city=city_name).create_weather(city_model, service, WEATHER_BIT_KEY)
+    provider, token = get_provider(city_name, service)
+    provider.create_weather(city_model, service, token)
+
+
+CITY_ID_FIELDS = ['open_weather_id', 'lat', 'lon']
+
+
+def resolve_city(city_model, city_ids) -> bool:
+    """Fills the city ids that are not known yet. Returns True if the city has changed"""
+    changed = False
+    for field, value in city_ids.items():
+        if value is not None and getattr(city_model, field) is None:
+            setattr(city_model, field, value)
+            changed = True
+    return changed
+
+
+def get_provider(city_name, service):
+    """Returns weather class of the selected service for the city with its api token"""
+    provider_class = providers[service]
+    return provider_class(city=city_name), provider_class.api_key
+
+
+def enabled_services(services=None) -> list:
+    """Registered services from `services` or from WEATHER_PROVIDERS, in that order"""
+    return [service for service in (services or WEATHER_PROVIDERS) if service in providers]
+
+
+def merge_readings(readings) -> dict:
+    """Consensus of readings of several services: the median of every value,
+    so one service that is off doesn't move the result. Country is taken by majority."""
+    readings = list(readings)
+    merged = {'country_code': Counter(reading['country_code'] for reading in readings).most_common(1)[0][0]}
+    for field in ('lat', 'lon', 'temp', 'pressure', 'humidity'):
+        values = [reading[field] for reading in readings if reading.get(field) is not None]
+        merged[field] = median(values) if values else None
+    if merged['humidity'] is not None:
+        merged['humidity'] = round(merged['humidity'])
+    return merged
+
+
+def fetch_weather(city_name, service) -> dict:
+    """Returns typed weather values for the city directly from the selected service.
+    Background calls probe the service even while its circuit is open."""
+    provider, token = get_provider(city_name, service)
+    return provider.get_weather_reading(token, probe=True)
+
+
+class CityNotFound(Exception):
+    """The selected service doesn't know the city"""
+    status = 404  # an answer of a healthy service for is_provider_failure
+
+
+def fetch_city_weather(city_name, service) -> dict:
+    """Validates the city and returns its typed weather with one call to the selected service.
+    The answer is remembered in city_validation_cache, so a known typo costs no calls at all.
+    Raises CityNotFound for a city the service doesn't know."""
+    exists = city_validation_cache.get(service, city_name)
+    if exists is False:
+        raise CityNotFound(city_name)
+    provider, token = get_provider(city_name, service)
+    try:
+        reading = provider.get_weather_reading(token)
+    except CityNotFound:
+        city_validation_cache.set(service, city_name, False)
+        raise
+    except requests.HTTPError as e:
+        if e.response is not None and e.response.status_code in (204, 400, 404):
+            city_validation_cache.set(service, city_name, False)
+            raise CityNotFound(city_name) from e
+        raise
+    if exists is None:
+        city_validation_cache.set(service, city_name, True)
+    return reading
+
+
+def store_weathers(readings, batch_size=None) -> int:
+    """Upserts Weather rows from {(city model, service): reading} with one
+    INSERT ... ON CONFLICT (city, service) DO UPDATE statement per batch.
+    Returns the number of written rows."""
+    updated_at = timezone.now()
+    weathers = [Weather(city=city_model, city_name=city_model.name, service=service, updated_at=updated_at, **reading)
+                for (city_model, service), reading in readings.items()]
+    Weather.objects.bulk_create(
+        weathers,
+        batch_size=batch_size or WEATHER_UPSERT_BATCH_SIZE,
+        update_conflicts=True,
+        unique_fields=['city', 'service'],
+        update_fields=['city_name', *READING_FIELDS, 'updated_at'],
+    )
+    return len(weathers)
+
+
+def store_weather(city_model, service, reading):
+    """Updates the only Weather row of the (city, service) pair or creates it"""
+    return store_weathers({(city_model, service): reading})
 
 
 def check_period(period) -> int:
@@ -250,16 +450,15 @@ def check_period(period) -> int:
     return period
 
 
-def subscription_dict(request, service) -> dict:
-    subscription_lst = Subscription.objects.filter(user=request.user.id, service=service)
-    dct = {}
-    if len(subscription_lst) != 0:
-        for subscription in subscription_lst:
-            dct[CityName(subscription.city.name).view()] = [subscription.service, subscription.period_notifications]
-    return dct
-
-
-
+def subscription_dicts(request) -> dict:
+    """Returns {service: {city: [service, period]}} of all user's subscriptions,
+    loaded with one query joined with the cities"""
+    dcts = {service: {} for service in Service}
+    subscriptions = Subscription.objects.filter(user=request.user.id).order_by('pk') \
+        .values_list('city__name', 'service', 'period_notifications')
+    for city_name, service, period in subscriptions:
+        dcts[service][CityName(city_name).view()] = [service, period]
+    return dcts
 
 
 def check_existing_subscription(data):
@@ -269,7 +468,6 @@ def check_existing_subscription(data):
             user=data['user'],
             city=data['city'],
             service=data['service'],
-            period_notifications=data['period_notifications']
         ).first()
     except:
         return Response(
@@ -290,24 +488,6 @@ def check_existing_subscription(data):
     return
 
 
-def send_message(name, email, content):
-    text = get_template("weatherreminder/message.html")
-    html = get_template("weatherreminder/message.html")
-    context = {
-        'name': name,
-        'email': email,
-        'content': content
-    }
-    subject = "Weather notification"
-    from_email = "rollbar1990@gmail.com"
-    text_content = text.render(context)
-    html_content = html.render(context)
-
-    msg = EmailMultiAlternatives(subject, text_content, from_email, to=[email])
-    msg.attach_alternative(html_content, 'text/html')
-    msg.send()
-
-
 def task_period_hours_change(period):
     if period == 3:
         return '*/'+period
@@ -1,33 +1,35 @@
 
 from weatherreminder.utils import change_period, \
-    check_period, delete_city_and_subscription, subscription_dict, \
-    OpenWeatherMap, CityName, CheckCity, WeatherBit
+    check_period, delete_city_and_subscription, subscription_dicts, fetch_city_weather, get_provider, \
+    resolve_city, store_weather, BaseWeather, CityNotFound, OpenWeatherMap, CityName, WeatherBit
 
 from django.contrib.auth import logout, login
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.views import LoginView
 from django.http import HttpResponseNotFound, HttpResponseServerError
 from django.shortcuts import render, redirect, get_object_or_404
-import environ
+from django.db import IntegrityError, transaction
 from django.views import View
 from django.views.generic import CreateView, ListView
 
-from djangoweatherreminder.settings import OPEN_WEATHER_API_URL, WEATHER_BIT_API_URL
+from djangoweatherreminder.settings import WEATHER_FANOUT_MODE
+from weatherreminder.clients import fetch_fanout
+from weatherreminder.gazetteer import get_gazetteer
 from weatherreminder.forms import RegisterUserForm, LoginUserForm, ChangeProfileForm
-from weatherreminder.models import Subscription, User, City, Service, Weather, SubscriptionTask, WeatherTask
+from weatherreminder.models import Subscription, User, City, Service, Weather, SubscriptionTask
+from weatherreminder.tasks import fetch_missing_weather_task
 from weatherreminder.utils import DataMixin
 
-env = environ.Env()
-WEATHER_API_KEY = env('WEATHER_API_KEY')
-WEATHER_BIT_KEY = env('WEATHER_BIT_KEY')
-
-
 def home(request):
     if request.method == 'POST':
         city = request.POST.get('city')
         token = request.POST.get('token')
         try:
-            context = OpenWeatherMap(city=city).get_context_mixin(token, index=True)
+            if WEATHER_FANOUT_MODE and not token:
+                reading, _ = fetch_fanout(city, WEATHER_FANOUT_MODE)
+                context = BaseWeather(city=city).get_context_from_reading(reading, index=True)
+            else:
+                context = OpenWeatherMap(city=city).get_context_mixin(token, index=True)
         except:
             context = {'error': True}
         return render(request, 'weatherreminder/index.html', context)
@@ -35,174 +37,101 @@ def home(request):
     return render(request, 'weatherreminder/index.html', context)
 
 
-class OpenWeatherView(LoginRequiredMixin, DataMixin, View):
+class SubscribeView(LoginRequiredMixin, DataMixin, View):
+    """Subscription page of one weather service. Both services share this code path:
+    a new city is validated, stored and rendered from one response of the service.
+    While the service is unavailable or throttled, cities from the gazetteer are still
+    subscribed and their weather is fetched in the background."""
     model = Subscription
-    template_name = 'weatherreminder/open_weather.html'
+    template_name = None
+    title = None
+    service = None
 
     def get(self, request):
-        context = self.get_user_context()
-        context['title'] = "OpenWeatherMap service"
-        context['user'] = request.user
+        context = self.get_user_context(title=self.title, user=request.user)
         return render(request, self.template_name, context=context)
 
     def post(self, request):
         user = request.user
-        context = self.get_user_context()
-        context['title'] = "OpenWeatherMap service"
-        context['user'] = user
+        context = self.get_user_context(title=self.title, user=user)
         city = request.POST.get('city')
-        period = request.POST.get('period')
-        service = Service.open_weather
+        period = check_period(request.POST.get('period'))
+        provider, _ = get_provider(city, self.service)
         try:
-            existing_city = City.objects.filter(
-                    name__iexact=CityName(city).serializer()).first()
+            city_name = CityName(city).serializer()
         except:
             context['error'] = True
             return render(request, self.template_name, context, status=302)
-        if not existing_city:
-            if CheckCity(city, OPEN_WEATHER_API_URL, WEATHER_API_KEY).check_existing_OpenWeather_city():
-                context['error'] = True
-                return render(request, self.template_name, context, status=302)
-            new_city = City.objects.create(name=CityName(city).serializer())
-            subscription = Subscription.objects.create(
-                user=user,
-                city=new_city,
-                period_notifications=check_period(period),
-                service=service
-            )
-            new_city.users.add(user)
-            new_city.save()
-            try:
-                OpenWeatherMap(city=city).create_weather(new_city, service, WEATHER_API_KEY)
-            except:
-                context['too_many'] = True
-                return render(request, self.template_name, context, status=429)
-            SubscriptionTask(subscription).create_task()
-            WeatherTask(subscription).create_task()
-            try:
-                context_mixin = OpenWeatherMap(city=city).get_context_mixin(WEATHER_API_KEY, index=True)
-            except:
-                context['to_many'] = True
-                return render(request, self.template_name, context, status=429)
-            context.update(context_mixin)
-            return render(request, self.template_name, context, status=200)
-        else:
-            existing_subscription = Subscription.objects.filter(city=existing_city, user=user, service=Service.open_weather).first()
+        existing_city = City.objects.filter(name__iexact=city_name).first()
+        if existing_city is not None:
+            existing_subscription = Subscription.objects.filter(city=existing_city, user=user,
+                                                                service=self.service).first()
             if existing_subscription is not None:
-                existing_subscription.period_notifications = period if period != "Select period" else 12
+                existing_subscription.period_notifications = period
                 existing_subscription.save()
-                context_mixin = OpenWeatherMap(city=city).get_existing_weather_mixin(existing_city, index=True)
-                SubscriptionTask(existing_subscription).create_task()
-                WeatherTask(existing_subscription).create_task()
-                context.update(context_mixin)
-                if context['user'] == request.user:
-                    context['exists'] = True
+                SubscriptionTask(existing_subscription).edit_task()
+                context.update(provider.get_existing_weather_mixin(existing_city, index=True))
+                context['exists'] = True
                 return render(request, self.template_name, context, status=302)
-            subscription = Subscription.objects.create(
-                user=user,
-                city=existing_city,
-                period_notifications=check_period(period),
-                service=service
-            )
-            existing_city.users.add(user)
-            existing_city.save()
-            weather = Weather.objects.filter(city_name=existing_city.name, service=service).first()
-            if not weather:
-                try:
-                    OpenWeatherMap(city=city).create_weather(existing_city, service, WEATHER_API_KEY)
-                    context_mixin = OpenWeatherMap(city=city).get_context_mixin(WEATHER_API_KEY)
-                except:
-                    context['to_many'] = True
-                    return render(request, self.template_name, context, status=429)
-            else:
-                context_mixin = OpenWeatherMap().get_existing_weather_mixin(existing_city, index=True)
-            SubscriptionTask(subscription).create_task()
-            WeatherTask(subscription).create_task()
-            context.update(context_mixin)
-            return render(request, self.template_name, context, status=200)
-
-
-class WeatherBitView(LoginRequiredMixin, DataMixin, View):
-    model = Subscription
-    template_name = 'weatherreminder/weather_bit.html'
-
-    def get(self, request):
-        context = self.get_user_context()
-        context['title'] = "OpenWeatherMap service"
-        context['user'] = request.user
-        return render(request, self.template_name, context=context)
-
-    def post(self, request):
-        user = request.user
-        context = self.get_user_context()
-        context['title'] = "WeatherBit service"
-        context['user'] = user
-        city = request.POST.get('city')
-        period = request.POST.get('period')
-        service = Service.weather_bit
-        try:
-            existing_city = City.objects.filter(
-                name__iexact=CityName(city).serializer()).first()
-        except:
-            context['error'] = True
-            return render(request, self.template_name, context, status=302)
-        if not existing_city:
-            if CheckCity(city, OPEN_WEATHER_API_URL, WEATHER_API_KEY).check_existing_OpenWeather_city():
+        weather = Weather.objects.filter(city=existing_city, service=self.service).first() if existing_city else None
+        reading = None
+        if weather is None:
+            try:
+                reading = fetch_city_weather(city, self.service)
+            except CityNotFound:
                 context['error'] = True
                 return render(request, self.template_name, context, status=302)
-            new_city = City.objects.create(name=CityName(city).serializer())
-            subscription = Subscription.objects.create(
-                user=user,
-                city=new_city,
-                period_notifications=check_period(period),
-                service=service
-            )
-            new_city.users.add(user)
-            new_city.save()
-            try:
-                WeatherBit(city=city).create_weather(new_city, service, WEATHER_BIT_KEY)
             except:
-                context['to_many'] = True
-                return render(request, self.template_name, context, status=429)
-            SubscriptionTask(subscription).create_task()
-            WeatherTask(subscription).create_task()
-            context_mixin = WeatherBit(city=city).get_context_mixin(WEATHER_BIT_KEY, index=True)
-            context.update(context_mixin)
-            return render(request, self.template_name, context, status=200)
-        else:
-            existing_subscription = Subscription.objects.filter(city=existing_city, user=user, service=Service.weather_bit).first()
-            if existing_subscription is not None:
-                existing_subscription.period_notifications = period if period != "Select period" else 12
-                existing_subscription.save()
-                context_mixin = WeatherBit(city=city).get_existing_weather_mixin(existing_city, index=True)
-                SubscriptionTask(existing_subscription).create_task()
-                WeatherTask(existing_subscription).create_task()
-                context.update(context_mixin)
-                if context['user'] == request.user:
-                    context['exists'] = True
-                return render(request, self.template_name, context, status=302)
-            subscription = Subscription.objects.create(
-                user=user,
-                city=existing_city,
-                period_notifications=check_period(period),
-                service=service
-            )
-            existing_city.users.add(user)
-            existing_city.save()
-            weather = Weather.objects.filter(city_name=existing_city.name, service=service).first()
-            if not weather:
-                try:
-                    WeatherBit(city=city).create_weather(existing_city, service, WEATHER_BIT_KEY)
-                    context_mixin = WeatherBit(city=city).get_context_mixin(WEATHER_BIT_KEY)
-                except:
+                if city not in get_gazetteer():
                     context['to_many'] = True
                     return render(request, self.template_name, context, status=429)
-            else:
-                context_mixin = WeatherBit().get_existing_weather_mixin(existing_city, index=True)
-            SubscriptionTask(subscription).create_task()
-            WeatherTask(subscription).create_task()
-            context.update(context_mixin)
-            return render(request, self.template_name, context, status=200)
+        subscription = self.create_subscription(user, existing_city, city_name, period, reading)
+        if reading is not None:
+            context.update(provider.get_context_from_reading(reading, index=True))
+        elif weather is not None:
+            context.update(provider.get_context_from_weather(weather, index=True))
+        else:
+            fetch_missing_weather_task.delay([[subscription.city_id, self.service]])
+            context['city'] = CityName(city).view()
+        return render(request, self.template_name, context, status=200)
+
+    def create_subscription(self, user, city_model, city_name, period, reading=None):
+        """Creates the city if it's new, the subscription and the weather from the service reading.
+        A subscription created meanwhile by a concurrent request gets the new period instead."""
+        with transaction.atomic():
+            if city_model is None:
+                city_model, _ = City.objects.get_or_create(name=city_name)
+            try:
+                with transaction.atomic():
+                    subscription = Subscription.objects.create(
+                        user=user,
+                        city=city_model,
+                        period_notifications=period,
+                        service=self.service
+                    )
+            except IntegrityError:
+                subscription = Subscription.objects.get(user=user, city=city_model, service=self.service)
+                subscription.period_notifications = period
+                subscription.save(update_fields=['period_notifications'])
+            city_model.users.add(user)
+            if reading is not None:
+                if resolve_city(city_model, {'lat': reading['lat'], 'lon': reading['lon']}):
+                    city_model.save(update_fields=['lat', 'lon'])
+                store_weather(city_model, self.service, reading)
+        SubscriptionTask(subscription).create_task()
+        return subscription
+
+
+class OpenWeatherView(SubscribeView):
+    template_name = 'weatherreminder/open_weather.html'
+    title = "OpenWeatherMap service"
+    service = Service.open_weather
+
+
+class WeatherBitView(SubscribeView):
+    template_name = 'weatherreminder/weather_bit.html'
+    title = "WeatherBit service"
+    service = Service.weather_bit
 
 
 class RegisterUser(DataMixin, CreateView):
@@ -247,8 +176,9 @@ class Profile(LoginRequiredMixin, DataMixin, ListView):
         context['user'] = get_object_or_404(User, pk=self.request.user.pk)
         context_mixin = self.get_user_context(title=f"Yours profile: {context['user']}")
         context_mixin['subscription'] = Subscription.objects.filter(user=self.request.user.id).first()
-        context_mixin['open_weather'] = subscription_dict(self.request, Service.open_weather)
-        context_mixin['weather_bit'] = subscription_dict(self.request, Service.weather_bit)
+        subscriptions = subscription_dicts(self.request)
+        context_mixin['open_weather'] = subscriptions[Service.open_weather]
+        context_mixin['weather_bit'] = subscriptions[Service.weather_bit]
         context.update(context_mixin)
         return context
 
@@ -262,14 +192,16 @@ class ChangeProfile(LoginRequiredMixin, DataMixin, View):
         initial_data = {
             'username': user.username,
             'email': user.email,
+            'digest_notifications': user.digest_notifications,
         }
         context = self.get_user_context()
         context_mixin = self.get_user_context(title=f"Change profile")
         context['form'] = self.post_form(initial=initial_data)
         context['user'] = get_object_or_404(User, pk=self.request.user.pk)
         context.update(context_mixin)
-        context['open_weather'] = subscription_dict(request, Service.open_weather)
-        context['weather_bit'] = subscription_dict(request, Service.weather_bit)
+        subscriptions = subscription_dicts(request)
+        context['open_weather'] = subscriptions[Service.open_weather]
+        context['weather_bit'] = subscriptions[Service.weather_bit]
 
         return render(request, self.template_name, context=context)
 